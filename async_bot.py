@@ -0,0 +1,513 @@
+"""
+asyncio-режим бота на AsyncTeleBot: все запросы к Telegram, ffmpeg и ffprobe
+не блокируют потоки, тысячи чатов обслуживает один цикл событий.
+yt-dlp работает в отдельном пуле потоков размером DOWNLOAD_WORKERS.
+
+Запуск: python async_bot.py (синхронный режим: python bot.py).
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import time
+import logging
+import tempfile
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+import bot as core
+from jobs import DOWNLOAD_WORKERS, JobCancelled, SharedDownloadFailed, open_control, close_control, get_control, set_current_job
+from pipeline import run_pipeline_async, detect_platform
+from ratelimit import TelegramRateLimiter, HIGH, LOW
+from state import WAITING_FOR_LINK, WAITING_FOR_DOWNLOAD
+from urls import extract_links, resolve_link, link_key
+import metrics
+
+# Сколько задач из очереди обрабатывается одновременно; ожидание сети и
+# ffmpeg не занимает потоков, поэтому значение может быть большим
+ASYNC_JOB_WORKERS = int(os.getenv("ASYNC_JOB_WORKERS", "64"))
+
+
+class RateLimitedAsyncTeleBot(AsyncTeleBot):
+    """AsyncTeleBot, у которого исходящие сообщения проходят через TelegramRateLimiter."""
+
+    def __init__(self, token, *args, limiter=None, **kwargs):
+        super().__init__(token, *args, **kwargs)
+        self.limiter = limiter or TelegramRateLimiter()
+
+    async def send_message(self, chat_id, text, *args, priority=HIGH, **kwargs):
+        return await self.limiter.call_async(chat_id, priority, super().send_message, chat_id, text, *args, **kwargs)
+
+    async def edit_message_text(self, text, chat_id=None, *args, priority=HIGH, **kwargs):
+        return await self.limiter.call_async(chat_id, priority, super().edit_message_text, text, chat_id, *args, **kwargs)
+
+    async def send_video(self, chat_id, video, *args, priority=HIGH, **kwargs):
+        return await self.limiter.call_async(chat_id, priority, super().send_video, chat_id, video, *args, **kwargs)
+
+    async def send_photo(self, chat_id, photo, *args, priority=HIGH, **kwargs):
+        return await self.limiter.call_async(chat_id, priority, super().send_photo, chat_id, photo, *args, **kwargs)
+
+    async def send_media_group(self, chat_id, media, *args, priority=HIGH, **kwargs):
+        return await self.limiter.call_async(chat_id, priority, super().send_media_group, chat_id, media, *args, **kwargs)
+
+    async def send_chat_action(self, chat_id, action, *args, priority=LOW, **kwargs):
+        return await self.limiter.call_async(chat_id, priority, super().send_chat_action, chat_id, action, *args, **kwargs)
+
+    async def get_chat_member(self, chat_id, user_id, *args, priority=HIGH, **kwargs):
+        return await self.limiter.call_async(None, priority, super().get_chat_member, chat_id, user_id, *args, **kwargs)
+
+    async def answer_callback_query(self, callback_query_id, *args, priority=HIGH, **kwargs):
+        return await self.limiter.call_async(None, priority, super().answer_callback_query, callback_query_id, *args, **kwargs)
+
+
+abot = RateLimitedAsyncTeleBot(core.API_TOKEN)
+abot.limiter.use_shared_budget(core.job_queue)
+# В asyncio-режиме сообщения отправляет abot, поэтому в статистике его лимитер
+metrics.add_stats_source("limiter", abot.limiter.stats)
+ydl_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="yt-dlp")
+_jobs_ready = asyncio.Event()
+
+
+_membership_lookups = {}
+
+
+async def run_blocking(func, *args):
+    """
+    Запросы к SQLite (очередь, кэш, состояние чатов) выполняются в пуле потоков,
+    чтобы запись под блокировкой не останавливала цикл событий. Контекст задачи
+    (текущая задача очереди) передаётся в поток вместе с вызовом.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, context.run, func, *args)
+
+
+async def fetch_subscription(user_id):
+    member = await abot.get_chat_member(core.CHANNEL_USERNAME, user_id)
+    subscribed = member.status in ['member', 'administrator', 'creator']
+    core.membership_cache.put(user_id, subscribed)
+    return subscribed
+
+
+async def check_subscription(user_id):
+    if user_id == core.OWNER_ID:
+        return True
+    subscribed = core.membership_cache.get(user_id)
+    if subscribed is not None:
+        return subscribed
+    # Одновременные проверки одного пользователя ждут один запрос
+    lookup = _membership_lookups.get(user_id)
+    if lookup is None:
+        lookup = asyncio.ensure_future(fetch_subscription(user_id))
+        _membership_lookups[user_id] = lookup
+        lookup.add_done_callback(lambda _: _membership_lookups.pop(user_id, None))
+    else:
+        core.membership_lookups.coalesced += 1
+    try:
+        return await asyncio.shield(lookup)
+    except Exception as e:
+        logging.warning(f"Ошибка проверки подписки: {e}")
+        return False
+
+
+def subscription_guard(func):
+    async def wrapper(message_or_call, *args, **kwargs):
+        user_id = (
+            message_or_call.from_user.id
+            if hasattr(message_or_call, "from_user")
+            else message_or_call.message.chat.id
+        )
+        if user_id == core.OWNER_ID:
+            return await func(message_or_call, *args, **kwargs)
+        if not await check_subscription(user_id):
+            chat_id = (
+                message_or_call.message.chat.id
+                if hasattr(message_or_call, "message")
+                else message_or_call.chat.id
+            )
+            await abot.send_message(chat_id, core.SUBSCRIBE_TEXT, reply_markup=core.build_subscribe_keyboard())
+            return
+        return await func(message_or_call, *args, **kwargs)
+    return wrapper
+
+
+# ---------- Скачивание ----------
+
+async def send_processing_status(chat_id, post_title, status, task_id, job_id=None):
+    msg = await abot.send_message(
+        chat_id,
+        core.format_status(post_title, status, task_id),
+        parse_mode="HTML",
+        reply_markup=core.build_cancel_keyboard(job_id) if job_id else None
+    )
+    return msg.message_id
+
+
+async def update_processing_status(chat_id, message_id, post_title, status, task_id, done=False, job_id=None,
+                                   priority=HIGH):
+    await abot.edit_message_text(
+        core.format_status(post_title, status, task_id, done),
+        chat_id,
+        message_id,
+        parse_mode="HTML",
+        reply_markup=core.build_cancel_keyboard(job_id) if job_id and not done else None,
+        priority=priority
+    )
+
+
+async def update_waiters(leader_id, status):
+    # См. bot.update_waiters
+    for waiter in await run_blocking(core.job_queue.waiters, leader_id):
+        if not waiter['status_message']:
+            continue
+        try:
+            await update_processing_status(
+                waiter['chat_id'], waiter['status_message'], "Ваша задача", status, waiter['id'],
+                job_id=waiter['id'], priority=LOW
+            )
+        except ApiTelegramException as e:
+            logging.info(f"Не удалось обновить статус задачи {waiter['id']}: {e}")
+
+
+async def open_processing_status(chat_id, post_title, task_id, job_id):
+    message_id = await run_blocking(core.job_queue.status_message, job_id) if job_id else None
+    if message_id:
+        try:
+            await update_processing_status(chat_id, message_id, post_title, "Обрабатываю видео...", task_id, job_id=job_id)
+            return message_id
+        except ApiTelegramException as e:
+            logging.info(f"Не удалось обновить статус задачи {job_id}: {e}")
+    message_id = await send_processing_status(chat_id, post_title, "Обрабатываю видео...", task_id, job_id)
+    if job_id:
+        await run_blocking(core.job_queue.set_status_message, job_id, message_id)
+    return message_id
+
+
+async def send_media_batch(chat_id, batch):
+    if len(batch) == 1:
+        kind, media = batch[0]
+        if kind == 'photo':
+            return [await abot.send_photo(chat_id, media)]
+        return [await abot.send_video(chat_id, media, supports_streaming=True)]
+    return await abot.send_media_group(chat_id, [core.build_input_media(kind, media) for kind, media in batch])
+
+
+async def send_cached_media(chat_id, media):
+    for batch in core.split_media_batches(media):
+        await send_media_batch(chat_id, batch)
+
+
+async def finish_delivery(chat_id, send_post=True, job_id=None):
+    post_text = await run_blocking(core.user_store.get_post, chat_id)
+    if post_text and send_post:
+        await abot.send_message(chat_id, f"{post_text}")
+    await run_blocking(core.rewriter.prefetch, post_text, chat_id)
+    await abot.send_message(chat_id, "✅ Видео загружено!", reply_markup=core.build_rocket_keyboard(), priority=LOW)
+    await run_blocking(core.after_video_sent, chat_id, job_id)
+
+
+async def deliver_result(chat_id, status_msg_id, post_title, task_id, result, job_id=None):
+    await update_processing_status(chat_id, status_msg_id, post_title, "Готово", task_id, done=True)
+    if result['post_text']:
+        await run_blocking(core.user_store.set_post, chat_id, result['post_text'])
+    await send_cached_media(chat_id, result['media'])
+    await finish_delivery(chat_id, job_id=job_id)
+
+
+async def report_failure(chat_id, url, error, job_id=None):
+    await abot.send_message(chat_id, core.failure_message(url, error))
+    await run_blocking(core.after_video_sent, chat_id, job_id)
+
+
+async def fail_waiters(leader_id, post_key, error):
+    # Ошибка ведущей доходит до всех ожидавших один раз, пост не скачивается заново
+    reason = core.failure_reason(error)
+    for waiter in await run_blocking(core.job_queue.fail_waiters, leader_id, post_key, reason):
+        metrics.observe_job("failed", waiter['created_at'])
+        try:
+            await report_failure(waiter['chat_id'], waiter['url'],
+                                 SharedDownloadFailed(reason, getattr(error, 'post_text', "")), waiter['id'])
+        except Exception as e:
+            logging.warning(f"Не удалось сообщить об ошибке задаче {waiter['id']}: {e}")
+
+
+async def upload_media(chat_id, outputs):
+    sent_media = []
+    for batch in core.split_media_batches(outputs):
+        with ExitStack() as stack:
+            files = [[kind, stack.enter_context(open(path, 'rb'))] for kind, path in batch]
+            sent_media.extend(core.sent_file_ids(await send_media_batch(chat_id, files)))
+    return sent_media
+
+
+async def download_and_send(chat_id, url, status_msg_id, post_title, task_id, job_id, post_key=None):
+    async def on_metadata(job):
+        if job.post_text:
+            await run_blocking(core.user_store.set_post, chat_id, job.post_text)
+            await abot.send_message(chat_id, job.post_text)
+        cached = await run_blocking(core.result_cache.get, job.post_key) if job.post_key not in (None, post_key) else None
+        if cached:
+            await update_processing_status(chat_id, status_msg_id, post_title, "Готово", task_id, done=True)
+            await send_cached_media(chat_id, cached['media'])
+            return cached
+        await update_processing_status(
+            chat_id, status_msg_id, post_title, core.format_media_summary(job), task_id, job_id=job_id
+        )
+        if job_id is not None:
+            await update_waiters(job_id, f"Общая загрузка: {core.format_media_summary(job)}")
+        return None
+
+    async def upload(job):
+        await update_processing_status(chat_id, status_msg_id, post_title, "Готово", task_id, done=True)
+        return await upload_media(chat_id, job.outputs)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        job = await run_pipeline_async(url, tmpdir, upload, executor=ydl_executor, control=get_control(job_id),
+                                       on_metadata=on_metadata)
+        if job.cached:
+            return dict(job.cached, post_key=job.post_key, cached=True)
+        for mode, media_seconds, elapsed, profile in job.transcodes:
+            await run_blocking(core.job_queue.record_transcode, job_id, mode, media_seconds, elapsed, profile)
+        return {'media': job.media, 'post_text': job.post_text, 'post_key': job.post_key, 'cached': False}
+
+
+async def process_download(chat_id, url, job_id=None):
+    started = time.time()
+    try:
+        task_id = job_id if job_id is not None else int(time.time())
+        post_title = "Ваша задача"
+        status_msg_id = await open_processing_status(chat_id, post_title, task_id, job_id)
+
+        # Раскрытие короткой ссылки — запрос в сеть, ключ без ID в ссылке ищет yt-dlp
+        link = await run_blocking(resolve_link, url)
+        post_key = await run_blocking(link_key, link)
+        cached = await run_blocking(core.result_cache.get, post_key)
+        if cached:
+            await deliver_result(chat_id, status_msg_id, post_title, task_id, cached, job_id)
+            metrics.observe_job("cached", started)
+            return
+
+        # Ожидающая задача остаётся в очереди со статусом waiting, см. bot.process_download
+        shared = await run_blocking(core.job_queue.lead, job_id, post_key, core.result_cache.get) if job_id is not None else {}
+        if shared.get('cached'):
+            await deliver_result(chat_id, status_msg_id, post_title, task_id, shared['cached'], job_id)
+            metrics.observe_job("cached", started)
+            return
+        if shared.get('error'):
+            raise SharedDownloadFailed(shared['error'])
+        if shared.get('leader'):
+            await update_processing_status(
+                chat_id, status_msg_id, post_title, "Видео уже скачивается, жду результат...", task_id, job_id=job_id
+            )
+            return
+
+        try:
+            result = await download_and_send(chat_id, link.url, status_msg_id, post_title, task_id, job_id, post_key)
+            for key in {post_key, result['post_key']} - {None}:
+                await run_blocking(core.result_cache.put, key, result['media'], result['post_text'])
+        except Exception as e:
+            if job_id is not None and not isinstance(e, JobCancelled):
+                await fail_waiters(job_id, post_key, e)
+            raise
+        finally:
+            if job_id is not None:
+                await run_blocking(core.job_queue.wake_waiters, job_id)
+                _jobs_ready.set()
+        await finish_delivery(chat_id, send_post=False, job_id=job_id)
+        metrics.observe_job("cached" if result['cached'] else "downloaded", started)
+    except Exception as e:
+        metrics.observe_job(core.failure_result(e), started)
+        await report_failure(chat_id, url, e, job_id)
+        raise
+
+
+def stage_reporter(loop, job_id):
+    # Этап может начаться и в потоке yt-dlp, а запись в SQLite не должна блокировать цикл событий
+    def report(stage):
+        loop.call_soon_threadsafe(loop.run_in_executor, None, core.job_queue.set_stage, job_id, stage)
+    return report
+
+
+async def download_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        job = await loop.run_in_executor(None, core.job_queue.claim)
+        if job is None:
+            _jobs_ready.clear()
+            try:
+                await asyncio.wait_for(_jobs_ready.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        error = None
+        # Каждый обработчик — своя задача asyncio со своим контекстом
+        set_current_job(job["id"])
+        open_control(job["id"], on_stage=stage_reporter(loop, job["id"]))
+        try:
+            await process_download(job["chat_id"], job["url"], job["id"])
+        except Exception as e:
+            logging.error(f"Задача {job['id']} завершилась с ошибкой: {e}")
+            error = str(e)
+        finally:
+            close_control(job["id"])
+            set_current_job(None)
+        await loop.run_in_executor(None, core.job_queue.finish, job["id"], error, job["started_at"])
+
+
+# ---------- Обработчики ----------
+
+@abot.message_handler(commands=['start'])
+@subscription_guard
+async def send_welcome(message):
+    chat_id = message.chat.id
+    await run_blocking(core.user_store.reset, chat_id)
+
+    if os.path.exists(core.WELCOME_VIDEO_PATH):
+        try:
+            with open(core.WELCOME_VIDEO_PATH, 'rb') as video:
+                await abot.send_video(chat_id, video, supports_streaming=True)
+        except Exception as e:
+            logging.error(f"Ошибка при отправке приветственного видео: {e}")
+
+    await abot.send_chat_action(chat_id, 'typing')
+    await asyncio.sleep(0.5)
+    await abot.send_message(chat_id, core.WELCOME_TEXT)
+
+
+@abot.message_handler(commands=['menu'])
+@subscription_guard
+async def show_menu(message):
+    chat_id = message.chat.id
+    await abot.send_message(chat_id, "Главное меню:", reply_markup=core.build_menu_keyboard(chat_id))
+
+
+@abot.callback_query_handler(func=lambda call: call.data == "admin_stats")
+async def show_admin_stats(call):
+    if call.message.chat.id != core.OWNER_ID:
+        await abot.answer_callback_query(call.id, "Нет доступа")
+        return
+    stats_text = await run_blocking(core.build_stats_text)
+    await abot.send_message(call.message.chat.id, f"Статистика бота:\n{stats_text}")
+    await abot.answer_callback_query(call.id)
+
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith("cancel:"))
+async def handle_cancel(call):
+    job_id = int(call.data.split(":", 1)[1])
+    url = await run_blocking(core.job_queue.cancel_waiting, job_id, call.message.chat.id)
+    if url:
+        # Ожидающая задача ничего не качает, поэтому завершается сразу
+        await abot.answer_callback_query(call.id, "Загрузка отменена")
+        await report_failure(call.message.chat.id, url, JobCancelled(), job_id)
+    # Для задачи этого процесса request_cancel сразу убивает её ffmpeg
+    elif await run_blocking(core.job_queue.request_cancel, job_id, call.message.chat.id):
+        await abot.answer_callback_query(call.id, "Отменяю загрузку...")
+    else:
+        await abot.answer_callback_query(call.id, "Задача уже завершена")
+
+
+@abot.callback_query_handler(func=lambda call: call.data == "check_subscription")
+async def handle_check_subscription(call):
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    core.membership_cache.invalidate(user_id)
+    if user_id == core.OWNER_ID or await check_subscription(user_id):
+        await abot.answer_callback_query(call.id, "✅ Подписка подтверждена! Можете пользоваться ботом.")
+        await abot.send_message(chat_id, "Спасибо за подписку! Теперь отправьте ссылку на видео или пост.")
+        await run_blocking(core.user_store.set_state, chat_id, WAITING_FOR_LINK)
+    else:
+        await abot.answer_callback_query(call.id, "❌ Подписка не найдена.")
+        await abot.send_message(chat_id, core.SUBSCRIPTION_MISSING_TEXT, reply_markup=core.build_subscribe_keyboard())
+
+
+@abot.message_handler(commands=['donate'])
+@subscription_guard
+async def handle_donate(message):
+    for text, markup in core.build_donate_messages():
+        await abot.send_message(message.chat.id, text, reply_markup=markup)
+
+
+@abot.callback_query_handler(func=lambda call: call.data.startswith("donate_"))
+async def handle_donate_amount(call):
+    text, markup = core.build_donate_amount_message(call.data.split("_")[1])
+    await abot.send_message(call.message.chat.id, text, reply_markup=markup)
+    await abot.answer_callback_query(call.id)
+
+
+@abot.message_handler(commands=['rocket'])
+@subscription_guard
+async def handle_rocket(message):
+    await abot.send_chat_action(message.chat.id, 'typing')
+    await asyncio.sleep(0.5)
+    await abot.send_message(message.chat.id, core.ROCKET_TEXT, reply_markup=core.build_rocket_promo_keyboard(), priority=LOW)
+    await run_blocking(core.increment_message_count, message.chat.id)
+
+
+@abot.message_handler(commands=['rewrite'])
+@subscription_guard
+async def handle_rewrite_command(message):
+    chat_id = message.chat.id
+    post_text = await run_blocking(core.user_store.get_post, chat_id)
+    if not post_text or not post_text.strip():
+        await abot.send_message(chat_id, "Нет текста для рерайта. Сначала скачайте видео с описанием.")
+        return
+    await run_blocking(core.rewriter.mark_used, chat_id)
+    rewritten = await run_blocking(core.rewriter.cached, post_text)
+    if rewritten is None:
+        wait = core.rewriter.allow(message.from_user.id)
+        if wait:
+            await abot.send_message(chat_id, f"⏳ Слишком много рерайтов подряд. Попробуйте через {wait:.0f} с")
+            return
+    await abot.send_chat_action(chat_id, 'typing')
+    try:
+        if rewritten is None:
+            # Пул рерайтов общий с обычным режимом: тот же кэш и ограничение параллельности
+            rewritten = await asyncio.wrap_future(core.rewriter.submit(post_text))
+        await abot.send_message(chat_id, f"✍️ Вот рерайт поста:\n\n{rewritten}")
+    except Exception as e:
+        logging.error(f"Ошибка рерайта: {e}")
+        await abot.send_message(chat_id, "⚠️ Не удалось сделать рерайт")
+
+
+@abot.message_handler(func=lambda message: True, content_types=['text'])
+@subscription_guard
+async def handle_link(message):
+    chat_id = message.chat.id
+
+    links = extract_links(message.text, accept=lambda link: detect_platform(link.url))
+    if not links:
+        await abot.reply_to(message, "⚠️ Формат не поддерживается или ссылка не распознана.")
+        return
+
+    accepted = await run_blocking(
+        functools.partial(core.user_store.transition, chat_id, WAITING_FOR_DOWNLOAD, unless=(WAITING_FOR_DOWNLOAD,),
+                          link=links[0].url, post='')
+    )
+    if not accepted:
+        await abot.send_message(chat_id, "⏳ Подожди чуть-чуть, я ещё обрабатываю предыдущее видео...")
+        return
+
+    for link in links:
+        await run_blocking(core.job_queue.enqueue, chat_id, message.from_user.id, link.url)
+    _jobs_ready.set()
+    if len(links) > 1:
+        await abot.send_message(chat_id, f"📥 Принял ссылок: {len(links)}, пришлю всё по готовности")
+
+
+async def main():
+    metrics.start_metrics_server()
+    workers = []
+    if core.BOT_ROLE != "dispatcher":
+        core.job_queue.recover()
+        core.job_queue.register_worker("all", ASYNC_JOB_WORKERS)
+        core.job_queue.start_heartbeat()
+        workers = [asyncio.create_task(download_worker()) for _ in range(ASYNC_JOB_WORKERS)]
+    logging.info(f"asyncio-режим: обработчиков задач {len(workers)}, потоков yt-dlp {DOWNLOAD_WORKERS}")
+    await abot.infinity_polling()
+
+
+if __name__ == '__main__':
+    print("Бот запущен (asyncio)")
+    asyncio.run(main())
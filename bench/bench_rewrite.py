@@ -0,0 +1,87 @@
+"""
+Замер /rewrite против bench/fake_openai.py: много пользователей присылают
+рерайт одних и тех же вирусных постов.
+
+    python bench/bench_rewrite.py                        # 200 запросов, 10 разных текстов
+    python bench/bench_rewrite.py -n 500 --texts 50 --latency 2000 --speculative
+
+Выводит число запросов к API, пиковую параллельность на стороне «OpenAI» и
+задержку ответа пользователю (p50/p99).
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--requests', type=int, default=200, help='запросов /rewrite')
+    parser.add_argument('--texts', type=int, default=10, help='разных текстов постов')
+    parser.add_argument('--users', type=int, default=50, help='одновременных пользователей')
+    parser.add_argument('--latency', type=float, default=1000, help='задержка OpenAI, мс')
+    parser.add_argument('--speculative', action='store_true', help='сначала заранее переписать тексты, как после скачивания')
+    args = parser.parse_args()
+
+    from fake_openai import FakeOpenAI, start_fake_openai
+    fake = FakeOpenAI(args.latency / 1000)
+    api_base = start_fake_openai(fake)
+
+    import openai
+    openai.api_key = "test"
+    openai.api_base = api_base
+    from rewrite import Rewriter, RewriteCache
+
+    workdir = tempfile.mkdtemp(prefix="bench-rewrite-")
+    # Лимит на пользователя не мешает замеру пропускной способности
+    rewriter = Rewriter("Перепиши текст", cache=RewriteCache(os.path.join(workdir, "cache.sqlite3")),
+                        user_limit=args.requests, speculative=True, prefetch_limit=args.texts)
+    texts = [f"Вирусный пост номер {i}. " * 5 for i in range(args.texts)]
+
+    if args.speculative:
+        # Заранее переписываются только посты чатов, где уже вызывали /rewrite
+        rewriter.mark_used(0)
+        for text in texts:
+            # prefetch пропускает текст, если пул занят, поэтому ждём свободного места
+            while rewriter.stats()["pending"] >= rewriter.workers:
+                time.sleep(0.01)
+            rewriter.prefetch(text, 0)
+        while rewriter.stats()["pending"]:
+            time.sleep(0.05)
+
+    def request(i):
+        text = random.choice(texts)
+        started = time.time()
+        if rewriter.cached(text) is None:
+            rewriter.allow(i % args.users)
+            rewriter.submit(text).result()
+        return time.time() - started
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=args.users) as users:
+        latencies = list(users.map(request, range(args.requests)))
+    elapsed = time.time() - started
+
+    server = fake.stats()
+    print(
+        f"запросов {args.requests} за {elapsed:.1f} с, к API {server['requests']} "
+        f"(разных текстов {server['unique_texts']}), параллельно на API до {server['max_concurrent']}, "
+        f"задержка p50 {percentile(latencies, 50):.2f} с, p99 {percentile(latencies, 99):.2f} с, "
+        f"из кэша {rewriter.stats()['cache_hits']}"
+    )
+
+
+if __name__ == '__main__':
+    main()
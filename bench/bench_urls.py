@@ -0,0 +1,124 @@
+"""
+Микробенчмарк разбора ссылок: классификация платформы и ключ поста через
+urls.parse_link против перебора экстракторов yt-dlp (cache.resolve_post_key),
+разбор сообщений с несколькими ссылками и раскрытие коротких ссылок через
+локальный сервер редиректов.
+
+    python bench/bench_urls.py                       # 20000 ссылок, 500 разных
+    python bench/bench_urls.py -n 100000 --unique 5000 --latency 150
+
+Выводит микросекунды на ссылку для каждого способа и проверяет, что ключи
+parse_link совпадают с ключами yt-dlp там, где yt-dlp распознаёт пост.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TRACKING = ["?igsh=MWQ1ZGUxMzBkMA==", "?utm_source=ig_web_copy_link", "?is_from_webapp=1&sender_device=pc", "", "#comments"]
+
+
+def make_urls(unique):
+    """Ссылки на посты всех платформ в разных видах: с параметрами, без схемы, мобильные."""
+    urls = []
+    for i in range(unique):
+        shortcode = f"C{i:09d}Ab"
+        video_id = str(7200000000000000000 + i)
+        pin_id = str(100000000000 + i)
+        urls += [
+            f"https://www.instagram.com/reel/{shortcode}/{random.choice(TRACKING)}",
+            f"instagram.com/p/{shortcode}/",
+            f"https://www.tiktok.com/@user{i}/video/{video_id}{random.choice(TRACKING)}",
+            f"https://ru.pinterest.com/pin/{pin_id}/",
+        ]
+    return urls
+
+
+def timed(func, items):
+    started = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - started) / len(items) * 1e6
+
+
+def start_redirect_server(latency):
+    """Сервер коротких ссылок: /<код> отвечает 301 на страницу поста TikTok."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            time.sleep(latency)
+            code = self.path.strip('/')
+            self.send_response(301)
+            self.send_header('Location', f"https://www.tiktok.com/@user/video/{7300000000000000000 + int(code)}?_r=1")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="redirects", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--links', type=int, default=20000, help='ссылок в замере')
+    parser.add_argument('--unique', type=int, default=500, help='разных постов каждой платформы')
+    parser.add_argument('--short', type=int, default=50, help='разных коротких ссылок')
+    parser.add_argument('--latency', type=float, default=100, help='задержка сервера редиректов, мс')
+    args = parser.parse_args()
+
+    from cache import resolve_post_key
+    from pipeline import detect_platform
+    from urls import parse_link, extract_links, link_key, ShortLinkResolver
+
+    pool = make_urls(args.unique)
+    links = [random.choice(pool) for _ in range(args.links)]
+
+    # Без кэша: одна ссылка — один проход классификатора
+    ytdlp = timed(resolve_post_key.__wrapped__, links[:2000])
+    parse = timed(parse_link.__wrapped__, links)
+    parse_link.cache_clear()
+    cached = timed(parse_link, links)
+    detect = timed(detect_platform, links)
+    print(
+        f"ключ поста: yt-dlp {ytdlp:.1f} мкс/ссылку, parse_link {parse:.1f} мкс (с кэшем {cached:.2f} мкс), "
+        f"detect_platform {detect:.2f} мкс"
+    )
+
+    mismatched = 0
+    for url in pool:
+        expected = resolve_post_key.__wrapped__(url)
+        if not expected.startswith("url:") and expected != link_key(parse_link(url)):
+            mismatched += 1
+            print(f"  расхождение: {url} -> {parse_link(url).key}, yt-dlp {expected}")
+    keys = {parse_link(url).key for url in pool}
+    print(f"постов {len(keys)} из {len(pool)} ссылок (ожидалось {args.unique * 3}), расхождений с yt-dlp {mismatched}")
+
+    messages = [" и ".join(random.sample(pool, 3)) + ", глянь!" for _ in range(args.links // 10)]
+    per_message = timed(extract_links, messages)
+    print(f"сообщение с 3 ссылками: {per_message:.1f} мкс, ссылок найдено {sum(len(extract_links(m)) for m in messages)}")
+
+    base = start_redirect_server(args.latency / 1000)
+    resolver = ShortLinkResolver()
+    short = [f"{base}/{random.randrange(args.short)}" for _ in range(args.short * 10)]
+    started = time.perf_counter()
+    resolved = [resolver.resolve(url) for url in short]
+    elapsed = time.perf_counter() - started
+    stats = resolver.stats()
+    ok = sum(parse_link(url).key is not None for url in resolved)
+    print(
+        f"короткие ссылки: {len(short)} за {elapsed:.2f} с, запросов к серверу {stats['misses']}, "
+        f"из кэша {stats['hits']} ({stats['hit_rate']:.0%}), с ключом поста {ok}, ошибок {stats['failures']}"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Локальная замена OpenAI Chat Completions для проверки /rewrite без сети:
+отвечает предсказуемым «рерайтом» с заданной задержкой и считает запросы.
+
+    python bench/fake_openai.py --port 8082 --latency 1500
+    OPENAI_API_BASE=http://127.0.0.1:8082/v1 OPENAI_API_KEY=test python bot.py
+"""
+import time
+import json
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAI:
+    def __init__(self, latency=1.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.texts = Counter()
+        self.max_concurrent = 0
+        self._concurrent = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self.texts.clear()
+            self.max_concurrent = 0
+
+    def handle(self, payload):
+        """Возвращает (HTTP-статус, JSON-ответ) на запрос chat/completions."""
+        messages = payload.get('messages') or []
+        text = messages[-1].get('content', '') if messages else ''
+        with self._lock:
+            self.requests += 1
+            self.texts[text] += 1
+            self._concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self._concurrent)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self._concurrent -= 1
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return 500, {"error": {"message": "The server had an error", "type": "server_error"}}
+        return 200, {
+            "id": f"chatcmpl-{random.getrandbits(48):x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get('model', 'gpt-3.5-turbo'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": f"Рерайт: {text[:200]}"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": len(text.split()), "completion_tokens": 0, "total_tokens": len(text.split())},
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "unique_texts": len(self.texts),
+                "max_concurrent": self.max_concurrent,
+            }
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                status, payload = 404, {"error": {"message": f"Unknown path {self.path}"}}
+            else:
+                status, payload = fake.handle(json.loads(body or b'{}'))
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start_fake_openai(fake, host='127.0.0.1', port=0):
+    """Запускает сервер в фоновом потоке и возвращает значение для OPENAI_API_BASE."""
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=1500, help='задержка ответа, мс')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    args = parser.parse_args()
+    fake = FakeOpenAI(args.latency / 1000, args.error_rate)
+    print(f"OPENAI_API_BASE={start_fake_openai(fake, port=args.port)}")
+    try:
+        while True:
+            time.sleep(10)
+            print(fake.stats())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
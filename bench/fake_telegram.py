@@ -0,0 +1,179 @@
+"""
+Локальная замена Bot API для замеров: отвечает правдоподобными Message,
+записывает вызовы, добавляет задержку и с заданной вероятностью отвечает 429.
+Заодно раздаёт тестовые ролики по /clips/<имя>, чтобы yt-dlp качал их по HTTP.
+
+    python bench/fake_telegram.py --port 8081 --latency 50 --rate-429 0.02
+"""
+import os
+import time
+import json
+import random
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.05, rate_429=0.0, retry_after=1, clips_dir=None, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth  # байт/с при раздаче роликов, 0 — без ограничения
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.clips_dir = clips_dir
+        self.calls = Counter()
+        self.errors_429 = 0
+        self.uploaded_bytes = 0
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors_429 = 0
+            self.uploaded_bytes = 0
+
+    def _next_message(self, chat_id):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}}
+
+    def handle(self, method, params, body_size):
+        """Возвращает (HTTP-статус, JSON-ответ) для вызова Bot API."""
+        with self._lock:
+            self.calls[method] += 1
+            self.uploaded_bytes += body_size
+        if self.latency:
+            time.sleep(self.latency)
+        if method != 'getChatMember' and random.random() < self.rate_429:
+            with self._lock:
+                self.errors_429 += 1
+            return 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        chat_id = params.get('chat_id', '0')
+        # chat_id бывает и @username канала (getChatMember)
+        chat_id = int(chat_id) if chat_id.lstrip('-').isdigit() else chat_id
+        if method in ('sendMessage', 'editMessageText'):
+            result = dict(self._next_message(chat_id), text=params.get('text', ''))
+        elif method == 'sendVideo':
+            result = dict(self._next_message(chat_id), video=self._video())
+        elif method == 'sendPhoto':
+            result = dict(self._next_message(chat_id), photo=[self._photo()])
+        elif method == 'sendMediaGroup':
+            items = json.loads(params.get('media', '[]'))
+            result = [
+                dict(self._next_message(chat_id), **(
+                    {"photo": [self._photo()]} if item.get('type') == 'photo' else {"video": self._video()}
+                ))
+                for item in items
+            ]
+        elif method == 'getChatMember':
+            result = {"user": {"id": int(params.get('user_id', 0)), "is_bot": False, "first_name": "Bench"},
+                      "status": "member"}
+        elif method == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def _video(self):
+        file_id = f"video-{random.getrandbits(48):x}"
+        return {"file_id": file_id, "file_unique_id": file_id, "width": 720, "height": 1280, "duration": 1}
+
+    def _photo(self):
+        file_id = f"photo-{random.getrandbits(48):x}"
+        return {"file_id": file_id, "file_unique_id": file_id, "width": 1080, "height": 1080}
+
+    def stats(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "errors_429": self.errors_429, "uploaded_bytes": self.uploaded_bytes}
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, status, body, content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _serve_clip(self, name):
+            path = os.path.join(fake.clips_dir or '', os.path.basename(name))
+            if not fake.clips_dir or not os.path.isfile(path):
+                self._reply(404, b'')
+                return
+            with open(path, 'rb') as f:
+                body = f.read()
+            if not fake.bandwidth:
+                self._reply(200, body, 'video/mp4')
+                return
+            # Имитация медленной сети: отдаём кусками с паузами
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            chunk = max(1, int(fake.bandwidth / 10))
+            for start in range(0, len(body), chunk):
+                self.wfile.write(body[start:start + chunk])
+                time.sleep(0.1)
+
+        def _api(self):
+            url = urlsplit(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if url.path.startswith('/clips/'):
+                self._serve_clip(url.path[len('/clips/'):])
+                return
+            # /bot<token>/<method>; параметры telebot передаёт в строке запроса
+            method = url.path.rsplit('/', 1)[-1]
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            status, payload = fake.handle(method, params, len(body))
+            self._reply(status, json.dumps(payload).encode())
+
+        do_GET = _api
+        do_POST = _api
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def start_fake_telegram(fake, host='127.0.0.1', port=0):
+    """Запускает сервер в фоновом потоке и возвращает его базовый адрес."""
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-telegram", daemon=True).start()
+    return f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=50, help='задержка ответа, мс')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--clips', help='каталог с роликами для /clips/')
+    parser.add_argument('--bandwidth', type=float, default=0, help='скорость раздачи роликов, Мбит/с')
+    args = parser.parse_args()
+    fake = FakeTelegram(args.latency / 1000, args.rate_429, clips_dir=args.clips,
+                        bandwidth=args.bandwidth * 125000)
+    base = start_fake_telegram(fake, port=args.port)
+    print(f"Bot API: {base}/bot{{0}}/{{1}}")
+    try:
+        while True:
+            time.sleep(10)
+            print(fake.stats())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""
+Сквозной замер конвейера скачивание → перекодирование → отправка без сети.
+
+Ссылки проходят через handle_link и очередь задач как настоящие сообщения,
+Bot API заменён bench/fake_telegram.py (задержка и 429), а вместо Instagram/TikTok
+работает платформа bench: yt-dlp скачивает по HTTP ролики, заранее сгенерированные
+ffmpeg testsrc в разных разрешениях и длительностях.
+
+    python bench/run_bench.py                                  # уровни 1, 4, 8 по 24 задачи
+    python bench/run_bench.py -c 1,2,4,16 -n 48 --latency 80 --rate-429 0.05
+    python bench/run_bench.py --clips 720x1280:5,1080x1920:10
+    STREAM_MODE=1 python bench/run_bench.py --bandwidth 2      # потоковый режим на медленной сети
+    python bench/run_bench.py -c 2 --processes 1,2,4           # задачи выполняют процессы worker.py
+
+Каждый уровень параллельности выполняется в отдельном процессе, поэтому CPU и
+пиковая память считаются честно (вместе с дочерними ffmpeg).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import sqlite3
+import resource
+import signal
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_CLIPS = "720x1280:5,1080x1920:10,480x854:3,1280x720:8"
+BENCH_CHAT_BASE = 900000000
+
+
+def parse_clips(spec):
+    clips = []
+    for item in spec.split(','):
+        size, duration = item.split(':')
+        width, height = (int(x) for x in size.split('x'))
+        clips.append({"name": f"testsrc_{width}x{height}_{duration}s", "width": width,
+                      "height": height, "duration": float(duration)})
+    return clips
+
+
+def generate_clips(clips, clips_dir):
+    """Генерирует недостающие ролики H.264/AAC через ffmpeg testsrc."""
+    for clip in clips:
+        path = os.path.join(clips_dir, clip["name"] + ".mp4")
+        if os.path.exists(path):
+            continue
+        duration = clip["duration"]
+        cmd = [
+            'ffmpeg', '-y', '-v', 'error',
+            '-f', 'lavfi', '-i', f'testsrc=size={clip["width"]}x{clip["height"]}:rate=30:duration={duration}',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-shortest', '-movflags', '+faststart', path,
+        ]
+        subprocess.run(cmd, check=True)
+        print(f"сгенерирован {clip['name']}.mp4")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# ---------- Процесс одного уровня параллельности ----------
+
+def register_bench_platform(pipeline, base_url, clips):
+    by_name = {clip["name"]: clip for clip in clips}
+
+    def extract(job):
+        # https://bench.local/<ролик>/<номер>
+        name, number = job.url.rstrip('/').split('/')[-2:]
+        clip = by_name[name]
+        info = {
+            'id': f"{name}-{number}",
+            'title': f"bench {name}",
+            'description': f"Тестовый ролик {name}",
+            'extractor': 'bench',
+            'extractor_key': 'Bench',
+            'webpage_url': job.url,
+            'duration': clip["duration"],
+            'formats': [{
+                'format_id': 'mp4', 'url': f"{base_url}/clips/{name}.mp4", 'ext': 'mp4',
+                'width': clip["width"], 'height': clip["height"], 'vcodec': 'h264', 'acodec': 'aac',
+            }],
+        }
+        job.info = job.ydl.process_ie_result(info, download=False)
+        job.post_text = info['description']
+
+    return pipeline.register_platform(pipeline.Platform(
+        'bench', r'^https?://bench\.local/', ydl_opts={'format': 'best'}, extract=extract,
+    ))
+
+
+def make_update(i, url):
+    chat_id = BENCH_CHAT_BASE + i
+    return json.dumps({
+        "update_id": i + 1,
+        "message": {
+            "message_id": i + 1, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "text": url,
+        },
+    })
+
+
+def setup_bot(args):
+    import telebot
+    telebot.apihelper.API_URL = args.api + "/bot{0}/{1}"
+    import bot
+    import pipeline
+
+    clips = parse_clips(args.clips)
+    register_bench_platform(pipeline, args.api, clips)
+    bot.bot.threaded = False
+    return bot, clips
+
+
+def run_worker(args):
+    """Процесс worker.py с платформой bench; по SIGTERM печатает число ошибок."""
+    setup_bot(args)
+    import metrics
+    import worker
+    sys.argv = [worker.__file__, '--workers', str(args.concurrency)]
+    worker.main()
+    print(json.dumps({"failed": metrics.JOBS_TOTAL.value(result="failed")}))
+
+
+def start_worker_processes(args):
+    procs = []
+    for _ in range(args.processes):
+        procs.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', '-c', str(args.concurrency),
+             '--clips', args.clips, '--api', args.api],
+            stdout=subprocess.PIPE, env=dict(os.environ, PYTHONUNBUFFERED='1'),
+        ))
+    return procs
+
+
+def stop_worker_processes(procs):
+    failed = 0
+    for proc in procs:
+        proc.send_signal(signal.SIGTERM)
+    for proc in procs:
+        out, _ = proc.communicate()
+        failed += json.loads(out.decode().strip().splitlines()[-1])["failed"]
+    return failed
+
+
+def run_level(args):
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.update({
+        "TELEGRAM_API_TOKEN": "0:bench",
+        "JOBS_DB": os.path.join(workdir, "jobs.sqlite3"),
+        "CACHE_DB": os.path.join(workdir, "cache.sqlite3"),
+        "STATE_DB": os.path.join(workdir, "state.sqlite3"),
+    })
+    os.chdir(workdir)
+    bot, clips = setup_bot(args)
+    import telebot
+    import metrics
+
+    for i in range(args.jobs):
+        clip = clips[i % len(clips)]
+        update = telebot.types.Update.de_json(make_update(i, f"https://bench.local/{clip['name']}/{i}"))
+        bot.bot.process_new_updates([update])
+
+    queued = bot.job_queue.stats()["pending"]
+    if queued != args.jobs:
+        raise SystemExit(f"В очередь попало {queued} задач из {args.jobs}, см. bot.log в {workdir}")
+
+    started = time.time()
+    cpu_before = _cpu_seconds()
+    procs = []
+    if args.processes:
+        # Этот процесс остаётся диспетчером, задачи выполняют процессы worker.py
+        procs = start_worker_processes(args)
+    else:
+        bot.job_queue.start(bot.process_download, workers=args.concurrency)
+    while True:
+        queue = bot.job_queue.stats()
+        if queue["done"] + queue["failed"] >= args.jobs:
+            break
+        time.sleep(0.1)
+    elapsed = time.time() - started
+    failed = stop_worker_processes(procs) if procs else metrics.JOBS_TOTAL.value(result="failed")
+    cpu = _cpu_seconds() - cpu_before
+
+    with sqlite3.connect(os.environ["JOBS_DB"]) as conn:
+        rows = conn.execute(
+            "SELECT finished_at - created_at FROM jobs WHERE finished_at IS NOT NULL"
+        ).fetchall()
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(json.dumps({
+        "concurrency": args.concurrency,
+        "processes": args.processes,
+        "jobs": len(rows),
+        "failed": failed,
+        "elapsed": elapsed,
+        "latencies": [r[0] for r in rows],
+        "cpu": cpu,
+        "rss_kb": self_rss,
+        "ffmpeg_rss_kb": children_rss,
+    }))
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+# ---------- Управляющий процесс ----------
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--concurrency', default="1,4,8", help='уровни DOWNLOAD_WORKERS через запятую')
+    parser.add_argument('-n', '--jobs', type=int, default=24, help='задач на уровень')
+    parser.add_argument('--clips', default=DEFAULT_CLIPS, help='ШxВ:секунды через запятую')
+    parser.add_argument('--clips-dir', default=os.path.join(tempfile.gettempdir(), 'bench-clips'))
+    parser.add_argument('--latency', type=float, default=50, help='задержка Bot API, мс')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--bandwidth', type=float, default=0, help='скорость скачивания роликов, Мбит/с (0 — без ограничения)')
+    parser.add_argument('--processes', default="0",
+                        help='процессов worker.py через запятую (0 — задачи выполняет сам процесс уровня)')
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    parser.add_argument('--level', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--api', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.level or args.worker:
+        args.concurrency = int(args.concurrency)
+        args.processes = int(args.processes)
+        run_worker(args) if args.worker else run_level(args)
+        return
+
+    from fake_telegram import FakeTelegram, start_fake_telegram
+
+    os.makedirs(args.clips_dir, exist_ok=True)
+    generate_clips(parse_clips(args.clips), args.clips_dir)
+    fake = FakeTelegram(args.latency / 1000, args.rate_429, clips_dir=args.clips_dir,
+                        bandwidth=args.bandwidth * 125000)
+    api = start_fake_telegram(fake)
+
+    results = []
+    levels = [(int(c), int(p)) for p in args.processes.split(',') for c in args.concurrency.split(',')]
+    for level, processes in levels:
+        fake.reset()
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--level', '-c', str(level), '-n', str(args.jobs),
+             '--clips', args.clips, '--api', api, '--processes', str(processes)],
+            stdout=subprocess.PIPE, check=True, env=dict(os.environ, PYTHONUNBUFFERED='1'),
+        )
+        result = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+        result["telegram"] = fake.stats()
+        results.append(result)
+        if not args.json:
+            print_result(result)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+def print_result(r):
+    latencies = r["latencies"] or [0.0]
+    calls = sum(r["telegram"]["calls"].values())
+    workers = f", процессов worker.py {r['processes']}" if r['processes'] else ""
+    print(
+        f"параллельно {r['concurrency']:>3}{workers}: {r['jobs'] / r['elapsed']:.2f} задач/с, "
+        f"задержка p50 {percentile(latencies, 50):.1f} с, p99 {percentile(latencies, 99):.1f} с, "
+        f"CPU {r['cpu'] / max(r['jobs'], 1):.2f} с/задачу, "
+        f"RSS {r['rss_kb'] / 1024:.0f} МБ (ffmpeg {r['ffmpeg_rss_kb'] / 1024:.0f} МБ), "
+        f"ошибок {r['failed']}, вызовов API {calls}, 429: {r['telegram']['errors_429']}"
+    )
+
+
+if __name__ == '__main__':
+    main()
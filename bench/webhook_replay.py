@@ -0,0 +1,111 @@
+"""
+Нагрузочная проверка webhook: отправляет записанные Update JSON и измеряет
+время подтверждения.
+
+    python bench/webhook_replay.py                      # в процессе, через Flask test client
+    python bench/webhook_replay.py --url http://127.0.0.1:8080/webhook -c 32
+
+В режиме без --url обработчики очереди не запускаются (WEBHOOK_START_WORKERS=0),
+а очередь пишется во временный файл, так что замер не трогает Telegram.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_UPDATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'updates.jsonl')
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def make_local_sender(secret):
+    os.environ.setdefault("WEBHOOK_START_WORKERS", "0")
+    os.environ.setdefault("JOBS_DB", os.path.join(tempfile.mkdtemp(), "jobs.sqlite3"))
+    os.environ.setdefault("TELEGRAM_API_TOKEN", "0:bench")
+    import webhook
+    client = webhook.app.test_client()
+
+    def send(payload):
+        resp = client.post(webhook.WEBHOOK_PATH, data=payload, headers={
+            'X-Telegram-Bot-Api-Secret-Token': secret, 'Content-Type': 'application/json'})
+        return resp.status_code
+    # test client Flask не потокобезопасен для параллельной отправки
+    return send, 1
+
+
+def make_http_sender(url, secret, concurrency):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    def send(payload):
+        resp = session.post(url, data=payload.encode('utf-8'), headers={
+            'X-Telegram-Bot-Api-Secret-Token': secret, 'Content-Type': 'application/json'}, timeout=10)
+        return resp.status_code
+    return send, concurrency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', default=DEFAULT_UPDATES, help='файл с Update JSON, по одному на строку')
+    parser.add_argument('--url', help='адрес webhook; без него — в процессе')
+    parser.add_argument('--secret', default=os.getenv("WEBHOOK_SECRET", "bench"))
+    parser.add_argument('-n', '--requests', type=int, default=1000)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates)
+    if args.url:
+        send, concurrency = make_http_sender(args.url, args.secret, args.concurrency)
+    else:
+        os.environ.setdefault("WEBHOOK_SECRET", args.secret)
+        send, concurrency = make_local_sender(args.secret)
+
+    payloads = []
+    for i in range(args.requests):
+        update = json.loads(updates[i % len(updates)])
+        update['update_id'] = update['update_id'] + i
+        payloads.append(json.dumps(update, ensure_ascii=False))
+
+    latencies = []
+    errors = 0
+
+    def timed_send(payload):
+        started = time.perf_counter()
+        status = send(payload)
+        return time.perf_counter() - started, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency, status in pool.map(timed_send, payloads):
+            latencies.append(latency)
+            if status != 200:
+                errors += 1
+    total = time.perf_counter() - started
+
+    print(f"запросов: {len(latencies)}, ошибок: {errors}, параллельно: {concurrency}")
+    print(f"пропускная способность: {len(latencies) / total:.0f} запросов/с")
+    print(f"задержка: p50 {percentile(latencies, 50) * 1000:.1f} мс, "
+          f"p99 {percentile(latencies, 99) * 1000:.1f} мс, "
+          f"среднее {statistics.mean(latencies) * 1000:.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,22 @@
-import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-import yt_dlp
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo
+from telebot.apihelper import ApiTelegramException
 import tempfile
 import os
-import re
-import subprocess
 import time
 import openai
-import threading
 import logging
+from contextlib import ExitStack
 from dotenv import load_dotenv
+from jobs import JobQueue, JobCancelled, JobTimeout, SharedDownloadFailed, current_job_id, current_control
+from cache import ResultCache, MembershipCache
+from singleflight import SingleFlight
+from pipeline import run_pipeline, detect_platform, MediaLimitExceeded, job_entries, media_duration
+from ratelimit import RateLimitedTeleBot, HIGH, LOW
+from state import open_state_store, WAITING_FOR_LINK, WAITING_FOR_DOWNLOAD
+import metrics
+import encode
+from rewrite import Rewriter
+from urls import extract_links, resolve_link, link_key, resolver
 
 load_dotenv()
 
@@ -19,29 +26,82 @@ OWNER_ID = int(os.getenv("OWNER_ID", "2101512357"))
 CHANNEL_USERNAME = os.getenv("CHANNEL_USERNAME", "@staritsin_school")
 CHANNEL_URL = "https://t.me/staritsin_school"
 ROCKET_URL = "https://t.me/rocketcontentbot"
+# all — принимать обновления и выполнять задачи в одном процессе;
+# dispatcher — только принимать обновления и ставить задачи, выполняют их процессы worker.py
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
 
-bot = telebot.TeleBot(API_TOKEN)
+bot = RateLimitedTeleBot(API_TOKEN)
 openai.api_key = OPENAI_API_KEY
+# Совместимый с OpenAI сервер, например bench/fake_openai.py для проверки без сети
+openai.api_base = os.getenv("OPENAI_API_BASE", openai.api_base)
 
 logging.basicConfig(filename='bot.log', level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
-PLATFORM_PATTERNS = {
-    'instagram': r'(https?://)?(www\.)?(instagram\.com|instagr\.am)/',
-    'tiktok': r'(https?://)?(www\.)?tiktok\.com/',
-    'pinterest': r'(https?://)?(www\.)?pinterest\.',
-}
-
-user_links = {}
-user_posts = {}
-user_state = {}
-user_message_count = {}
+# Состояние чатов: ожидаемое действие, ссылка в работе, текст поста, счётчик сообщений
+user_store = open_state_store()
+
+job_queue = JobQueue()
+# Лимит Telegram на бота один на все процессы: диспетчер и воркеры берут токены из очереди
+bot.limiter.use_shared_budget(job_queue)
+result_cache = ResultCache()
+# Пресет и потоки ffmpeg подбираются по длине очереди
+encode.controller.backlog = job_queue.pending_count
+# ENCODE_THREADS — бюджет машины, воркеры на ней делят его поровну
+encode.controller.peers = job_queue.local_workers
+membership_cache = MembershipCache()
+membership_lookups = SingleFlight()
+
+metrics.Gauge("bot_queue_pending", "Задач ожидает в очереди", lambda: job_queue.stats()["pending"])
+metrics.Gauge("bot_queue_running", "Задач в работе", lambda: job_queue.stats()["running"])
+metrics.Gauge("bot_updates_pending", "Необработанных обновлений webhook", lambda: job_queue.stats()["updates"])
+metrics.Gauge("bot_workers_alive", "Живых процессов, разбирающих очередь", lambda: len(job_queue.workers()))
+metrics.Gauge("bot_inflight_downloads", "Уникальных загрузок в процессе", lambda: job_queue.stats()["leading"])
+metrics.Gauge("bot_queue_waiting", "Задач ждёт общей загрузки поста", lambda: job_queue.stats()["waiting"])
+metrics.Gauge("bot_encode_threads", "Занято потоков libx264", lambda: encode.controller.threads_in_use)
+
+SUBSCRIBE_TEXT = "❗ Чтобы пользоваться ботом, подпишитесь на канал @staritsin_school"
+SUBSCRIPTION_MISSING_TEXT = "❗ Я не вижу вашу подписку. Проверьте, что вы подписаны на канал @staritsin_school и попробуйте снова."
+WELCOME_TEXT = (
+    "👋 Привет! Отправь мне ссылку на видео 🎥\n"
+    "Я помогу скачать видео и посты из Instagram, TikTok, Pinterest.\n\n"
+    "⚡ Поддерживаются только вертикальные видео (9:16, 720x1280)."
+)
+# ⚡ Используем уже готовое видео с правильным размером (720x1280)
+WELCOME_VIDEO_PATH = 'welcome_ready.mp4'  # заранее подготовленный файл
+# Больше 10 элементов sendMediaGroup не принимает
+MEDIA_GROUP_SIZE = 10
+REWRITE_PROMPT = "Ты профессиональный копирайтер. Перепиши текст поста, сохранив смысл, но сделай его коротким, цепляющим и эмоциональным для соцсетей на русском языке."
+
+# /rewrite выполняется в своём пуле и кэшируется по тексту поста
+rewriter = Rewriter(REWRITE_PROMPT)
+rewriter.use_shared_budget(job_queue)
+metrics.Gauge("bot_rewrites_pending", "Рерайтов в очереди", lambda: rewriter.stats()["pending"])
+
+# Счётчики в памяти процесса: воркеры публикуют их в очередь, /stats складывает по всем процессам
+metrics.add_stats_source("cache", lambda: {"hits": result_cache.hits, "misses": result_cache.misses})
+metrics.add_stats_source("membership", lambda: dict(membership_cache.stats(), coalesced=membership_lookups.coalesced))
+metrics.add_stats_source("limiter", bot.limiter.stats)
+metrics.add_stats_source("rewrites", rewriter.stats)
+metrics.add_stats_source("short_links", resolver.stats)
+# Бюджет потоков учитывается только у процессов, которые сами выполняют задачи
+metrics.add_stats_source("encode", lambda: {"threads_in_use": encode.controller.threads_in_use,
+                                            "budget": encode.controller.local_budget() if job_queue.role else 0})
+
+def fetch_subscription(user_id):
+    member = bot.get_chat_member(CHANNEL_USERNAME, user_id)
+    subscribed = member.status in ['member', 'administrator', 'creator']
+    membership_cache.put(user_id, subscribed)
+    return subscribed
 
 def check_subscription(user_id):
     if user_id == OWNER_ID:
         return True
+    subscribed = membership_cache.get(user_id)
+    if subscribed is not None:
+        return subscribed
     try:
-        member = bot.get_chat_member(CHANNEL_USERNAME, user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        # Одновременные проверки одного пользователя делают один запрос get_chat_member
+        return membership_lookups.do(user_id, lambda: fetch_subscription(user_id))
     except Exception as e:
         logging.warning(f"Ошибка проверки подписки: {e}")
         return False
@@ -69,26 +129,130 @@ def subscription_guard(func):
             )
             bot.send_message(
                 chat_id,
-                "❗ Чтобы пользоваться ботом, подпишитесь на канал @staritsin_school",
+                SUBSCRIBE_TEXT,
                 reply_markup=build_subscribe_keyboard()
             )
             return
         return func(message_or_call, *args, **kwargs)
     return wrapper
 
-def detect_platform(url):
-    for platform, pattern in PLATFORM_PATTERNS.items():
-        if re.search(pattern, url):
-            logging.info(f"Платформа: {platform}")
-            return platform
-    logging.info("Платформа: не определена")
-    return None
-
 def build_rocket_keyboard():
     markup = InlineKeyboardMarkup()
     markup.add(InlineKeyboardButton("🚀 Ещё больше автоматизации тут", url=ROCKET_URL))
     return markup
 
+def build_cancel_keyboard(job_id):
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("❌ Отменить", callback_data=f"cancel:{job_id}"))
+    return markup
+
+def build_menu_keyboard(chat_id):
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("🚀 Ещё больше автоматизации тут", url=ROCKET_URL))
+    if chat_id == OWNER_ID:
+        markup.add(InlineKeyboardButton("Статистика", callback_data="admin_stats"))
+    return markup
+
+ROCKET_TEXT = "🚀 Для ещё большей автоматизации переходите в @rocketcontentbot"
+
+def build_rocket_promo_keyboard():
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton("🚀 Ещё больше автоматизации", url=ROCKET_URL))
+    return markup
+
+def build_donate_messages():
+    """Сообщения /donate в виде списка (текст, клавиатура)."""
+    # Сообщение с основными способами оплаты
+    markup_main = InlineKeyboardMarkup(row_width=1)
+    markup_main.add(
+        InlineKeyboardButton("T-Pay / СБП / РФ карта", url="https://pay.cloudtips.ru/p/2a436b20"),
+        InlineKeyboardButton("Telegram Stars / Любая карта", url="https://t.me/your_stars_link"),
+        InlineKeyboardButton("Crypto", url="https://t.me/your_crypto_link")
+    )
+
+    # Сообщение с выбором суммы
+    markup_sum = InlineKeyboardMarkup(row_width=3)
+    markup_sum.add(
+        InlineKeyboardButton("⭐ 10", callback_data="donate_10"),
+        InlineKeyboardButton("⭐ 50", callback_data="donate_50"),
+        InlineKeyboardButton("⭐ 100", callback_data="donate_100"),
+        InlineKeyboardButton("⭐ 200", callback_data="donate_200"),
+        InlineKeyboardButton("⭐ 500", callback_data="donate_500"),
+        InlineKeyboardButton("⭐ 1000", callback_data="donate_1000"),
+        InlineKeyboardButton("⭐ 10000", callback_data="donate_10000")
+    )
+
+    # Сообщение с быстрым донатом
+    markup_pay = InlineKeyboardMarkup()
+    markup_pay.add(InlineKeyboardButton("Заплатить ⭐ 50", url="https://pay.cloudtips.ru/p/2a436b20?amount=50"))
+
+    return [
+        ("Если вам нравятся наши продукты автоматизации, и вы цените, что мы для вас стараемся — будем рады вашей поддержке в виде доната 💙", markup_main),
+        ("Какая сумма заставит нас танцевать от счастья прямо сейчас?", markup_sum),
+        ("🍩 В качестве благодарности!!! Просто возьми мои деньги!!!", markup_pay),
+    ]
+
+def build_donate_amount_message(amount):
+    pay_url = f"https://pay.cloudtips.ru/p/2a436b20?amount={amount}"
+    markup = InlineKeyboardMarkup()
+    markup.add(InlineKeyboardButton(f"Заплатить ⭐ {amount}", url=pay_url))
+    return f"Спасибо за поддержку! Для оплаты {amount} рублей нажмите кнопку ниже 👇", markup
+
+def format_latency(total, histogram, **labels):
+    p50, p95 = total.quantile(histogram, 0.5, **labels), total.quantile(histogram, 0.95, **labels)
+    if p50 is None:
+        return "нет данных"
+    return f"p50 {p50:.1f} с, p95 {p95:.1f} с"
+
+def format_workers(workers):
+    if not workers:
+        return "нет живых воркеров"
+    return ", ".join(f"{worker_id} {info['running']}/{info['capacity']}" for worker_id, info in workers.items())
+
+def build_stats_text():
+    queue = job_queue.stats()
+    workers = job_queue.workers()
+    transcode = job_queue.transcode_stats()
+    # Счётчики этого процесса и снимки живых воркеров
+    total = metrics.aggregate(job_queue.peer_stats())
+    cache = dict(total.source("cache"), size=result_cache.stats()["size"])
+    membership = total.source("membership")
+    limiter = total.source("limiter")
+    rewrites = total.source("rewrites")
+    short_links = total.source("short_links")
+    threads = total.source("encode")
+    users = user_store.stats()
+    stats = (
+        f"👤 Пользователей: {users['users']}\n"
+        f"📥 Ссылок в очереди: {users['links']}\n"
+        f"📝 Постов: {users['posts']}\n"
+        f"🗂️ Всего сообщений: {users['messages']}\n"
+        f"⏳ Задач ожидает: {queue['pending']}, в работе: {queue['running']}, уникальных загрузок: {queue['leading']}, "
+        f"ждут общей загрузки: {queue['waiting']}\n"
+        f"✔️ Выполнено: {queue['done']}, с ошибкой: {queue['failed']}\n"
+        f"🖥️ Воркеры ({len(workers)}): {format_workers(workers)}\n"
+        f"🔄 Этапы задач в работе: {', '.join(f'{stage} {count}' for stage, count in queue['stages'].items()) or 'нет'}\n"
+        f"⌛ Ожидание: макс. {queue['max_wait']:.0f} с, среднее за час {queue['avg_wait']:.1f} с\n"
+        f"🎞️ Перекодирование: {transcode['summary']}, сэкономлено ~{transcode['saved_seconds']:.0f} с CPU\n"
+        f"⚙️ Пресеты: {transcode['presets'] or 'нет данных'}, потоков занято {threads['threads_in_use']}"
+        f" из {threads['budget']}\n"
+        f"🔗 Короткие ссылки: раскрыто {short_links['resolved']}, из кэша {short_links['hits']}, "
+        f"ошибок {short_links['failures']}\n"
+        f"💾 Кэш: {cache['size']} постов, попаданий {cache['hits']}, промахов {cache['misses']} ({cache['hit_rate']:.0%})\n"
+        f"🔐 Проверки подписки: попаданий в кэш {membership['hits']}, промахов {membership['misses']} "
+        f"({membership['hit_rate']:.0%}), объединено {membership['coalesced']}\n"
+        f"🚦 Telegram API: ожиданий лимита {limiter['throttled']}, повторов после 429 {limiter['retries']}\n"
+        f"✍️ Рерайты: запросов к OpenAI {rewrites['api_calls']}, из кэша {rewrites['cache_hits']}, "
+        f"заранее {rewrites['prefetched']}, отказов по лимиту {rewrites['limited']}\n"
+        f"⌛ Ожидание в очереди: {format_latency(total, metrics.JOB_WAIT_SECONDS)}\n"
+        f"⏱️ Скачивание целиком: {format_latency(total, metrics.JOB_SECONDS, result='downloaded')}\n"
+        + "".join(
+            f"   {stage}: {format_latency(total, metrics.STAGE_SECONDS, stage=stage)}\n"
+            for stage in ("extract", "download", "probe", "transcode", "upload")
+        )
+    )
+    return stats.rstrip()
+
 def cleanup_files(files):
     for f in files:
         try:
@@ -96,303 +260,328 @@ def cleanup_files(files):
         except Exception:
             pass
 
-def send_processing_status(chat_id, post_title, status, task_id):
-    msg = bot.send_message(
-        chat_id,
+def format_status(post_title, status, task_id, done=False):
+    prefix = "✅ <b>Задача успешно выполнена!</b>" if done else "⏳ <b>Обработка вашего Reels</b>"
+    return (
         f"<b>Контент машина</b>\n{post_title}\n\n"
-        f"⏳ <b>Обработка вашего Reels</b>\n"
+        f"{prefix}\n"
         f"🆔 <b>ID задачи:</b> {task_id}\n"
-        f"✍️ <b>Статус:</b> {status}",
-        parse_mode="HTML"
+        f"✍️ <b>Статус:</b> {status}"
+    )
+
+def send_processing_status(chat_id, post_title, status, task_id, job_id=None):
+    msg = bot.send_message(
+        chat_id,
+        format_status(post_title, status, task_id),
+        parse_mode="HTML",
+        reply_markup=build_cancel_keyboard(job_id) if job_id else None
     )
     return msg.message_id
 
-def update_processing_status(chat_id, message_id, post_title, status, task_id, done=False):
-    prefix = "✅ <b>Задача успешно выполнена!</b>" if done else "⏳ <b>Обработка вашего Reels</b>"
+def update_processing_status(chat_id, message_id, post_title, status, task_id, done=False, job_id=None, priority=HIGH):
+    # Кнопка отмены остаётся, пока задача выполняется
     bot.edit_message_text(
-        f"<b>Контент машина</b>\n{post_title}\n\n"
-        f"{prefix}\n"
-        f"🆔 <b>ID задачи:</b> {task_id}\n"
-        f"✍️ <b>Статус:</b> {status}",
+        format_status(post_title, status, task_id, done),
         chat_id,
         message_id,
-        parse_mode="HTML"
+        parse_mode="HTML",
+        reply_markup=build_cancel_keyboard(job_id) if job_id and not done else None,
+        priority=priority
     )
 
-def ensure_mp4(filename):
-    new_filename = os.path.splitext(filename)[0] + '.mp4'
-    ffmpeg_cmd = [
-        'ffmpeg', '-y', '-i', filename,
-        '-vf', (
-            'scale=w=720:h=1280:force_original_aspect_ratio=decrease,'
-            'pad=720:1280:(ow-iw)/2:(oh-ih)/2:color=black'
-        ),
-        '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
-        '-c:a', 'aac', '-b:a', '128k',
-        '-movflags', '+faststart',
-        new_filename
-    ]
-    subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return new_filename
+def update_waiters(leader_id, status):
+    # Задачи, ждущие общей загрузки, видят её ход в своих сообщениях о статусе
+    for waiter in job_queue.waiters(leader_id):
+        if not waiter['status_message']:
+            continue
+        try:
+            update_processing_status(
+                waiter['chat_id'], waiter['status_message'], "Ваша задача", status, waiter['id'],
+                job_id=waiter['id'], priority=LOW
+            )
+        except ApiTelegramException as e:
+            logging.info(f"Не удалось обновить статус задачи {waiter['id']}: {e}")
 
-def after_video_sent(chat_id):
-    user_links.pop(chat_id, None)
-    user_posts.pop(chat_id, None)
-    user_state[chat_id] = 'WAITING_FOR_LINK'
+def after_video_sent(chat_id, job_id=None):
+    # Пока не готовы остальные ссылки из того же сообщения, новые не принимаем.
+    # job_id передаётся явно: доставка может выполняться не в потоке своей задачи
+    if job_id is not None and not job_queue.chat_done(chat_id, job_id):
+        return
+    # Текст поста остаётся для /rewrite до следующей ссылки
+    user_store.transition(chat_id, WAITING_FOR_LINK, link=None)
 
 def increment_message_count(chat_id):
-    user_message_count[chat_id] = user_message_count.get(chat_id, 0) + 1
+    user_store.increment_messages(chat_id)
 
-def process_download(chat_id, url):
-    try:
-        task_id = int(time.time())
-        post_title = "Ваша задача"
-        status_msg_id = send_processing_status(chat_id, post_title, "Обрабатываю видео...", task_id)
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            platform = detect_platform(url)
-            media_files = []
-            post_text = ""
-
-            if platform == 'instagram':
-                media_files, post_text = download_instagram_content(url, tmpdir)
-                user_posts[chat_id] = post_text
-            elif platform == 'pinterest':
-                file = download_pinterest_video(url, os.path.join(tmpdir, 'video.mp4'))
-                if file and os.path.exists(file):
-                    media_files.append(file)
-            elif platform == 'tiktok':
-                media_files, post_text = download_tiktok_video(url, tmpdir)
-                user_posts[chat_id] = post_text
+def split_media_batches(media):
+    return [media[i:i + MEDIA_GROUP_SIZE] for i in range(0, len(media), MEDIA_GROUP_SIZE)]
 
-            update_processing_status(chat_id, status_msg_id, post_title, "Готово", task_id, done=True)
+def build_input_media(kind, media):
+    if kind == 'photo':
+        return InputMediaPhoto(media)
+    return InputMediaVideo(media, supports_streaming=True)
 
-            if len(media_files) > 1:
-                for f in media_files:
-                    with open(f, 'rb') as file_obj:
-                        bot.send_video(chat_id, file_obj, supports_streaming=True)
-                        time.sleep(1)
-            elif len(media_files) == 1:
-                with open(media_files[0], 'rb') as f:
-                    bot.send_video(chat_id, f, supports_streaming=True)
-            else:
-                raise Exception("No media files found")
+def sent_file_ids(messages):
+    # У фото берём самый большой размер
+    return [
+        ['photo', msg.photo[-1].file_id] if msg.photo else ['video', msg.video.file_id]
+        for msg in messages
+    ]
 
-            if user_posts.get(chat_id):
-                bot.send_message(chat_id, f"{user_posts[chat_id]}")
+def send_media_batch(chat_id, batch):
+    # Один элемент отправляем обычным сообщением: группа должна быть из 2–10
+    if len(batch) == 1:
+        kind, media = batch[0]
+        if kind == 'photo':
+            return [bot.send_photo(chat_id, media)]
+        return [bot.send_video(chat_id, media, supports_streaming=True)]
+    return bot.send_media_group(chat_id, [build_input_media(kind, media) for kind, media in batch])
+
+def send_cached_media(chat_id, media):
+    for batch in split_media_batches(media):
+        send_media_batch(chat_id, batch)
+
+def finish_delivery(chat_id, send_post=True, job_id=None):
+    post_text = user_store.get_post(chat_id)
+    # После скачивания подпись уже отправлена по метаданным, до видео
+    if post_text and send_post:
+        bot.send_message(chat_id, f"{post_text}")
+    rewriter.prefetch(post_text, chat_id)
 
-            bot.send_message(
-                chat_id,
-                "✅ Видео загружено!",
-                reply_markup=build_rocket_keyboard()
-            )
-            cleanup_files(media_files)
-            after_video_sent(chat_id)
-    except Exception as e:
-        logging.error(f"Ошибка при скачивании/отправке: {e}")
-        post_text = user_posts.get(chat_id, "")
-        bot.send_message(chat_id, f"⚠️ Не удалось скачать видео. Вот ссылка: {url}\n{post_text}")
-        after_video_sent(chat_id)
+    bot.send_message(
+        chat_id,
+        "✅ Видео загружено!",
+        reply_markup=build_rocket_keyboard(),
+        priority=LOW
+    )
+    after_video_sent(chat_id, job_id)
+
+def deliver_result(chat_id, status_msg_id, post_title, task_id, result, job_id=None):
+    # Отправка уже загруженного в Telegram результата (кэш или общий результат)
+    update_processing_status(chat_id, status_msg_id, post_title, "Готово", task_id, done=True)
+    if result['post_text']:
+        user_store.set_post(chat_id, result['post_text'])
+    send_cached_media(chat_id, result['media'])
+    finish_delivery(chat_id, job_id=job_id)
+
+def failure_result(error):
+    if isinstance(error, JobCancelled):
+        return "cancelled"
+    if isinstance(error, JobTimeout):
+        return "timeout"
+    return "failed"
+
+def failure_reason(error):
+    if isinstance(error, SharedDownloadFailed):
+        # Причина уже посчитана для задачи, которая скачивала пост
+        return str(error)
+    if isinstance(error, MediaLimitExceeded):
+        return f"⚠️ {error}"
+    if isinstance(error, JobTimeout):
+        return "⚠️ Видео обрабатывалось слишком долго"
+    return "⚠️ Не удалось скачать видео"
+
+def failure_message(url, error):
+    if isinstance(error, JobCancelled):
+        logging.info(f"Загрузка {url} отменена пользователем")
+        return "❌ Загрузка отменена"
+    logging.error(f"Ошибка при скачивании/отправке: {error}")
+    message = f"{failure_reason(error)}. Вот ссылка: {url}"
+    # Обычно подпись уже отправил on_metadata; если отказ случился раньше, она приходит с ошибкой
+    post_text = getattr(error, 'post_text', "")
+    return f"{message}\n{post_text}" if post_text else message
+
+def report_failure(chat_id, url, error, job_id=None):
+    bot.send_message(chat_id, failure_message(url, error))
+    after_video_sent(chat_id, job_id)
+
+def fail_waiters(leader_id, post_key, error):
+    # Ошибка ведущей доходит до всех ожидавших один раз, пост не скачивается заново
+    reason = failure_reason(error)
+    for waiter in job_queue.fail_waiters(leader_id, post_key, reason):
+        metrics.observe_job("failed", waiter['created_at'])
+        try:
+            report_failure(waiter['chat_id'], waiter['url'],
+                           SharedDownloadFailed(reason, getattr(error, 'post_text', "")), waiter['id'])
+        except Exception as e:
+            logging.warning(f"Не удалось сообщить об ошибке задаче {waiter['id']}: {e}")
 
-def download_tiktok_video(url, tmpdir):
-    """
-    Скачивает видео из TikTok по ссылке url.
-    Возвращает (media_files, post_text).
-    """
-    import yt_dlp
-    import os
-    import subprocess
-
-    ydl_opts = {
-        'outtmpl': os.path.join(tmpdir, '%(title)s.%(ext)s'),
-        'quiet': True,
-        'merge_output_format': 'mp4',
-        'format': (
-            'bestvideo[ext=mp4][height<=1280][width<=720][vcodec!*=none]+'
-            'bestaudio[ext=m4a]/best[ext=mp4][height<=1280][width<=720][vcodec!*=none]/best'
-        ),
-        'postprocessors': [],
-        'http_headers': {'User-Agent': 'Mozilla/5.0'},
-        'allow_unplayable_formats': False,
-        'prefer_ffmpeg': True,
-    }
-
-    media_files = []
-    post_text = ""
+def open_processing_status(chat_id, post_title, task_id, job_id):
+    # Повтор задачи (после ожидания общей загрузки или сбоя) правит прежнее сообщение
+    message_id = job_queue.status_message(job_id) if job_id else None
+    if message_id:
+        try:
+            update_processing_status(chat_id, message_id, post_title, "Обрабатываю видео...", task_id, job_id=job_id)
+            return message_id
+        except ApiTelegramException as e:
+            logging.info(f"Не удалось обновить статус задачи {job_id}: {e}")
+    message_id = send_processing_status(chat_id, post_title, "Обрабатываю видео...", task_id, job_id)
+    if job_id:
+        job_queue.set_status_message(job_id, message_id)
+    return message_id
+
+def process_download(chat_id, url):
+    started = time.time()
+    job_id = current_job_id()
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            post_text = info.get('description') or info.get('title') or ""
-            filename = ydl.prepare_filename(info)
-            new_filename = os.path.splitext(filename)[0] + '.mp4'
-            subprocess.run([
-                'ffmpeg', '-y', '-i', filename,
-                '-vf', 'scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2:color=black',
-                '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
-                '-c:a', 'aac', '-b:a', '128k',
-                '-movflags', '+faststart',
-                new_filename
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if os.path.exists(new_filename) and os.path.getsize(new_filename) > 0:
-                media_files.append(new_filename)
-    except Exception as e:
-        print(f"Ошибка скачивания TikTok: {e}")
-    return media_files, post_text
+        # ID задачи очереди не меняется при повторах, его же видят ожидающие
+        task_id = job_id if job_id is not None else int(time.time())
+        post_title = "Ваша задача"
+        status_msg_id = open_processing_status(chat_id, post_title, task_id, job_id)
+
+        # Короткая ссылка раскрывается здесь, в воркере: это запрос в сеть
+        link = resolve_link(url)
+        post_key = link_key(link)
+        cached = result_cache.get(post_key)
+        if cached:
+            deliver_result(chat_id, status_msg_id, post_title, task_id, cached, job_id)
+            metrics.observe_job("cached", started)
+            return
 
-def download_instagram_content(url, tmpdir):
+        shared = job_queue.lead(job_id, post_key, result_cache.get) if job_id is not None else {}
+        if shared.get('cached'):
+            deliver_result(chat_id, status_msg_id, post_title, task_id, shared['cached'], job_id)
+            metrics.observe_job("cached", started)
+            return
+        if shared.get('error'):
+            raise SharedDownloadFailed(shared['error'])
+        if shared.get('leader'):
+            # Этот пост уже скачивает другая задача. Эта ждёт в очереди (статус waiting):
+            # после успеха ведущей возьмёт результат из кэша, после ошибки получит ту же
+            # ошибку, а если ведущую отменили или её процесс упал — скачает сама
+            update_processing_status(
+                chat_id, status_msg_id, post_title, "Видео уже скачивается, жду результат...", task_id, job_id=job_id
+            )
+            return
+
+        try:
+            result = download_and_send(chat_id, link.url, status_msg_id, post_title, task_id, job_id, post_key)
+            for key in {post_key, result['post_key']} - {None}:
+                result_cache.put(key, result['media'], result['post_text'])
+        except Exception as e:
+            if job_id is not None and not isinstance(e, JobCancelled):
+                fail_waiters(job_id, post_key, e)
+            raise
+        finally:
+            if job_id is not None:
+                job_queue.wake_waiters(job_id)
+        finish_delivery(chat_id, send_post=False, job_id=job_id)
+        metrics.observe_job("cached" if result['cached'] else "downloaded", started)
+    except Exception as e:
+        metrics.observe_job(failure_result(e), started)
+        report_failure(chat_id, url, e, job_id)
+        # Воркер очереди запишет задачу как failed
+        raise
+
+def upload_media(chat_id, outputs):
+    sent_media = []
+    for batch in split_media_batches(outputs):
+        with ExitStack() as stack:
+            files = [[kind, stack.enter_context(open(path, 'rb'))] for kind, path in batch]
+            sent_media.extend(sent_file_ids(send_media_batch(chat_id, files)))
+    return sent_media
+
+def format_media_summary(job):
+    entries = job_entries(job)
+    duration = media_duration(job)
+    length = f", {int(duration) // 60}:{int(duration) % 60:02d}" if duration else ""
+    if len(entries) > 1:
+        return f"Скачиваю карусель: {len(entries)} файлов{length}..."
+    return f"Скачиваю видео{length}..."
+
+def download_and_send(chat_id, url, status_msg_id, post_title, task_id, job_id=None, post_key=None):
     """
-    Скачивает Reels, пост или карусель из Instagram по ссылке url.
-    Требует, чтобы вы были залогинены в Instagram в Chrome на этом компьютере!
-    Возвращает (media_files, post_text).
+    Скачивает и отправляет медиа по ссылке. Подпись отправляется сразу по
+    метаданным, пока видео ещё качается.
+    Возвращает {"media": [[тип, file_id], ...], "post_text": ..., "post_key": ..., "cached": ...}.
     """
-    import yt_dlp
-    import os
-    import subprocess
-
-    ydl_opts = {
-    'outtmpl': os.path.join(tmpdir, '%(title)s.%(ext)s'),
-    'quiet': True,
-    'merge_output_format': 'mp4',
-    'format': (
-        'bestvideo[ext=mp4][height<=1280][width<=720][vcodec!*=none]+'
-        'bestaudio[ext=m4a]/best[ext=mp4][height<=1280][width<=720][vcodec!*=none]/best'
-    ),
-    'postprocessors': [],
-    'http_headers': {'User-Agent': 'Mozilla/5.0'},
-    'allow_unplayable_formats': False,
-    'prefer_ffmpeg': True,
-    'cookiefile': 'instagram_cookies.txt',  # <-- используйте этот параметр
-}
-
-    media_files = []
-    post_text = ""
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            post_text = info.get('description') or info.get('title') or ""
-            # Карусель (несколько видео/фото)
-            if 'entries' in info and info['entries']:
-                for entry in info['entries']:
-                    filename = ydl.prepare_filename(entry)
-                    new_filename = os.path.splitext(filename)[0] + '.mp4'
-                    subprocess.run([
-                        'ffmpeg', '-y', '-i', filename,
-                        '-vf', 'scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2:color=black',
-                        '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
-                        '-c:a', 'aac', '-b:a', '128k',
-                        '-movflags', '+faststart',
-                        new_filename
-                    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    if os.path.exists(new_filename) and os.path.getsize(new_filename) > 0:
-                        media_files.append(new_filename)
-            else:
-                filename = ydl.prepare_filename(info)
-                new_filename = os.path.splitext(filename)[0] + '.mp4'
-                subprocess.run([
-                    'ffmpeg', '-y', '-i', filename,
-                    '-vf', 'scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2:color=black',
-                    '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
-                    '-c:a', 'aac', '-b:a', '128k',
-                    '-movflags', '+faststart',
-                    new_filename
-                ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if os.path.exists(new_filename) and os.path.getsize(new_filename) > 0:
-                    media_files.append(new_filename)
-    except Exception as e:
-        print(f"Ошибка скачивания Instagram: {e}")
-    return media_files, post_text   
-
-def download_pinterest_video(url, output_path):
-    ydl_opts = {
-        'outtmpl': output_path,
-        'quiet': True,
-        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-        'merge_output_format': 'mp4',
-        'noplaylist': True,
-    }
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            new_filename = os.path.splitext(filename)[0] + '.mp4'
-            subprocess.run([
-                'ffmpeg', '-y', '-i', filename,
-                '-vf', 'scale=720:1280:force_original_aspect_ratio=decrease,pad=720:1280:(ow-iw)/2:(oh-ih)/2:color=black',
-                '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
-                '-c:a', 'aac', '-b:a', '128k',
-                '-movflags', '+faststart',
-                new_filename
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            return new_filename if os.path.exists(new_filename) else None
-    except Exception as e:
-        print(f"Ошибка при скачивании Pinterest видео: {e}")
+    def on_metadata(job):
+        if job.post_text:
+            user_store.set_post(chat_id, job.post_text)
+            bot.send_message(chat_id, job.post_text)
+        # Короткая ссылка или другой вид ссылки на уже отправленный пост
+        cached = result_cache.get(job.post_key) if job.post_key not in (None, post_key) else None
+        if cached:
+            update_processing_status(chat_id, status_msg_id, post_title, "Готово", task_id, done=True)
+            send_cached_media(chat_id, cached['media'])
+            return cached
+        update_processing_status(chat_id, status_msg_id, post_title, format_media_summary(job), task_id, job_id=job_id)
+        if job_id is not None:
+            update_waiters(job_id, f"Общая загрузка: {format_media_summary(job)}")
         return None
-    
+
+    def upload(job):
+        update_processing_status(chat_id, status_msg_id, post_title, "Готово", task_id, done=True)
+        return upload_media(chat_id, job.outputs)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        job = run_pipeline(url, tmpdir, upload, control=current_control(), on_metadata=on_metadata)
+        if job.cached:
+            return dict(job.cached, post_key=job.post_key, cached=True)
+        for mode, media_seconds, elapsed, profile in job.transcodes:
+            job_queue.record_transcode(job_id, mode, media_seconds, elapsed, profile)
+        return {'media': job.media, 'post_text': job.post_text, 'post_key': job.post_key, 'cached': False}
+
 @bot.message_handler(commands=['start'])
 @subscription_guard
 def send_welcome(message):
     chat_id = message.chat.id
-    user_links.pop(chat_id, None)
-    user_posts.pop(chat_id, None)
-    user_state[chat_id] = 'WAITING_FOR_LINK'
-
-    # ⚡ Используем уже готовое видео с правильным размером (720x1280)
-    video_path = 'welcome_ready.mp4'  # заранее подготовленный файл
+    user_store.reset(chat_id)
 
-    if os.path.exists(video_path):
+    if os.path.exists(WELCOME_VIDEO_PATH):
         try:
-            with open(video_path, 'rb') as video:
+            with open(WELCOME_VIDEO_PATH, 'rb') as video:
                 bot.send_video(chat_id, video, supports_streaming=True)
         except Exception as e:
-            print(f'❌ Ошибка при отправке видео: {e}')
+            logging.error(f"Ошибка при отправке приветственного видео: {e}")
 
     bot.send_chat_action(chat_id, 'typing')
     time.sleep(0.5)
-    welcome_text = (
-        "👋 Привет! Отправь мне ссылку на видео 🎥\n"
-        "Я помогу скачать видео и посты из Instagram, TikTok, Pinterest.\n\n"
-        "⚡ Поддерживаются только вертикальные видео (9:16, 720x1280)."
-    )
-    bot.send_message(chat_id, welcome_text)
+    bot.send_message(chat_id, WELCOME_TEXT)
 
 
 @bot.message_handler(commands=['menu'])
 @subscription_guard
 def show_menu(message):
     chat_id = message.chat.id
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("🚀 Ещё больше автоматизации тут", url=ROCKET_URL))
-    if chat_id == OWNER_ID:
-        markup.add(InlineKeyboardButton("Статистика", callback_data="admin_stats"))
-    bot.send_message(chat_id, "Главное меню:", reply_markup=markup)
+    bot.send_message(chat_id, "Главное меню:", reply_markup=build_menu_keyboard(chat_id))
 
 @bot.callback_query_handler(func=lambda call: call.data == "admin_stats")
 def show_admin_stats(call):
     if call.message.chat.id != OWNER_ID:
         bot.answer_callback_query(call.id, "Нет доступа")
         return
-    stats = (
-        f"👤 Пользователей: {len(user_state)}\n"
-        f"📥 Ссылок в очереди: {len(user_links)}\n"
-        f"📝 Постов: {len(user_posts)}\n"
-        f"🗂️ Всего сообщений: {sum(user_message_count.values()) if 'user_message_count' in globals() else 'N/A'}"
-    )
-    bot.send_message(call.message.chat.id, f"Статистика бота:\n{stats}")
+    bot.send_message(call.message.chat.id, f"Статистика бота:\n{build_stats_text()}")
     bot.answer_callback_query(call.id)
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith("cancel:"))
+def handle_cancel(call):
+    job_id = int(call.data.split(":", 1)[1])
+    url = job_queue.cancel_waiting(job_id, call.message.chat.id)
+    if url:
+        # Ожидающая задача ничего не качает, поэтому завершается сразу
+        bot.answer_callback_query(call.id, "Загрузка отменена")
+        report_failure(call.message.chat.id, url, JobCancelled(), job_id)
+    elif job_queue.request_cancel(job_id, call.message.chat.id):
+        bot.answer_callback_query(call.id, "Отменяю загрузку...")
+    else:
+        bot.answer_callback_query(call.id, "Задача уже завершена")
+
 @bot.callback_query_handler(func=lambda call: call.data == "check_subscription")
 def handle_check_subscription(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
+    # Пользователь только что подписался — не верим закэшированному отказу
+    membership_cache.invalidate(user_id)
     if user_id == OWNER_ID or check_subscription(user_id):
         bot.answer_callback_query(call.id, "✅ Подписка подтверждена! Можете пользоваться ботом.")
         bot.send_message(chat_id, "Спасибо за подписку! Теперь отправьте ссылку на видео или пост.")
-        user_state[chat_id] = 'WAITING_FOR_LINK'
+        user_store.set_state(chat_id, WAITING_FOR_LINK)
     else:
         bot.answer_callback_query(call.id, "❌ Подписка не найдена.")
         bot.send_message(
             chat_id,
-            "❗ Я не вижу вашу подписку. Проверьте, что вы подписаны на канал @staritsin_school и попробуйте снова.",
+            SUBSCRIPTION_MISSING_TEXT,
             reply_markup=build_subscribe_keyboard()
         )
 
@@ -401,57 +590,14 @@ def handle_check_subscription(call):
 def handle_donate(message):
     chat_id = message.chat.id
 
-    # Сообщение с основными способами оплаты
-    markup_main = InlineKeyboardMarkup(row_width=1)
-    markup_main.add(
-        InlineKeyboardButton("T-Pay / СБП / РФ карта", url="https://pay.cloudtips.ru/p/2a436b20"),
-        InlineKeyboardButton("Telegram Stars / Любая карта", url="https://t.me/your_stars_link"),
-        InlineKeyboardButton("Crypto", url="https://t.me/your_crypto_link")
-    )
-    bot.send_message(
-        chat_id,
-        "Если вам нравятся наши продукты автоматизации, и вы цените, что мы для вас стараемся — будем рады вашей поддержке в виде доната 💙",
-        reply_markup=markup_main
-    )
-
-    # Сообщение с выбором суммы
-    markup_sum = InlineKeyboardMarkup(row_width=3)
-    markup_sum.add(
-        InlineKeyboardButton("⭐ 10", callback_data="donate_10"),
-        InlineKeyboardButton("⭐ 50", callback_data="donate_50"),
-        InlineKeyboardButton("⭐ 100", callback_data="donate_100"),
-        InlineKeyboardButton("⭐ 200", callback_data="donate_200"),
-        InlineKeyboardButton("⭐ 500", callback_data="donate_500"),
-        InlineKeyboardButton("⭐ 1000", callback_data="donate_1000"),
-        InlineKeyboardButton("⭐ 10000", callback_data="donate_10000")
-    )
-    bot.send_message(
-        chat_id,
-        "Какая сумма заставит нас танцевать от счастья прямо сейчас?",
-        reply_markup=markup_sum
-    )
-
-    # Сообщение с быстрым донатом
-    markup_pay = InlineKeyboardMarkup()
-    markup_pay.add(InlineKeyboardButton("Заплатить ⭐ 50", url="https://pay.cloudtips.ru/p/2a436b20?amount=50"))
-    bot.send_message(
-        chat_id,
-        "🍩 В качестве благодарности!!! Просто возьми мои деньги!!!",
-        reply_markup=markup_pay
-    )
+    for text, markup in build_donate_messages():
+        bot.send_message(chat_id, text, reply_markup=markup)
 
 # Обработка нажатий на суммы (можно добавить переход на нужную ссылку)
 @bot.callback_query_handler(func=lambda call: call.data.startswith("donate_"))
 def handle_donate_amount(call):
-    amount = call.data.split("_")[1]
-    pay_url = f"https://pay.cloudtips.ru/p/2a436b20?amount={amount}"
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton(f"Заплатить ⭐ {amount}", url=pay_url))
-    bot.send_message(
-        call.message.chat.id,
-        f"Спасибо за поддержку! Для оплаты {amount} рублей нажмите кнопку ниже 👇",
-        reply_markup=markup
-    )
+    text, markup = build_donate_amount_message(call.data.split("_")[1])
+    bot.send_message(call.message.chat.id, text, reply_markup=markup)
     bot.answer_callback_query(call.id)
 
 @bot.message_handler(commands=['rocket'])
@@ -459,62 +605,61 @@ def handle_donate_amount(call):
 def handle_rocket(message):
     bot.send_chat_action(message.chat.id, 'typing')
     time.sleep(0.5)
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("🚀 Ещё больше автоматизации", url=ROCKET_URL))
-    bot.send_message(
-        message.chat.id,
-        "🚀 Для ещё большей автоматизации переходите в @rocketcontentbot",
-        reply_markup=markup
-    )
+    bot.send_message(message.chat.id, ROCKET_TEXT, reply_markup=build_rocket_promo_keyboard(), priority=LOW)
     increment_message_count(message.chat.id)
 
 @bot.message_handler(commands=['rewrite'])
 @subscription_guard
 def handle_rewrite_command(message):
     chat_id = message.chat.id
-    post_text = user_posts.get(chat_id)
+    post_text = user_store.get_post(chat_id)
     if not post_text or not post_text.strip():
         bot.send_message(chat_id, "Нет текста для рерайта. Сначала скачайте видео с описанием.")
         return
-    bot.send_chat_action(chat_id, 'typing')
-    try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Ты профессиональный копирайтер. Перепиши текст поста, сохранив смысл, но сделай его коротким, цепляющим и эмоциональным для соцсетей на русском языке."},
-                {"role": "user", "content": post_text}
-            ],
-            max_tokens=256,
-            temperature=1.0,
-        )
-        rewritten = response.choices[0].message.content.strip()
+    rewriter.mark_used(chat_id)
+    rewritten = rewriter.cached(post_text)
+    if rewritten is not None:
         bot.send_message(chat_id, f"✍️ Вот рерайт поста:\n\n{rewritten}")
-    except Exception as e:
-        logging.error(f"Ошибка рерайта: {e}")
+        return
+    wait = rewriter.allow(message.from_user.id)
+    if wait:
+        bot.send_message(chat_id, f"⏳ Слишком много рерайтов подряд. Попробуйте через {wait:.0f} с")
+        return
+    bot.send_chat_action(chat_id, 'typing')
+    # Ответ придёт из пула рерайтов, поток обновлений не ждёт OpenAI
+    rewriter.submit(post_text, lambda rewritten, error: send_rewrite(chat_id, rewritten, error))
+
+def send_rewrite(chat_id, rewritten, error):
+    if error:
+        logging.error(f"Ошибка рерайта: {error}")
         bot.send_message(chat_id, "⚠️ Не удалось сделать рерайт")
+        return
+    bot.send_message(chat_id, f"✍️ Вот рерайт поста:\n\n{rewritten}")
 
 @bot.message_handler(func=lambda message: True, content_types=['text'])
 @subscription_guard
 def handle_link(message):
-    url = message.text.strip()
     chat_id = message.chat.id
 
-    if user_state.get(chat_id) == 'WAITING_FOR_DOWNLOAD':
-        bot.send_message(chat_id, "⏳ Подожди чуть-чуть, я ещё обрабатываю предыдущее видео...")
-        return
-
-    platform = detect_platform(url)
-    if not platform:
+    # Ссылки без параметров отслеживания, по одной на пост
+    links = extract_links(message.text, accept=lambda link: detect_platform(link.url))
+    if not links:
         bot.reply_to(message, "⚠️ Формат не поддерживается или ссылка не распознана.")
         return
 
-    user_links.pop(chat_id, None)
-    user_posts.pop(chat_id, None)
-    user_links[chat_id] = url
-    user_state[chat_id] = 'WAITING_FOR_DOWNLOAD'
+    # Проверка и захват состояния атомарны: две ссылки подряд не запустят две загрузки
+    if not user_store.transition(chat_id, WAITING_FOR_DOWNLOAD, unless=(WAITING_FOR_DOWNLOAD,), link=links[0].url, post=''):
+        bot.send_message(chat_id, "⏳ Подожди чуть-чуть, я ещё обрабатываю предыдущее видео...")
+        return
 
-    threading.Thread(target=process_download, args=(chat_id, url)).start()
+    for link in links:
+        job_queue.enqueue(chat_id, message.from_user.id, link.url)
+    if len(links) > 1:
+        bot.send_message(chat_id, f"📥 Принял ссылок: {len(links)}, пришлю всё по готовности")
 
 if __name__ == '__main__':
-    print("Бот запущен")
+    print(f"Бот запущен, роль: {BOT_ROLE}")
+    metrics.start_metrics_server()
+    if BOT_ROLE != "dispatcher":
+        job_queue.start(process_download)
     bot.infinity_polling()
@@ -0,0 +1,218 @@
+import os
+import copy
+import json
+import sqlite3
+import threading
+import time
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+
+import yt_dlp.extractor
+
+CACHE_DB = os.getenv("CACHE_DB", "cache.sqlite3")
+# file_id в Telegram не протухают, TTL нужен только чтобы обновлять подписи
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+# Подписка меняется редко, а вот отписавшемуся после подписки не стоит ждать долго
+SUBSCRIPTION_TTL = int(os.getenv("SUBSCRIPTION_TTL", "600"))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "60"))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "100000"))
+# Метаданные yt-dlp содержат временные ссылки CDN, поэтому храним их недолго —
+# только чтобы повтор задачи или ссылки не извлекал пост заново
+METADATA_TTL = int(os.getenv("METADATA_TTL", "300"))
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "256"))
+
+_extractors = None
+
+
+@lru_cache(maxsize=4096)
+def resolve_post_key(url):
+    """
+    Канонический ключ поста по ID экстрактора yt-dlp, например "instagram:Cxyz123".
+    Параметры ссылки (utm, igsh, lang) на ключ не влияют.
+    Если экстрактор не распознал ссылку, ключом служит сама ссылка.
+    """
+    global _extractors
+    if _extractors is None:
+        _extractors = [ie for ie in yt_dlp.extractor.gen_extractor_classes() if ie.ie_key() != "Generic"]
+    for ie in _extractors:
+        if ie.suitable(url):
+            post_id = ie.get_temp_id(url)
+            if post_id:
+                return f"{ie.ie_key().lower()}:{post_id}"
+            break
+    return f"url:{url.strip()}"
+
+
+def post_key_from_info(info):
+    """
+    Ключ поста по метаданным yt-dlp в том же виде, что и resolve_post_key.
+    В отличие от него учитывает редиректы коротких ссылок. None, если ID неизвестен.
+    """
+    extractor = info.get('extractor_key') or info.get('ie_key')
+    if not extractor or not info.get('id'):
+        return None
+    return f"{extractor.lower()}:{info['id']}"
+
+
+class MetadataCache:
+    """
+    Кэш результатов extract_info в памяти процесса на ttl секунд.
+    Хранит и отдаёт копии: process_info дописывает в метаданные пути файлов.
+    """
+
+    def __init__(self, ttl=METADATA_TTL, max_entries=METADATA_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(entry[0])
+
+    def put(self, key, info):
+        try:
+            info = copy.deepcopy(info)
+        except Exception as e:
+            # Ленивые списки фрагментов и т.п. не копируются — такой пост не кэшируем
+            logging.info(f"Метаданные {key} не закэшированы: {e}")
+            return
+        with self._lock:
+            self._entries[key] = (info, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class MembershipCache:
+    """
+    Кэш проверок подписки на канал в памяти процесса.
+    Положительный ответ хранится ttl секунд, отрицательный — negative_ttl.
+    """
+
+    def __init__(self, ttl=SUBSCRIPTION_TTL, negative_ttl=SUBSCRIPTION_NEGATIVE_TTL, max_entries=SUBSCRIPTION_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id, subscribed):
+        ttl = self.ttl if subscribed else self.negative_ttl
+        with self._lock:
+            self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class ResultCache:
+    """
+    Кэш готовых результатов: ключ поста -> file_id отправленных в Telegram
+    медиа и текст поста. Повторная отправка по file_id не требует ни
+    скачивания, ни перекодирования, ни загрузки файла.
+    """
+
+    def __init__(self, path=CACHE_DB, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, "
+                "media TEXT NOT NULL, "
+                "post_text TEXT NOT NULL DEFAULT '', "
+                "created_at REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def get(self, key):
+        """Возвращает {"media": [[тип, file_id], ...], "post_text": ...} или None."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT media, post_text, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[2] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        logging.info(f"Кэш: попадание {key}")
+        return {"media": json.loads(row[0]), "post_text": row[1]}
+
+    def put(self, key, media, post_text=""):
+        if not media:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, media, post_text, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(media), post_text or "", now, now)
+            )
+            # Вытесняем давно не использованные записи сверх лимита
+            self._conn.execute(
+                "DELETE FROM results WHERE key IN ("
+                "SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def invalidate(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
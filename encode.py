@@ -0,0 +1,119 @@
+import os
+import threading
+import logging
+from contextlib import contextmanager
+
+import metrics
+from jobs import TRANSCODE_WORKERS
+
+# Бюджет потоков libx264 на машину: делится между живыми процессами-воркерами,
+# сумма -threads всех ffmpeg не больше него
+ENCODE_THREADS = int(os.getenv("ENCODE_THREADS", str(os.cpu_count() or 1)))
+# Пресеты от простоя к перегрузке: чем длиннее очередь, тем быстрее пресет
+ENCODE_PRESETS = os.getenv(
+    "ENCODE_PRESETS", f"{os.getenv('ENCODE_PRESET', 'fast')},faster,veryfast"
+).split(",")
+# Сколько задач в очереди переводят кодирование на следующий пресет
+ENCODE_BACKLOG_STEP = int(os.getenv("ENCODE_BACKLOG_STEP", "4"))
+
+
+def _load_per_core():
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        # getloadavg есть не везде
+        return 0.0
+
+
+class EncodeController:
+    """
+    Выбирает пресет и число потоков для каждого кодирования по длине очереди
+    и загрузке машины. Пока все потоки бюджета заняты, новое кодирование ждёт,
+    поэтому параллельные ffmpeg не делят ядра друг у друга. Бюджет машины
+    делится поровну между процессами-воркерами на ней. Кодирование без
+    конкурентов получает весь свободный бюджет процесса, а при конкуренции —
+    не больше доли процесса // slots потоков, чтобы все слоты пула
+    перекодирования могли работать одновременно.
+    """
+
+    def __init__(self, budget=ENCODE_THREADS, presets=ENCODE_PRESETS, backlog_step=ENCODE_BACKLOG_STEP,
+                 slots=TRANSCODE_WORKERS):
+        self.budget = max(1, budget)
+        self.slots = max(1, slots)
+        self.presets = presets
+        self.backlog_step = max(1, backlog_step)
+        # Функции, возвращающие число задач в очереди и живых воркеров на машине; задаёт бот
+        self.backlog = lambda: 0
+        self.peers = lambda: 1
+        self.active = 0
+        self.waiting = 0
+        self.threads_in_use = 0
+        self._cond = threading.Condition()
+
+    def _backlog(self):
+        try:
+            return self.backlog()
+        except Exception as e:
+            logging.warning(f"Не удалось узнать длину очереди: {e}")
+            return 0
+
+    def local_budget(self):
+        """Потоки этого процесса: бюджет машины, поделённый между её воркерами."""
+        try:
+            peers = self.peers()
+        except Exception as e:
+            logging.warning(f"Не удалось узнать число воркеров: {e}")
+            peers = 1
+        return max(1, self.budget // max(1, peers))
+
+    def choose_preset(self, backlog, load):
+        level = backlog // self.backlog_step
+        if load > 1.0:
+            # Машина и так перегружена (чужие процессы, ffprobe, yt-dlp)
+            level += 1
+        return self.presets[min(level, len(self.presets) - 1)]
+
+    def acquire(self):
+        """Ждёт свободные потоки и возвращает профиль {'preset', 'threads', 'backlog', 'load'}."""
+        backlog = self._backlog()
+        load = _load_per_core()
+        preset = self.choose_preset(backlog, load)
+        budget = self.local_budget()
+        with self._cond:
+            self.waiting += 1
+            while self.threads_in_use >= budget:
+                self._cond.wait()
+            # Делим бюджет между текущими кодированиями и ждущими потоков (включая это):
+            # единственное кодирование забирает весь свободный бюджет
+            contenders = self.active + self.waiting
+            share = budget // contenders
+            if contenders > 1:
+                # При конкуренции одно кодирование не занимает больше доли слота пула
+                share = min(share, max(1, budget // self.slots))
+            threads = max(1, min(share, budget - self.threads_in_use))
+            self.waiting -= 1
+            self.active += 1
+            self.threads_in_use += threads
+        metrics.ENCODE_PROFILES.inc(preset=preset)
+        return {'preset': preset, 'threads': threads, 'backlog': backlog, 'load': round(load, 2)}
+
+    def release(self, profile):
+        with self._cond:
+            self.active -= 1
+            self.threads_in_use -= profile['threads']
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, mode):
+        """Профиль для режима 'encode'; remux и поток без перекодирования потоков не занимают."""
+        if mode != 'encode':
+            yield None
+            return
+        profile = self.acquire()
+        try:
+            yield profile
+        finally:
+            self.release(profile)
+
+
+controller = EncodeController()
@@ -0,0 +1,874 @@
+import os
+import json
+import socket
+import contextvars
+import sqlite3
+import subprocess
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+JOBS_DB = os.getenv("JOBS_DB", "jobs.sqlite3")
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 1)))
+# Сколько хранить завершённые задачи (для статистики ожидания)
+JOBS_KEEP_SECONDS = int(os.getenv("JOBS_KEEP_SECONDS", "86400"))
+# Задача, владелец которой не отмечался дольше этого времени, возвращается в очередь
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "90"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+# Общий срок на задачу целиком; сроки отдельных этапов задаёт pipeline
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", "900"))
+# Как часто процесс проверяет запросы отмены своих задач
+CANCEL_POLL_SECONDS = float(os.getenv("CANCEL_POLL_SECONDS", "2"))
+# Как часто простаивающий воркер заглядывает в очередь: задачи от диспетчера
+# из другого процесса приходят без уведомления
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+# Сколько помнить ошибку общей загрузки поста: запросы того же поста сразу
+# получают ту же ошибку, а не скачивают его заново
+SHARED_FAILURE_TTL = int(os.getenv("SHARED_FAILURE_TTL", "120"))
+# Как часто воркер публикует снимок своих метрик для статистики диспетчера, секунд
+STATS_PUBLISH_SECONDS = float(os.getenv("STATS_PUBLISH_SECONDS", "10"))
+
+# Очередь общая для нескольких процессов (gunicorn), поэтому у каждого свой идентификатор
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Отдельный пул для ffmpeg: кодирование упирается в CPU, поэтому
+# одновременно кодируем не больше TRANSCODE_WORKERS файлов
+transcode_pool = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix="transcode")
+
+# Свой у каждого потока загрузки и у каждой задачи asyncio
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def current_job_id():
+    """ID задачи, которую выполняет текущий поток загрузки или задача asyncio (или None)."""
+    return _current_job.get()
+
+
+def set_current_job(job_id):
+    _current_job.set(job_id)
+
+
+def current_control():
+    """JobControl задачи, которую выполняет текущий поток загрузки (или None)."""
+    return get_control(current_job_id())
+
+
+def get_control(job_id):
+    return _controls.get(job_id)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class SharedDownloadFailed(Exception):
+    """
+    Пост не скачала задача-ведущая; текст — причина для пользователя,
+    post_text — подпись поста, если ведущая не успела её отправить.
+    """
+
+    def __init__(self, reason, post_text=""):
+        super().__init__(reason)
+        self.post_text = post_text
+
+
+class JobControl:
+    """
+    Отмена и сроки одной задачи. Подпроцессы (ffmpeg) регистрируются здесь,
+    чтобы отмена или истечение срока их убивали и освобождали воркер.
+    """
+
+    def __init__(self, job_id=None, timeout=JOB_TIMEOUT, on_stage=None):
+        self.job_id = job_id
+        # on_stage(stage) сообщает этап задачи в очередь, чтобы его видел диспетчер
+        self.on_stage = on_stage
+        self.deadline = time.monotonic() + timeout
+        self.stage = None
+        self.stage_deadline = self.deadline
+        self.cancelled = False
+        self._procs = set()
+        self._lock = threading.Lock()
+
+    def start_stage(self, stage, timeout=None):
+        self.check()
+        self.stage = stage
+        self.stage_deadline = min(self.deadline, time.monotonic() + timeout) if timeout else self.deadline
+        if self.on_stage:
+            try:
+                self.on_stage(stage)
+            except Exception as e:
+                logging.warning(f"Не удалось записать этап задачи {self.job_id}: {e}")
+
+    def remaining(self):
+        return max(self.stage_deadline - time.monotonic(), 0.0)
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled("Задача отменена пользователем")
+        if time.monotonic() > self.stage_deadline:
+            raise JobTimeout(f"Превышено время этапа {self.stage}")
+
+    def progress_hook(self, status):
+        # progress_hooks yt-dlp вызываются на каждый скачанный блок
+        self.check()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            procs = list(self._procs)
+        for proc in procs:
+            _kill(proc)
+        logging.info(f"Задача {self.job_id} отменена")
+
+    def register(self, proc):
+        with self._lock:
+            self._procs.add(proc)
+            cancelled = self.cancelled
+        if cancelled:
+            _kill(proc)
+
+    def unregister(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+
+    def wait(self, proc):
+        """Ждёт подпроцесс не дольше оставшегося времени этапа, иначе убивает его."""
+        self.register(proc)
+        try:
+            proc.wait(timeout=self.remaining())
+        except subprocess.TimeoutExpired:
+            _kill(proc)
+            proc.wait()
+        finally:
+            self.unregister(proc)
+        self.check()
+        return proc.returncode
+
+
+def _kill(proc):
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+
+
+_controls = {}
+
+
+def open_control(job_id, on_stage=None):
+    control = JobControl(job_id, on_stage=on_stage)
+    _controls[job_id] = control
+    return control
+
+
+def close_control(job_id):
+    _controls.pop(job_id, None)
+
+
+def run_transcode(func, *args, **kwargs):
+    """
+    Выполняет func в пуле перекодирования и ждёт результата.
+    Поток загрузки при этом не занимает CPU, а число одновременных ffmpeg ограничено.
+    """
+    return transcode_pool.submit(func, *args, **kwargs).result()
+
+
+class JobQueue:
+    """
+    Очередь задач на скачивание в SQLite.
+    Задачи переживают перезапуск, воркеры выбирают задачи по очереди между
+    пользователями, чтобы один пользователь не занимал все воркеры.
+    """
+
+    def __init__(self, path=JOBS_DB):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = threading.Event()
+        self.role = None
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "chat_id INTEGER NOT NULL, "
+                "user_id INTEGER NOT NULL, "
+                "url TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', "
+                "created_at REAL NOT NULL, "
+                "started_at REAL, "
+                "finished_at REAL, "
+                "error TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, user_id)")
+            for column in ("worker TEXT", "heartbeat_at REAL", "cancel_requested INTEGER NOT NULL DEFAULT 0", "stage TEXT",
+                           "delivered INTEGER NOT NULL DEFAULT 0",
+                           # Ключ поста, который скачивает задача-ведущий, и ведущий ожидающей задачи
+                           "post_key TEXT", "leader_id INTEGER", "status_message INTEGER"):
+                self._add_column("jobs", column)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_post_key ON jobs (post_key, status)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_leader ON jobs (leader_id)")
+            # Процессы, разбирающие очередь: диспетчер видит их по отметкам heartbeat
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS workers ("
+                "id TEXT PRIMARY KEY, "
+                "role TEXT NOT NULL, "
+                "capacity INTEGER NOT NULL, "
+                "started_at REAL NOT NULL, "
+                "heartbeat_at REAL NOT NULL)"
+            )
+            # Снимок метрик процесса (metrics.snapshot) в JSON
+            self._add_column("workers", "stats TEXT")
+            # Общие для всех процессов token bucket, например лимит Telegram на бота
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limits ("
+                "name TEXT PRIMARY KEY, "
+                "tokens REAL NOT NULL, "
+                "updated REAL NOT NULL)"
+            )
+            # Входящие обновления Telegram из webhook, ожидающие обработки
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS updates ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "payload TEXT NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+            # Обновление удаляется только после обработки; аренду продлевает heartbeat владельца
+            for column in ("worker TEXT", "claimed_at REAL"):
+                self._add_column("updates", column)
+            # Последняя ошибка общей загрузки поста, живёт SHARED_FAILURE_TTL
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS post_failures ("
+                "post_key TEXT PRIMARY KEY, "
+                "error TEXT NOT NULL, "
+                "failed_at REAL NOT NULL)"
+            )
+            # Решения о перекодировании по каждому файлу задачи
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS transcodes ("
+                "job_id INTEGER, "
+                "mode TEXT NOT NULL, "
+                "media_seconds REAL NOT NULL, "
+                "elapsed REAL NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+            # Профиль кодирования (пресет и потоки), выбранный encode.controller
+            for column in ("preset TEXT", "threads INTEGER"):
+                self._add_column("transcodes", column)
+
+    def _add_column(self, table, column):
+        existing = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+        if column.split()[0] not in existing:
+            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+    def enqueue(self, chat_id, user_id, url):
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO jobs (chat_id, user_id, url, created_at) VALUES (?, ?, ?, ?)",
+                (chat_id, user_id, url, time.time())
+            )
+            job_id = cur.lastrowid
+        with self._cond:
+            self._cond.notify_all()
+        logging.info(f"Задача {job_id} поставлена в очередь: {url}")
+        return job_id
+
+    def claim(self):
+        """
+        Забирает следующую задачу. Сначала идут пользователи, у которых сейчас
+        меньше всего задач в работе, затем по порядку их собственных задач.
+        """
+        with self._lock:
+            # BEGIN IMMEDIATE: выбор и захват задачи атомарны и между процессами
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT j.* FROM jobs j WHERE j.status = 'pending' ORDER BY "
+                    "(SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.status = 'running'), "
+                    "(SELECT COUNT(*) FROM jobs p WHERE p.user_id = j.user_id AND p.status = 'pending' AND p.id < j.id), "
+                    "j.id LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    now = time.time()
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', started_at = ?, worker = ?, heartbeat_at = ?, stage = NULL, delivered = 0 "
+                        "WHERE id = ?",
+                        (now, WORKER_ID, now, row["id"])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        metrics.JOB_WAIT_SECONDS.observe(now - row["created_at"])
+        job = dict(row)
+        job["started_at"] = now
+        return job
+
+    def enqueue_update(self, payload):
+        """Сохраняет JSON обновления Telegram для последующей обработки."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO updates (payload, created_at) VALUES (?, ?)", (payload, time.time())
+            )
+        with self._cond:
+            self._cond.notify_all()
+
+    def claim_update(self):
+        """
+        Берёт в аренду следующее обновление: свободное или то, чей владелец
+        перестал отмечаться. Возвращает (id, payload); после обработки
+        обновление удаляет ack_update.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT id, payload FROM updates WHERE claimed_at IS NULL OR claimed_at < ? ORDER BY id LIMIT 1",
+                    (now - JOB_LEASE_SECONDS,)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE updates SET worker = ?, claimed_at = ? WHERE id = ?", (WORKER_ID, now, row["id"])
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return (row["id"], row["payload"]) if row is not None else None
+
+    def ack_update(self, update_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM updates WHERE id = ?", (update_id,))
+
+    def finish(self, job_id, error=None, started_at=None):
+        # Задачу, которую обработчик вернул в очередь или оставил ждать ведущего, не трогаем;
+        # started_at отличает этот запуск от повторного, если задачу уже забрал другой воркер
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ? AND status = 'running' "
+                "AND (? IS NULL OR started_at = ?)",
+                ("failed" if error else "done", time.time(), error, job_id, started_at, started_at)
+            )
+
+    def lead(self, job_id, post_key, lookup=None):
+        """
+        Берёт на задачу скачивание поста post_key. Возвращает словарь:
+        {'leader': ID} — пост уже скачивает другая задача, эта переходит в статус
+        waiting и остаётся в очереди, поэтому её не потеряет ни падение ведущего,
+        ни перезапуск процесса; {'error': причина} — ведущая недавно не справилась
+        с этим постом; {'cached': результат lookup(post_key)} — ведущая успела
+        закончить; {} — скачивать этой задаче.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                outcome = self._lead(job_id, post_key, lookup)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return outcome
+
+    def _lead(self, job_id, post_key, lookup):
+        row = self._conn.execute(
+            "SELECT id FROM jobs WHERE post_key = ? AND status = 'running' AND id != ? ORDER BY id LIMIT 1",
+            (post_key, job_id)
+        ).fetchone()
+        if row is not None:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'waiting', leader_id = ?, post_key = NULL WHERE id = ?", (row["id"], job_id)
+            )
+            return {'leader': row["id"]}
+        failure = self._conn.execute(
+            "SELECT error FROM post_failures WHERE post_key = ? AND failed_at >= ?",
+            (post_key, time.time() - SHARED_FAILURE_TTL)
+        ).fetchone()
+        if failure is not None:
+            return {'error': failure["error"]}
+        # Ведущая кладёт результат в кэш до того, как снять post_key, а эта транзакция
+        # идёт после её снятия: проверка здесь не даст скачать пост второй раз
+        cached = lookup(post_key) if lookup else None
+        if cached:
+            return {'cached': cached}
+        self._conn.execute("UPDATE jobs SET post_key = ? WHERE id = ?", (post_key, job_id))
+        return {}
+
+    def fail_waiters(self, leader_id, post_key, error):
+        """
+        Ведущая не скачала пост: запоминает причину на SHARED_FAILURE_TTL и завершает
+        ожидавшие задачи с ошибкой. Возвращает их строки, чтобы сообщить в чаты.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("UPDATE jobs SET post_key = NULL WHERE id = ?", (leader_id,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO post_failures (post_key, error, failed_at) VALUES (?, ?, ?)",
+                    (post_key, error, now)
+                )
+                waiters = self._conn.execute(
+                    "SELECT id, chat_id, url, status_message, created_at FROM jobs WHERE leader_id = ? AND status = 'waiting'",
+                    (leader_id,)
+                ).fetchall()
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', finished_at = ?, error = ?, leader_id = NULL "
+                    "WHERE leader_id = ? AND status = 'waiting'",
+                    (now, error, leader_id)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [dict(row) for row in waiters]
+
+    def waiters(self, leader_id):
+        """Задачи, ждущие ведущую: чтобы показать им ход общей загрузки."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, chat_id, status_message FROM jobs WHERE leader_id = ? AND status = 'waiting'", (leader_id,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def wake_waiters(self, leader_id):
+        """
+        Возвращает в очередь задачи, ждавшие ведущего: после успеха они найдут
+        результат в кэше, после отмены ведущей одна из них скачает пост сама.
+        Ошибку ведущей ожидающим передаёт fail_waiters.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Ведущий больше не принимает ожидающих
+                self._conn.execute("UPDATE jobs SET post_key = NULL WHERE id = ?", (leader_id,))
+                cur = self._conn.execute(
+                    "UPDATE jobs SET status = 'pending', leader_id = NULL, started_at = NULL, worker = NULL "
+                    "WHERE leader_id = ? AND status = 'waiting'",
+                    (leader_id,)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if cur.rowcount:
+            with self._cond:
+                self._cond.notify_all()
+        return cur.rowcount
+
+    def status_message(self, job_id):
+        """ID сообщения о статусе задачи в чате, если задача уже запускалась."""
+        with self._lock:
+            row = self._conn.execute("SELECT status_message FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_status_message(self, job_id, message_id):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status_message = ? WHERE id = ?", (message_id, job_id))
+
+    def requeue(self, job_id):
+        """Возвращает задачу в очередь, даже если она уже завершена."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'pending', started_at = NULL, finished_at = NULL, worker = NULL, "
+                "error = NULL WHERE id = ?",
+                (job_id,)
+            )
+        with self._cond:
+            self._cond.notify_all()
+
+    def set_stage(self, job_id, stage):
+        """Запоминает текущий этап задачи (extract, download, transcode, upload)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET stage = ?, heartbeat_at = ? WHERE id = ? AND worker = ?",
+                (stage, time.time(), job_id, WORKER_ID)
+            )
+
+    def heartbeat(self):
+        """Продлевает аренду задач и обновлений, которые обрабатывает этот процесс."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND worker = ?",
+                (now, WORKER_ID)
+            )
+            self._conn.execute("UPDATE updates SET claimed_at = ? WHERE worker = ?", (now, WORKER_ID))
+            if self.role:
+                self._conn.execute("UPDATE workers SET heartbeat_at = ? WHERE id = ?", (now, WORKER_ID))
+
+    def register_worker(self, role, capacity):
+        """Отмечает процесс в таблице workers; capacity — сколько задач он берёт одновременно."""
+        now = time.time()
+        self.role = role
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO workers (id, role, capacity, started_at, heartbeat_at) VALUES (?, ?, ?, ?, ?)",
+                (WORKER_ID, role, capacity, now, now)
+            )
+
+    def unregister_worker(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM workers WHERE id = ?", (WORKER_ID,))
+        self.role = None
+
+    def workers(self):
+        """Живые процессы-воркеры: {id: {'role', 'capacity', 'running'}}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT w.id, w.role, w.capacity, "
+                "(SELECT COUNT(*) FROM jobs j WHERE j.worker = w.id AND j.status = 'running') "
+                "FROM workers w WHERE w.heartbeat_at >= ? ORDER BY w.id",
+                (time.time() - JOB_LEASE_SECONDS,)
+            ).fetchall()
+        return {row[0]: {"role": row[1], "capacity": row[2], "running": row[3]} for row in rows}
+
+    def publish_stats(self):
+        """Сохраняет снимок метрик этого процесса в его строку workers."""
+        if not self.role:
+            return
+        stats = json.dumps(metrics.snapshot())
+        with self._lock:
+            self._conn.execute("UPDATE workers SET stats = ? WHERE id = ?", (stats, WORKER_ID))
+
+    def peer_stats(self):
+        """Снимки метрик других живых процессов-воркеров."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stats FROM workers WHERE id != ? AND heartbeat_at >= ? AND stats IS NOT NULL",
+                (WORKER_ID, time.time() - JOB_LEASE_SECONDS)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def take_tokens(self, name, rate, capacity, count):
+        """
+        Забирает до count токенов из общего bucket name.
+        Возвращает (сколько забрано, через сколько секунд появится следующий токен).
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tokens, updated FROM rate_limits WHERE name = ?", (name,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                taken = int(min(count, max(0.0, tokens)))
+                tokens -= taken
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?)",
+                    (name, tokens, now)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return taken, max(0.0, (1 - tokens) / rate)
+
+    def drain_tokens(self, name, rate, seconds):
+        """Обнуляет общий bucket так, чтобы токены появились не раньше чем через seconds секунд."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?)",
+                (name, -seconds * rate, time.time())
+            )
+
+    def local_workers(self):
+        """Живые процессы-воркеры на этой машине, включая этот (не меньше 1)."""
+        host = WORKER_ID.rsplit(":", 1)[0] + ":"
+        with self._lock:
+            count = self._conn.execute(
+                "SELECT COUNT(*) FROM workers WHERE substr(id, 1, ?) = ? AND heartbeat_at >= ?",
+                (len(host), host, time.time() - JOB_LEASE_SECONDS)
+            ).fetchone()[0]
+        return max(1, count)
+
+    def apply_cancellations(self):
+        """Отменяет задачи этого процесса, отмену которых запросили из другого процесса."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status = 'running' AND worker = ? AND cancel_requested = 1",
+                (WORKER_ID,)
+            ).fetchall()
+        for row in rows:
+            control = _controls.get(row["id"])
+            if control and not control.cancelled:
+                control.cancel()
+
+    def cancel_waiting(self, job_id, chat_id):
+        """Отменяет задачу чата, ждущую общей загрузки; возвращает её ссылку или None, если она уже не ждёт."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT url FROM jobs WHERE id = ? AND chat_id = ? AND status = 'waiting'", (job_id, chat_id)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'failed', finished_at = ?, error = 'cancelled', leader_id = NULL "
+                        "WHERE id = ?",
+                        (time.time(), job_id)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return row["url"] if row is not None else None
+
+    def request_cancel(self, job_id, chat_id):
+        """
+        Просит отменить выполняющуюся задачу чата. Задачу другого процесса
+        отменит его heartbeat. Возвращает False, если задача уже завершена.
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND chat_id = ? AND status = 'running'",
+                (job_id, chat_id)
+            )
+        if not cur.rowcount:
+            return False
+        control = _controls.get(job_id)
+        if control:
+            control.cancel()
+        return True
+
+    def recover(self):
+        """
+        Возвращает в очередь задачи, владелец которых перестал отмечаться
+        (процесс упал или был перезапущен).
+        """
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', started_at = NULL, worker = NULL, post_key = NULL "
+                "WHERE status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (time.time() - JOB_LEASE_SECONDS,)
+            )
+            # Ожидающие ведущего, который упал или уже закончил, не разбудив их
+            orphans = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', leader_id = NULL, started_at = NULL, worker = NULL "
+                "WHERE status = 'waiting' AND leader_id NOT IN (SELECT id FROM jobs WHERE status = 'running')"
+            ).rowcount
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - JOBS_KEEP_SECONDS,)
+            )
+            self._conn.execute("DELETE FROM transcodes WHERE created_at < ?", (time.time() - JOBS_KEEP_SECONDS,))
+            self._conn.execute("DELETE FROM post_failures WHERE failed_at < ?", (time.time() - SHARED_FAILURE_TTL,))
+            self._conn.execute("DELETE FROM workers WHERE heartbeat_at < ?", (time.time() - JOB_LEASE_SECONDS,))
+        if cur.rowcount or orphans:
+            logging.info(f"Возвращено в очередь незавершённых задач: {cur.rowcount}, ожидавших ведущего: {orphans}")
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = self._conn.execute("SELECT MIN(created_at) FROM jobs WHERE status = 'pending'").fetchone()[0]
+            avg_wait = self._conn.execute(
+                "SELECT AVG(started_at - created_at) FROM jobs WHERE started_at IS NOT NULL AND created_at > ?",
+                (now - 3600,)
+            ).fetchone()[0]
+            updates = self._conn.execute("SELECT COUNT(*) FROM updates").fetchone()[0]
+            leading = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND post_key IS NOT NULL"
+            ).fetchone()[0]
+            stages = self._conn.execute(
+                "SELECT COALESCE(stage, 'start'), COUNT(*) FROM jobs WHERE status = 'running' GROUP BY 1 ORDER BY 1"
+            ).fetchall()
+        return {
+            "updates": updates,
+            "stages": dict(stages),
+            "pending": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "waiting": counts.get("waiting", 0),
+            "leading": leading,
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "max_wait": now - oldest if oldest else 0.0,
+            "avg_wait": avg_wait or 0.0,
+        }
+
+    def chat_done(self, chat_id, job_id):
+        """
+        Отмечает, что задача job_id отдала результат в чат. True, если других
+        незавершённых задач у чата нет (например, ссылок из того же сообщения).
+        Одновременно закончившиеся задачи чата получат True ровно один раз.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("UPDATE jobs SET delivered = 1 WHERE id = ? AND chat_id = ?", (job_id, chat_id))
+                others = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE chat_id = ? AND status IN ('pending', 'running', 'waiting') "
+                    "AND delivered = 0 AND id != ?",
+                    (chat_id, job_id)
+                ).fetchone()[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return others == 0
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+
+    def record_transcode(self, job_id, mode, media_seconds, elapsed, profile=None):
+        profile = profile or {}
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO transcodes (job_id, mode, media_seconds, elapsed, created_at, preset, threads) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, mode, media_seconds, elapsed, time.time(), profile.get('preset'), profile.get('threads'))
+            )
+
+    def transcode_stats(self):
+        """
+        Сколько файлов пошло по каждому пути и сколько времени кодирования
+        сэкономлено: секунды пропущенного видео умножаются на среднюю
+        скорость полного перекодирования.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT mode, COUNT(*), SUM(media_seconds), SUM(elapsed) FROM transcodes GROUP BY mode"
+            ).fetchall()
+        by_mode = {mode: (count, media or 0.0, elapsed or 0.0) for mode, count, media, elapsed in rows}
+        encoded = by_mode.get("encode", (0, 0.0, 0.0))
+        cost = encoded[2] / encoded[1] if encoded[1] else 0.0
+        saved = 0.0
+        for mode in ("skip", "remux"):
+            count, media, elapsed = by_mode.get(mode, (0, 0.0, 0.0))
+            saved += max(media * cost - elapsed, 0.0)
+        summary = ", ".join(f"{mode} {by_mode.get(mode, (0,))[0]}" for mode in ("skip", "remux", "encode"))
+        return {"by_mode": by_mode, "saved_seconds": saved, "summary": summary, "presets": self._preset_summary()}
+
+    def _preset_summary(self):
+        # Скорость кодирования по пресетам: секунды видео на секунду работы
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT preset, COUNT(*), AVG(threads), SUM(media_seconds), SUM(elapsed) FROM transcodes "
+                "WHERE mode = 'encode' AND preset IS NOT NULL GROUP BY preset ORDER BY COUNT(*) DESC"
+            ).fetchall()
+        return ", ".join(
+            f"{preset} {count} ({media / elapsed if elapsed else 0:.1f}x, ~{threads:.1f} потоков)"
+            for preset, count, threads, media, elapsed in rows
+        )
+
+    def start_heartbeat(self):
+        # Нужен и воркерам задач, и обработчикам обновлений; поток один на процесс
+        if any(t.name == "jobs-heartbeat" for t in self._threads):
+            return
+        t = threading.Thread(target=self._heartbeat_loop, name="jobs-heartbeat", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def _heartbeat_loop(self):
+        last_heartbeat = last_stats = time.monotonic()
+        while True:
+            time.sleep(CANCEL_POLL_SECONDS)
+            try:
+                self.apply_cancellations()
+                if time.monotonic() - last_heartbeat >= JOB_LEASE_SECONDS / 3:
+                    last_heartbeat = time.monotonic()
+                    self.heartbeat()
+                    self.recover()
+                if time.monotonic() - last_stats >= STATS_PUBLISH_SECONDS:
+                    last_stats = time.monotonic()
+                    self.publish_stats()
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка очереди задач: {e}")
+
+    def start_updates(self, handler, workers=UPDATE_WORKERS):
+        """Запускает обработчики обновлений из webhook; handler(payload) обрабатывает одно."""
+        self.start_heartbeat()
+        for i in range(workers):
+            t = threading.Thread(target=self._update_worker, args=(handler,), name=f"update-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _update_worker(self, handler):
+        while True:
+            try:
+                claimed = self.claim_update()
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка очереди обновлений: {e}")
+                claimed = None
+            if claimed is None:
+                with self._cond:
+                    self._cond.wait(timeout=1.0)
+                continue
+            update_id, payload = claimed
+            try:
+                handler(payload)
+            except Exception as e:
+                # Повтор упадёт так же, поэтому обновление всё равно удаляется
+                logging.error(f"Ошибка обработки обновления: {e}")
+            try:
+                self.ack_update(update_id)
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка очереди обновлений: {e}")
+
+    def start(self, handler, workers=DOWNLOAD_WORKERS, role="all"):
+        """
+        Запускает воркеры; handler(chat_id, url) выполняет одну задачу.
+        role — роль процесса в таблице workers: "all" (бот целиком) или "worker".
+        """
+        self.recover()
+        self.register_worker(role, workers)
+        self.start_heartbeat()
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, args=(handler,), name=f"download-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logging.info(f"Запущено воркеров скачивания: {workers}, перекодирования: {TRANSCODE_WORKERS}")
+
+    def stop(self, timeout=None):
+        """
+        Перестаёт брать новые задачи и ждёт, пока воркеры закончат текущие.
+        Возвращает False, если за timeout секунд закончили не все.
+        """
+        self._stopping.set()
+        with self._cond:
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for t in self._threads:
+            if t.name.startswith("download-"):
+                t.join(None if deadline is None else max(deadline - time.monotonic(), 0.0))
+        busy = [t.name for t in self._threads if t.name.startswith("download-") and t.is_alive()]
+        if not busy:
+            self.unregister_worker()
+        return not busy
+
+    def _worker(self, handler):
+        while not self._stopping.is_set():
+            try:
+                job = self.claim()
+            except sqlite3.Error as e:
+                logging.error(f"Ошибка очереди задач: {e}")
+                job = None
+            if job is None:
+                with self._cond:
+                    if not self._stopping.is_set():
+                        self._cond.wait(timeout=JOB_POLL_SECONDS)
+                continue
+            set_current_job(job["id"])
+            open_control(job["id"], on_stage=lambda stage, job_id=job["id"]: self.set_stage(job_id, stage))
+            error = None
+            try:
+                handler(job["chat_id"], job["url"])
+            except Exception as e:
+                logging.error(f"Задача {job['id']} завершилась с ошибкой: {e}")
+                error = str(e)
+            finally:
+                close_control(job["id"])
+                set_current_job(None)
+            self.finish(job["id"], error, job["started_at"])
@@ -0,0 +1,270 @@
+"""
+Метрики в формате Prometheus: счётчики, gauge и гистограммы в памяти процесса.
+Если задан METRICS_PORT, они отдаются по http://METRICS_HOST:METRICS_PORT/metrics;
+если порт занят другим процессом бота, берётся следующий свободный.
+Снимок метрик процесса (snapshot) воркеры публикуют в очередь, а статистика
+владельца складывает снимки всех живых процессов (aggregate).
+"""
+import os
+import time
+import bisect
+import threading
+import logging
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — не поднимать HTTP-эндпоинт
+# Сколько последних значений гистограммы хранить для p50/p95 в статистике
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1000"))
+# Сколько последних значений каждой гистограммы попадает в снимок для других процессов
+METRICS_SNAPSHOT_WINDOW = int(os.getenv("METRICS_SNAPSHOT_WINDOW", "200"))
+# Сколько портов подряд от METRICS_PORT пробовать: у каждого процесса свой эндпоинт
+METRICS_PORT_TRIES = int(os.getenv("METRICS_PORT_TRIES", "16"))
+
+SECONDS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+BYTES_BUCKETS = (100e3, 500e3, 1e6, 5e6, 10e6, 20e6, 50e6, 100e6)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        with self._lock:
+            return sum(v for k, v in self._values.items() if _matches(self.labels, k, labels))
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(self.labels, k)} {v}" for k, v in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """Значение задаётся через set() или считается функцией в момент выгрузки."""
+    kind = "gauge"
+
+    def __init__(self, name, help_text, func=None):
+        super().__init__(name, help_text)
+        self._value = 0
+        self._func = func
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def _samples(self):
+        value = self._value
+        if self._func is not None:
+            try:
+                value = self._func()
+            except Exception as e:
+                logging.warning(f"Метрика {self.name} не посчитана: {e}")
+        return [f"{self.name} {value}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    "counts": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                    "recent": deque(maxlen=METRICS_WINDOW),
+                }
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["recent"].append(value)
+
+    def quantile(self, q, **labels):
+        """Квантиль по последним METRICS_WINDOW значениям подходящих серий (None, если данных нет)."""
+        with self._lock:
+            values = sorted(
+                v for k, s in self._series.items() if _matches(self.labels, k, labels) for v in s["recent"]
+            )
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def snapshot(self, window=None):
+        """Последние значения серий: [[метки, [значения]], ...]."""
+        with self._lock:
+            return [[list(k), list(s["recent"])[-window:] if window else list(s["recent"])]
+                    for k, s in self._series.items()]
+
+    def _samples(self):
+        lines = []
+        for key, series in sorted(self._series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+                total += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                labels = _format_labels(self.labels + ("le",), key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {total}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {series['sum']}")
+            lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+def _matches(names, key, labels):
+    return all(key[names.index(n)] == v for n, v in labels.items())
+
+
+REGISTRY = []
+# Счётчики компонентов процесса для статистики владельца: имя -> функция, возвращающая dict
+STATS_SOURCES = {}
+
+
+def add_stats_source(name, func):
+    STATS_SOURCES[name] = func
+
+
+def snapshot(window=METRICS_SNAPSHOT_WINDOW):
+    """Гистограммы и счётчики компонентов этого процесса в виде, пригодном для JSON."""
+    data = {"histograms": {}, "sources": {}}
+    for metric in REGISTRY:
+        if isinstance(metric, Histogram):
+            data["histograms"][metric.name] = metric.snapshot(window)
+    for name, func in STATS_SOURCES.items():
+        try:
+            data["sources"][name] = func()
+        except Exception as e:
+            logging.warning(f"Статистика {name} не посчитана: {e}")
+    return data
+
+
+class Aggregate:
+    """
+    Сводка по снимкам нескольких процессов: числовые счётчики компонентов
+    складываются, квантили считаются по общей выборке последних значений.
+    """
+
+    def __init__(self, snapshots):
+        self.snapshots = list(snapshots)
+
+    def quantile(self, histogram, q, **labels):
+        values = sorted(
+            v for s in self.snapshots for k, recent in s["histograms"].get(histogram.name, [])
+            if _matches(histogram.labels, tuple(k), labels) for v in recent
+        )
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def source(self, name):
+        total = {}
+        for s in self.snapshots:
+            for key, value in (s["sources"].get(name) or {}).items():
+                if isinstance(value, (int, float)):
+                    total[key] = total.get(key, 0) + value
+        # Доля попаданий не складывается, а пересчитывается по сумме
+        if "hits" in total and "misses" in total:
+            lookups = total["hits"] + total["misses"]
+            total["hit_rate"] = total["hits"] / lookups if lookups else 0.0
+        return total
+
+
+def aggregate(peers=()):
+    """Сводка по этому процессу (все значения окна) и снимкам peers других процессов."""
+    return Aggregate([snapshot(window=None), *peers])
+
+# ---------- Метрики бота ----------
+
+STAGE_SECONDS = Histogram("bot_stage_seconds", "Время этапа конвейера", ("platform", "stage"))
+PIPELINE_TOTAL = Counter("bot_pipeline_total", "Запуски конвейера по платформам", ("platform", "result"))
+JOB_SECONDS = Histogram("bot_job_seconds", "Время обработки ссылки от начала до отправки", ("result",))
+JOBS_TOTAL = Counter("bot_jobs_total", "Обработанные ссылки: downloaded, cached, failed, cancelled, timeout", ("result",))
+JOB_WAIT_SECONDS = Histogram("bot_job_wait_seconds", "Ожидание задачи в очереди")
+OUTPUT_BYTES = Histogram("bot_output_bytes", "Размер отправляемого файла", ("platform", "kind"), BYTES_BUCKETS)
+DOWNLOADED_BYTES = Counter("bot_downloaded_bytes_total", "Скачано байт", ("platform",))
+UPLOADED_BYTES = Counter("bot_uploaded_bytes_total", "Отправлено в Telegram байт", ("platform",))
+ENCODE_PROFILES = Counter("bot_encode_profiles_total", "Выбранные пресеты libx264", ("preset",))
+
+
+def observe_job(result, started):
+    JOBS_TOTAL.inc(result=result)
+    JOB_SECONDS.observe(time.time() - started, result=result)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST, tries=METRICS_PORT_TRIES):
+    if not port:
+        return None
+    for candidate in range(port, port + max(1, tries)):
+        try:
+            server = ThreadingHTTPServer((host, candidate), _MetricsHandler)
+            break
+        except OSError as e:
+            # Порт занят другим процессом бота (воркер gunicorn, worker.py) — пробуем следующий
+            error = e
+    else:
+        logging.warning(f"Метрики не запущены на портах {port}-{port + max(1, tries) - 1}: {error}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Метрики: http://{host}:{candidate}/metrics")
+    return server
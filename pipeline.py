@@ -0,0 +1,838 @@
+import os
+import re
+import asyncio
+import json
+import time
+import shutil
+import struct
+import logging
+import subprocess
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # не POSIX: ffmpeg без nice и rlimit
+    resource = None
+
+import yt_dlp
+
+import metrics
+import encode
+from cache import MetadataCache, post_key_from_info
+from jobs import run_transcode, TRANSCODE_WORKERS, JobCancelled, JobTimeout
+from urls import parse_link, HOST_PLATFORMS
+
+# Общие настройки кодирования для всех платформ
+ENCODE_PRESET = os.getenv("ENCODE_PRESET", "fast")
+ENCODE_CRF = os.getenv("ENCODE_CRF", "23")
+TARGET_WIDTH = 720
+TARGET_HEIGHT = 1280
+INSTAGRAM_COOKIES = os.getenv("INSTAGRAM_COOKIES", "instagram_cookies.txt")
+# Потоковый режим: ролик идёт из сети прямо в stdin ffmpeg, без промежуточного файла
+STREAM_MODE = os.getenv("STREAM_MODE", "0") == "1"
+STREAM_CHUNK_SIZE = 256 * 1024
+# Для потока нужен один прогрессивный http-формат со звуком
+STREAM_FORMAT = 'best[ext=mp4][vcodec!=none][acodec!=none][protocol^=http]'
+# Фото из каруселей отправляются как есть, без ffmpeg
+PHOTO_EXTS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Ограничения на исходник: проверяются по метаданным до скачивания
+MAX_DURATION = int(os.getenv("MAX_DURATION", "600"))  # секунд, 0 — без ограничения
+MAX_FILESIZE = int(os.getenv("MAX_FILESIZE", str(200 * 1024 * 1024)))  # байт, 0 — без ограничения
+# Сколько ждать ответа сервера, прежде чем yt-dlp сочтёт соединение оборванным
+SOCKET_TIMEOUT = int(os.getenv("SOCKET_TIMEOUT", "20"))
+# Сроки этапов, секунд; общий срок задачи — JOB_TIMEOUT в jobs.py
+STAGE_TIMEOUTS = {
+    'extract': int(os.getenv("EXTRACT_TIMEOUT", "60")),
+    'download': int(os.getenv("DOWNLOAD_TIMEOUT", "300")),
+    'probe': int(os.getenv("PROBE_TIMEOUT", "30")),
+    'transcode': int(os.getenv("TRANSCODE_TIMEOUT", "300")),
+    'upload': int(os.getenv("UPLOAD_TIMEOUT", "300")),
+}
+# Ресурсы одного ffmpeg: приоритет и лимит процессорного времени; потоки
+# и пресет libx264 выбирает encode.controller
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", "10"))
+FFMPEG_CPU_SECONDS = int(os.getenv("FFMPEG_CPU_SECONDS", "600"))  # 0 — без ограничения
+
+VERTICAL_FORMAT = (
+    'bestvideo[ext=mp4][height<=1280][width<=720][vcodec!*=none]+'
+    'bestaudio[ext=m4a]/best[ext=mp4][height<=1280][width<=720][vcodec!*=none]/best'
+)
+
+BASE_YDL_OPTS = {
+    'quiet': True,
+    'merge_output_format': 'mp4',
+    'format': VERTICAL_FORMAT,
+    'postprocessors': [],
+    'http_headers': {'User-Agent': 'Mozilla/5.0'},
+    'allow_unplayable_formats': False,
+    'prefer_ffmpeg': True,
+    # Фото в карусели не должно ронять извлечение всего поста
+    'ignore_no_formats_error': True,
+    'socket_timeout': SOCKET_TIMEOUT,
+}
+if MAX_FILESIZE:
+    # На случай, если размер стал известен только при скачивании
+    BASE_YDL_OPTS['max_filesize'] = MAX_FILESIZE
+
+
+class MediaLimitExceeded(Exception):
+    """
+    Исходник длиннее или больше допустимого; текст исключения показывается пользователю.
+    post_text — подпись поста: отказ случается до on_metadata, и подпись ещё не отправлена.
+    """
+    post_text = ""
+
+
+# Повтор задачи или ссылки в течение METADATA_TTL не извлекает пост заново
+metadata_cache = MetadataCache()
+
+
+class MediaJob:
+    """Состояние одной загрузки, которое передаётся между этапами конвейера."""
+
+    def __init__(self, url, platform, tmpdir):
+        self.url = url
+        self.platform = platform
+        self.tmpdir = tmpdir
+        self.ydl = None
+        self.info = None
+        self.post_key = None  # канонический ключ поста по метаданным
+        self.cached = None  # готовый результат, найденный по метаданным; скачивание не нужно
+        self.post_text = ""
+        self.files = []
+        self.probes = []
+        self.outputs = []  # [[тип, путь], ...] в порядке поста
+        self.transcodes = []
+        self.streamed = {}  # путь -> (режим, время, сведения о формате, профиль) для потоковых файлов
+        self.media = []
+        self.timings = {}
+        self.control = None  # jobs.JobControl: отмена и сроки задачи
+
+
+# ---------- Этапы по умолчанию ----------
+
+def extract_stage(job):
+    # Только метаданные: ID, форматы, длительность и подпись; файлы не качаются
+    key = (job.platform.name, job.url)
+    job.info = metadata_cache.get(key)
+    if job.info is None:
+        job.info = job.ydl.extract_info(job.url, download=False)
+        metadata_cache.put(key, job.info)
+    if job.platform.caption:
+        job.post_text = job.info.get('description') or job.info.get('title') or ""
+
+
+def job_entries(job):
+    # Карусель (несколько видео/фото) или одиночное видео
+    return [entry for entry in job.info.get('entries') or [job.info] if entry]
+
+
+def download_stage(job):
+    for entry in job_entries(job):
+        if not entry.get('url') and not entry.get('requested_formats'):
+            # Элемент без видеоформатов — фото, если у него есть картинка
+            filename = download_photo(job, entry)
+        elif STREAM_MODE and stream_entry(job, entry):
+            continue
+        else:
+            job.ydl.process_info(entry)
+            filename = entry.get('filepath') or job.ydl.prepare_filename(entry)
+        if filename and os.path.exists(filename):
+            job.files.append(filename)
+
+
+def metadata_stage(job):
+    """
+    Разбор метаданных до скачивания: канонический ключ поста для кэша
+    и проверка лимитов всех элементов, чтобы не тратить трафик впустую.
+    """
+    job.post_key = post_key_from_info(job.info)
+    try:
+        for entry in job_entries(job):
+            check_limits(entry)
+    except MediaLimitExceeded as e:
+        e.post_text = job.post_text
+        raise
+
+
+def media_duration(job):
+    return sum(entry.get('duration') or 0 for entry in job_entries(job))
+
+
+def check_limits(entry):
+    """Отказывает до скачивания, если длительность или размер превышают лимиты."""
+    duration = entry.get('duration') or 0
+    if MAX_DURATION and duration > MAX_DURATION:
+        limit = f"{MAX_DURATION // 60} мин" if MAX_DURATION >= 60 else f"{MAX_DURATION} с"
+        raise MediaLimitExceeded(f"Видео длиннее {limit} — такие не скачиваю")
+    formats = entry.get('requested_formats') or [entry]
+    size = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in formats)
+    if MAX_FILESIZE and size > MAX_FILESIZE:
+        raise filesize_exceeded()
+
+
+def filesize_exceeded():
+    return MediaLimitExceeded(f"Файл больше {MAX_FILESIZE // (1024 * 1024)} МБ — такие не скачиваю")
+
+
+def download_photo(job, entry):
+    thumbnails = [t for t in entry.get('thumbnails') or [] if t.get('url')]
+    if not thumbnails:
+        logging.warning(f"Элемент {entry.get('id')} без медиа пропущен")
+        return None
+    best = max(thumbnails, key=lambda t: (t.get('width') or 0) * (t.get('height') or 0))
+    filename = os.path.join(job.tmpdir, f"{entry.get('id') or len(job.files)}.jpg")
+    with job.ydl.urlopen(best['url']) as response, open(filename, 'wb') as f:
+        f.write(response.read())
+    return filename
+
+
+def format_info(entry):
+    """
+    Сведения о выбранном формате из метаданных yt-dlp в виде результата probe_media.
+    None, если кодек или размер неизвестны и без ffprobe не обойтись.
+    """
+    vcodec = entry.get('vcodec') or ''
+    acodec = entry.get('acodec') or ''
+    if not vcodec or vcodec == 'none' or not entry.get('width') or not entry.get('height'):
+        return None
+    return {
+        'vcodec': 'h264' if vcodec.startswith(('avc', 'h264')) else vcodec,
+        'acodec': 'aac' if acodec.startswith(('mp4a', 'aac')) else (acodec if acodec not in ('', 'none') else None),
+        'width': entry['width'],
+        'height': entry['height'],
+        'format': entry.get('ext') or '',
+        'duration': float(entry.get('duration') or 0),
+    }
+
+
+def stream_entry(job, entry):
+    """
+    Качает прогрессивный формат прямо в stdin ffmpeg, перекрывая сеть и кодирование.
+    Возвращает False, если поток не подходит (склейка дорожек, неизвестный кодек,
+    файл уже готов к отправке), соединение оборвалось или ffmpeg не смог его
+    прочитать — тогда файл скачивается обычным способом.
+    """
+    info = format_info(entry)
+    if entry.get('requested_formats') or not (entry.get('protocol') or '').startswith('http') or info is None:
+        return False
+    mode = choose_transcode_mode(f"stream.{info['format']}", info)
+    if mode != 'encode' and 'mp4' in info['format']:
+        # Можно ли отправить mp4 как есть (pix_fmt, положение moov), видно только по самому файлу
+        return False
+    new_filename = os.path.join(job.tmpdir, f"{entry.get('id') or len(job.files)}_720.mp4")
+    request = urllib.request.Request(entry['url'], headers=entry.get('http_headers') or {})
+    started = time.time()
+    try:
+        # Соединение и первый блок ждём в потоке задачи: слот пула перекодирования
+        # и потоки кодировщика занимаются, только когда данные уже пошли
+        with job.ydl.urlopen(request) as response:
+            chunk = response.read(STREAM_CHUNK_SIZE)
+            ok, profile = run_transcode(_stream_to_ffmpeg, response, chunk, new_filename, mode, job.control)
+    except (JobCancelled, JobTimeout, MediaLimitExceeded):
+        if os.path.exists(new_filename):
+            os.remove(new_filename)
+        raise
+    except (OSError, urllib.error.URLError) as e:
+        logging.warning(f"Поток {entry.get('id')} оборвался ({e}), качаю файл целиком")
+        if os.path.exists(new_filename):
+            os.remove(new_filename)
+        return False
+    elapsed = time.time() - started
+    if not ok or not os.path.exists(new_filename) or os.path.getsize(new_filename) == 0:
+        logging.warning(f"Потоковое перекодирование {entry.get('id')} не удалось, качаю файл целиком")
+        if os.path.exists(new_filename):
+            os.remove(new_filename)
+        return False
+    logging.info(f"Потоковое перекодирование: {mode}, {info['duration']:.1f} с видео за {elapsed:.1f} с")
+    job.files.append(new_filename)
+    job.streamed[new_filename] = (mode, elapsed, info, profile)
+    return True
+
+
+def _stream_to_ffmpeg(response, chunk, new_filename, mode, control=None):
+    # Пока идёт передача, ffmpeg держит слот пула и потоки кодировщика, даже если сеть
+    # медленнее кодирования: это цена перекрытия скачивания и кодирования. Если сеть
+    # заметно медленнее ffmpeg, обычный режим (STREAM_MODE=0) занимает пул меньше
+    with encode.controller.reserve(mode) as profile:
+        cmd = build_ffmpeg_cmd('pipe:0', new_filename, mode, profile=profile)
+        return _pipe_to_ffmpeg(response, chunk, cmd, control) == 0, profile
+
+
+def _pipe_to_ffmpeg(response, chunk, cmd, control):
+    proc = subprocess.Popen(ffmpeg_command(cmd), stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _limit_ffmpeg(proc)
+    if control:
+        control.register(proc)
+    received = 0
+    try:
+        while chunk:
+            received += len(chunk)
+            # Размер формата мог быть неизвестен при проверке лимитов
+            if MAX_FILESIZE and received > MAX_FILESIZE:
+                raise filesize_exceeded()
+            proc.stdin.write(chunk)
+            if control:
+                control.check()
+            chunk = response.read(STREAM_CHUNK_SIZE)
+    except BrokenPipeError:
+        # ffmpeg завершился раньше (например, moov в конце файла) — решит код возврата
+        pass
+    except Exception:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if control:
+            control.unregister(proc)
+    return _wait_ffmpeg(proc, control)
+
+
+def media_kind(filename):
+    return 'photo' if filename.lower().endswith(PHOTO_EXTS) else 'video'
+
+
+def probe_stage(job):
+    job.probes = [_known_probe(job, f) or (probe_media(f) if media_kind(f) == 'video' else None) for f in job.files]
+
+
+def _known_probe(job, filename):
+    streamed = job.streamed.get(filename)
+    return streamed[2] if streamed else None
+
+
+def transcode_stage(job):
+    # Элементы карусели перекодируются параллельно; общее число ffmpeg
+    # ограничивает пул перекодирования
+    items = list(zip(job.files, job.probes))
+    if len(items) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(items), TRANSCODE_WORKERS)) as pool:
+            results = list(pool.map(lambda item: prepare_output(job, *item), items))
+    else:
+        results = [prepare_output(job, *item) for item in items]
+    _collect_outputs(job, items, results)
+
+
+def prepare_output(job, filename, info):
+    if media_kind(filename) == 'photo':
+        return filename, 'photo', 0.0, None
+    if filename in job.streamed:
+        # Уже перекодирован на лету при скачивании
+        mode, elapsed, _, profile = job.streamed[filename]
+        return filename, mode, elapsed, profile
+    return transcode_for_telegram(filename, info, job.control)
+
+
+def _collect_outputs(job, items, results):
+    for (filename, info), (new_filename, mode, elapsed, profile) in zip(items, results):
+        if mode != 'photo':
+            job.transcodes.append((mode, info['duration'] if info else 0.0, elapsed, profile))
+        if new_filename:
+            job.outputs.append([media_kind(new_filename), new_filename])
+
+
+# ---------- Пробинг и перекодирование ----------
+
+# preexec_fn в многопоточном процессе небезопасен: между fork и exec дочерний процесс
+# может зависнуть на блокировке, которую держал другой поток. Поэтому приоритет задаёт
+# nice в команде, а лимит процессорного времени ставится уже запущенному ffmpeg
+_NICE = shutil.which('nice')
+
+
+def ffmpeg_command(cmd):
+    """Команда ffmpeg с пониженным приоритетом: ffmpeg не отнимает CPU у бота."""
+    if FFMPEG_NICE and _NICE:
+        return [_NICE, '-n', str(FFMPEG_NICE)] + cmd
+    return cmd
+
+
+def _limit_ffmpeg(proc):
+    # nice заменяет себя ffmpeg через exec, pid и лимит остаются теми же
+    if not FFMPEG_CPU_SECONDS or resource is None or not hasattr(resource, 'prlimit'):
+        return
+    try:
+        resource.prlimit(proc.pid, resource.RLIMIT_CPU, (FFMPEG_CPU_SECONDS, FFMPEG_CPU_SECONDS))
+    except OSError as e:
+        # ffmpeg мог уже завершиться
+        logging.warning(f"Не удалось ограничить время CPU ffmpeg: {e}")
+
+
+def _wait_ffmpeg(proc, control):
+    if control:
+        return control.wait(proc)
+    try:
+        return proc.wait(timeout=STAGE_TIMEOUTS['transcode'])
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        raise JobTimeout("Превышено время перекодирования")
+
+
+def _ffmpeg(filename, new_filename, mode, control):
+    # Профиль выбирается, когда ffmpeg уже получил слот пула и вот-вот запустится
+    with encode.controller.reserve(mode) as profile:
+        cmd = build_ffmpeg_cmd(filename, new_filename, mode, profile=profile)
+        proc = subprocess.Popen(ffmpeg_command(cmd), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        _limit_ffmpeg(proc)
+        _wait_ffmpeg(proc, control)
+    return profile
+
+
+def run_ffmpeg(filename, new_filename, mode, control=None):
+    """Запускает ffmpeg в пуле перекодирования и возвращает выбранный профиль (None для remux)."""
+    return run_transcode(_ffmpeg, filename, new_filename, mode, control)
+
+
+def build_probe_cmd(filename):
+    return [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name,width,height,pix_fmt:format=format_name,duration',
+        '-of', 'json', filename
+    ]
+
+
+def probe_media(filename):
+    """
+    Кодеки, размер и длительность файла через ffprobe.
+    Возвращает None, если ffprobe недоступен или не смог прочитать файл.
+    """
+    try:
+        proc = subprocess.run(build_probe_cmd(filename), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              timeout=STAGE_TIMEOUTS['probe'])
+        data = json.loads(proc.stdout or b'{}')
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        logging.warning(f"Ошибка ffprobe: {e}")
+        return None
+    return parse_probe(data)
+
+
+def parse_probe(data):
+    streams = data.get('streams') or []
+    if not streams:
+        return None
+    video = next((s for s in streams if s.get('codec_type') == 'video'), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+    fmt = data.get('format') or {}
+    return {
+        'vcodec': video.get('codec_name'),
+        'acodec': audio.get('codec_name'),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'pix_fmt': video.get('pix_fmt'),
+        'format': fmt.get('format_name') or '',
+        'duration': float(fmt.get('duration') or 0),
+    }
+
+
+def choose_transcode_mode(filename, info):
+    """
+    skip  — файл уже mp4 720x1280 H.264/AAC в yuv420p с moov перед mdat, отправляем как есть;
+    remux — кодеки и размер подходят, меняем только контейнер (-c copy, +faststart);
+    encode — полное перекодирование libx264 со scale+pad.
+    """
+    if not info:
+        return 'encode'
+    if info['vcodec'] != 'h264' or info['acodec'] not in ('aac', None):
+        return 'encode'
+    if (info['width'], info['height']) != (TARGET_WIDTH, TARGET_HEIGHT):
+        return 'encode'
+    # Другой формат пикселей -c copy не исправит; неизвестный (метаданные yt-dlp) — не повод кодировать
+    if info.get('pix_fmt') not in ('yuv420p', None):
+        return 'encode'
+    if (filename.endswith('.mp4') and 'mp4' in info['format'] and info.get('pix_fmt') == 'yuv420p'
+            and mp4_faststart(filename)):
+        return 'skip'
+    return 'remux'
+
+
+def mp4_faststart(filename):
+    """True, если атом moov стоит перед mdat: плееру не нужно дочитывать файл до конца."""
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, kind = struct.unpack('>I4s', header)
+                if kind == b'moov':
+                    return True
+                if kind == b'mdat':
+                    return False
+                if size == 1:
+                    # 64-битный размер сразу после заголовка
+                    size = struct.unpack('>Q', f.read(8))[0] - 8
+                elif size == 0:
+                    # Атом до конца файла, moov за ним быть не может
+                    return False
+                if size < 8:
+                    return False
+                f.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+def build_ffmpeg_cmd(filename, new_filename, mode, profile=None):
+    if mode == 'remux':
+        codec_args = ['-c', 'copy']
+    else:
+        preset = profile['preset'] if profile else ENCODE_PRESET
+        threads = ['-threads', str(profile['threads'])] if profile else []
+        codec_args = [
+            '-vf', (
+                f'scale={TARGET_WIDTH}:{TARGET_HEIGHT}:force_original_aspect_ratio=decrease,'
+                f'pad={TARGET_WIDTH}:{TARGET_HEIGHT}:(ow-iw)/2:(oh-ih)/2:color=black'
+            ),
+            '-c:v', 'libx264', '-preset', preset, '-crf', ENCODE_CRF, '-pix_fmt', 'yuv420p',
+        ] + threads + [
+            '-c:a', 'aac', '-b:a', '128k',
+        ]
+    # Выход всегда файл, даже при чтении из потока, поэтому moov с длительностью
+    # переносится в начало: Telegram показывает длительность и размер ролика
+    return ['ffmpeg', '-y', '-i', filename] + codec_args + ['-movflags', '+faststart', new_filename]
+
+
+def transcode_for_telegram(filename, info, control=None):
+    """
+    Приводит файл к mp4 720x1280 для Telegram, перекодируя только при необходимости.
+    Возвращает (путь к готовому файлу или None, выбранный режим, затраченное время).
+    """
+    mode = choose_transcode_mode(filename, info)
+    started = time.time()
+    profile = None
+    if mode == 'skip':
+        new_filename = filename
+    else:
+        new_filename = os.path.splitext(filename)[0] + '_720.mp4'
+        profile = run_ffmpeg(filename, new_filename, mode, control)
+    return _transcode_result(new_filename, mode, info, time.time() - started, profile)
+
+
+def _transcode_result(new_filename, mode, info, elapsed, profile):
+    used = f" ({profile['preset']}, потоков {profile['threads']})" if profile else ""
+    logging.info(f"Перекодирование: {mode}{used}, {info['duration'] if info else 0:.1f} с видео за {elapsed:.1f} с")
+    if os.path.exists(new_filename) and os.path.getsize(new_filename) > 0:
+        return new_filename, mode, elapsed, profile
+    return None, mode, elapsed, profile
+
+
+# ---------- Асинхронные варианты для asyncio-режима ----------
+
+# Ограничение одновременных ffmpeg в asyncio-режиме (аналог пула перекодирования)
+_async_transcode_slots = asyncio.Semaphore(TRANSCODE_WORKERS)
+# Ожидание потоков encode.controller: свой пул, чтобы не занимать пул по умолчанию,
+# через который идут запросы к SQLite; больше TRANSCODE_WORKERS ожиданий не бывает
+_encode_waits = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix="encode-wait")
+
+
+def _release_late(future):
+    """Возвращает потоки, которые acquire получил уже после отмены ожидавшей его задачи."""
+    if not future.cancelled() and future.exception() is None:
+        encode.controller.release(future.result())
+
+
+async def run_ffmpeg_async(filename, new_filename, mode, control=None):
+    async with _async_transcode_slots:
+        profile = None
+        if mode == 'encode':
+            # acquire может ждать свободных потоков, поэтому не в цикле событий
+            waiting = _encode_waits.submit(encode.controller.acquire)
+            try:
+                profile = await asyncio.wrap_future(waiting)
+            except asyncio.CancelledError:
+                waiting.add_done_callback(_release_late)
+                raise
+        try:
+            await _ffmpeg_async(build_ffmpeg_cmd(filename, new_filename, mode, profile=profile), control)
+        finally:
+            if profile:
+                encode.controller.release(profile)
+        return profile
+
+
+async def _ffmpeg_async(cmd, control):
+    proc = await asyncio.create_subprocess_exec(
+        *ffmpeg_command(cmd), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    _limit_ffmpeg(proc)
+    if control:
+        control.register(proc)
+    timeout = control.remaining() if control else STAGE_TIMEOUTS['transcode']
+    try:
+        await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        if not control:
+            raise JobTimeout("Превышено время перекодирования")
+    finally:
+        if control:
+            control.unregister(proc)
+    if control:
+        control.check()
+    return proc.returncode
+
+
+async def probe_media_async(filename):
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *build_probe_cmd(filename), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await asyncio.wait_for(proc.communicate(), STAGE_TIMEOUTS['probe'])
+        data = json.loads(stdout or b'{}')
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        logging.warning(f"ffprobe не уложился в {STAGE_TIMEOUTS['probe']} с: {filename}")
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ошибка ffprobe: {e}")
+        return None
+    return parse_probe(data)
+
+
+async def transcode_for_telegram_async(filename, info, control=None):
+    mode = choose_transcode_mode(filename, info)
+    started = time.time()
+    profile = None
+    if mode == 'skip':
+        new_filename = filename
+    else:
+        new_filename = os.path.splitext(filename)[0] + '_720.mp4'
+        profile = await run_ffmpeg_async(filename, new_filename, mode, control)
+    return _transcode_result(new_filename, mode, info, time.time() - started, profile)
+
+
+async def probe_stage_async(job):
+    async def probe(filename):
+        known = _known_probe(job, filename)
+        if known or media_kind(filename) != 'video':
+            return known
+        return await probe_media_async(filename)
+
+    job.probes = list(await asyncio.gather(*(probe(f) for f in job.files)))
+
+
+async def prepare_output_async(job, filename, info):
+    if media_kind(filename) == 'photo' or filename in job.streamed:
+        return prepare_output(job, filename, info)
+    return await transcode_for_telegram_async(filename, info, job.control)
+
+
+async def transcode_stage_async(job):
+    # Параллельность ограничивает _async_transcode_slots
+    items = list(zip(job.files, job.probes))
+    results = await asyncio.gather(*(prepare_output_async(job, *item) for item in items))
+    _collect_outputs(job, items, results)
+
+
+# ---------- Платформы ----------
+
+class Platform:
+    """
+    Платформа: шаблон ссылки, настройки yt-dlp и этапы конвейера.
+    Любой этап можно заменить своей функцией, принимающей MediaJob.
+    """
+
+    def __init__(self, name, pattern, ydl_opts=None, caption=True,
+                 extract=extract_stage, download=download_stage,
+                 probe=probe_stage, transcode=transcode_stage, upload=None):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.ydl_opts = ydl_opts or {}
+        self.caption = caption
+        self.extract = extract
+        self.download = download
+        self.probe = probe
+        self.transcode = transcode
+        self.upload = upload
+
+    def matches(self, url):
+        return self.pattern.search(url) is not None
+
+    def build_ydl_opts(self, tmpdir, control=None):
+        opts = dict(BASE_YDL_OPTS)
+        opts['outtmpl'] = os.path.join(tmpdir, '%(id)s.%(ext)s')
+        opts.update(self.ydl_opts)
+        if STREAM_MODE:
+            # Предпочитаем формат, который можно читать потоком, иначе — обычный выбор
+            opts['format'] = f"{STREAM_FORMAT}/{opts['format']}"
+        if control:
+            # Отмена и срок скачивания проверяются на каждом блоке
+            opts['progress_hooks'] = list(opts.get('progress_hooks') or []) + [control.progress_hook]
+        return opts
+
+
+PLATFORMS = []
+_platforms_by_name = {}
+
+
+def register_platform(platform):
+    PLATFORMS.append(platform)
+    _platforms_by_name.setdefault(platform.name, platform)
+    return platform
+
+
+def detect_platform(url):
+    """
+    Платформа ссылки: известные хосты классифицирует urls.parse_link (результат
+    кэшируется), шаблоны перебираются только для платформ, которых там нет.
+    Шаблоны instagram/tiktok/pinterest не якорены на хост и совпали бы
+    с notinstagram.com или ?u=instagram.com, поэтому для них решает только хост.
+    """
+    platform = _platforms_by_name.get(parse_link(url).platform)
+    if platform is not None:
+        return platform
+    for platform in PLATFORMS:
+        if platform.name not in HOST_PLATFORMS and platform.matches(url):
+            return platform
+    return None
+
+
+register_platform(Platform(
+    'instagram', r'(https?://)?(www\.)?(instagram\.com|instagr\.am)/',
+    # Требует файл cookies залогиненного аккаунта Instagram
+    ydl_opts={'cookiefile': INSTAGRAM_COOKIES},
+))
+register_platform(Platform(
+    'tiktok', r'(https?://)?(www\.)?tiktok\.com/',
+))
+register_platform(Platform(
+    'pinterest', r'(https?://)?(www\.)?pinterest\.',
+    ydl_opts={
+        'format': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+        'noplaylist': True,
+    },
+    caption=False,
+))
+
+
+# ---------- Запуск ----------
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _record_metrics(job, ok):
+    platform = job.platform.name
+    for stage, seconds in job.timings.items():
+        metrics.STAGE_SECONDS.observe(seconds, platform=platform, stage=stage)
+    metrics.PIPELINE_TOTAL.inc(platform=platform, result="cached" if job.cached else "ok" if ok else "error")
+    metrics.DOWNLOADED_BYTES.inc(sum(_file_size(f) for f in job.files), platform=platform)
+    if ok:
+        for kind, path in job.outputs:
+            size = _file_size(path)
+            metrics.OUTPUT_BYTES.observe(size, platform=platform, kind=kind)
+            metrics.UPLOADED_BYTES.inc(size, platform=platform)
+    timings = ", ".join(f"{stage} {seconds:.1f} с" for stage, seconds in job.timings.items())
+    logging.info(f"Этапы {platform}: {timings}")
+
+
+def _start_stage(job, stage):
+    if job.control:
+        job.control.start_stage(stage, STAGE_TIMEOUTS.get(stage))
+
+
+def _timed(job, stage, func):
+    _start_stage(job, stage)
+    started = time.time()
+    try:
+        return func(job)
+    finally:
+        job.timings[stage] = time.time() - started
+
+
+def run_pipeline(url, tmpdir, upload, platform=None, control=None, on_metadata=None):
+    """
+    extractor -> downloader -> probe -> transcode -> uploader.
+    upload(job) отправляет job.outputs ([[тип, путь], ...]) и возвращает [[тип, file_id], ...].
+    control (jobs.JobControl) задаёт сроки этапов и позволяет отменить задачу.
+    on_metadata(job) вызывается после извлечения метаданных, до скачивания; если он
+    вернёт готовый результат, конвейер останавливается и результат лежит в job.cached.
+    Возвращает MediaJob с результатами и временем каждого этапа.
+    """
+    platform = platform or detect_platform(url)
+    if platform is None:
+        raise ValueError(f"Платформа не поддерживается: {url}")
+    job = MediaJob(url, platform, tmpdir)
+    job.control = control
+    ok = False
+    try:
+        with yt_dlp.YoutubeDL(platform.build_ydl_opts(tmpdir, control)) as ydl:
+            job.ydl = ydl
+            _timed(job, 'extract', platform.extract)
+            metadata_stage(job)
+            if on_metadata:
+                job.cached = on_metadata(job)
+            if job.cached:
+                ok = True
+                return job
+            _timed(job, 'download', platform.download)
+        _timed(job, 'probe', platform.probe)
+        _timed(job, 'transcode', platform.transcode)
+        if not job.outputs:
+            raise Exception("No media files found")
+        job.media = _timed(job, 'upload', platform.upload or upload)
+        ok = True
+    finally:
+        _record_metrics(job, ok)
+    return job
+
+
+async def _timed_async(job, stage, coro_func):
+    _start_stage(job, stage)
+    started = time.time()
+    try:
+        return await coro_func(job)
+    finally:
+        job.timings[stage] = time.time() - started
+
+
+async def run_pipeline_async(url, tmpdir, upload, platform=None, executor=None, control=None, on_metadata=None):
+    """
+    То же, что run_pipeline, но для asyncio: yt-dlp выполняется в executor,
+    ffprobe/ffmpeg — через asyncio.create_subprocess_exec, upload(job) и
+    on_metadata(job) — корутины. Нестандартные этапы платформы выполняются в executor.
+    """
+    platform = platform or detect_platform(url)
+    if platform is None:
+        raise ValueError(f"Платформа не поддерживается: {url}")
+    job = MediaJob(url, platform, tmpdir)
+    job.control = control
+    loop = asyncio.get_running_loop()
+
+    def in_executor(func):
+        return lambda j: loop.run_in_executor(executor, func, j)
+
+    ok = False
+    try:
+        with yt_dlp.YoutubeDL(platform.build_ydl_opts(tmpdir, control)) as ydl:
+            job.ydl = ydl
+            await _timed_async(job, 'extract', in_executor(platform.extract))
+            metadata_stage(job)
+            if on_metadata:
+                job.cached = await on_metadata(job)
+            if job.cached:
+                ok = True
+                return job
+            await _timed_async(job, 'download', in_executor(platform.download))
+        probe = probe_stage_async if platform.probe is probe_stage else in_executor(platform.probe)
+        transcode = transcode_stage_async if platform.transcode is transcode_stage else in_executor(platform.transcode)
+        await _timed_async(job, 'probe', probe)
+        await _timed_async(job, 'transcode', transcode)
+        if not job.outputs:
+            raise Exception("No media files found")
+        job.media = await _timed_async(job, 'upload', upload)
+        ok = True
+    finally:
+        _record_metrics(job, ok)
+    return job
@@ -0,0 +1,288 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота, около 1 в секунду
+# в личный чат и 20 в минуту в группу
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_429_RETRIES = int(os.getenv("TELEGRAM_429_RETRIES", "3"))
+# Сколько токенов общего лимита процесс забирает из общего bucket за одно обращение к SQLite
+TELEGRAM_SHARED_BATCH = int(os.getenv("TELEGRAM_SHARED_BATCH", "3"))
+
+# Приоритеты: статусы и доставка видео идут раньше рекламных сообщений
+HIGH = 0
+LOW = 1
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now):
+        """Через сколько секунд будет доступен токен (0 — уже доступен)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SharedTokenBucket:
+    """
+    Token bucket, общий для всех процессов бота: токены хранятся в store
+    (JobQueue.take_tokens), процесс забирает их пачками по batch и тратит локально.
+    Если общее хранилище недоступно, процесс ограничивает себя локальным bucket.
+    """
+
+    def __init__(self, store, name, rate, capacity, batch=TELEGRAM_SHARED_BATCH):
+        self.store = store
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.batch = max(1, min(batch, int(capacity) or 1))
+        self.tokens = 0
+        self.updated = time.monotonic()
+        self._fallback = TokenBucket(rate, capacity)
+
+    def delay(self, now):
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        try:
+            taken, wait = self.store.take_tokens(self.name, self.rate, self.capacity, self.batch)
+        except Exception as e:
+            logging.warning(f"Общий лимит {self.name} недоступен, считаю локально: {e}")
+            wait = self._fallback.delay(now)
+            if wait <= 0:
+                self._fallback.take()
+                self.tokens += 1
+            return wait
+        self.tokens += taken
+        return 0.0 if self.tokens >= 1 else wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """После 429 на весь бот останавливает отправку во всех процессах."""
+        self.tokens = 0
+        try:
+            self.store.drain_tokens(self.name, self.rate, seconds)
+        except Exception as e:
+            logging.warning(f"Общий лимит {self.name} недоступен: {e}")
+
+
+def _rewind_files(values):
+    """Перематывает загружаемые файлы (в том числе внутри InputMedia) перед повтором запроса."""
+    for value in values:
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            item = getattr(item, 'media', item)
+            if hasattr(item, 'seek'):
+                item.seek(0)
+
+
+class TelegramRateLimiter:
+    """
+    Общий и по-чатовый token bucket для исходящих запросов к Bot API.
+    Запрос с приоритетом LOW пропускает вперёд запросы HIGH, которые ждут того же
+    ресурса: токена общего лимита или своего чата. HIGH, ждущий лимита другого
+    чата, LOW не задерживает.
+    После ответа 429 чат (или весь бот) блокируется на retry_after секунд.
+    После use_shared_budget общий лимит делят все процессы бота, а лимиты чатов
+    остаются у каждого процесса свои.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, group_rate=TELEGRAM_GROUP_RATE):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._blocked_until = {}
+        # Ждущие HIGH по чатам и те из них, кого держит только общий лимит
+        self._high_chats = {}
+        self._high_global = 0
+        self._cond = threading.Condition()
+        self.throttled = 0
+        self.retries = 0
+
+    def use_shared_budget(self, store, name="telegram"):
+        """Берёт токены общего лимита из store, общего для процессов (см. SharedTokenBucket)."""
+        with self._cond:
+            self._global = SharedTokenBucket(store, name, self._global.rate, self._global.capacity)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательный chat_id — группа или канал
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > 10000:
+                self._drop_idle_buckets()
+        return bucket
+
+    def _drop_idle_buckets(self):
+        now = time.monotonic()
+        for key in [k for k, b in self._chats.items() if now - b.updated > 60]:
+            del self._chats[key]
+
+    def _enter(self, chat_id, priority):
+        """Под self._cond: регистрирует ждущий запрос HIGH; возвращает его состояние."""
+        if priority != HIGH:
+            return None
+        self._high_chats[chat_id] = self._high_chats.get(chat_id, 0) + 1
+        return {"chat_id": chat_id, "global": False}
+
+    def _leave(self, waiter):
+        if waiter is None:
+            return
+        chat_id = waiter["chat_id"]
+        self._high_chats[chat_id] -= 1
+        if not self._high_chats[chat_id]:
+            del self._high_chats[chat_id]
+        if waiter["global"]:
+            self._high_global -= 1
+        self._cond.notify_all()
+
+    def _try_acquire(self, chat_id, priority, waiter=None):
+        """Под self._cond: забирает токены или возвращает, сколько ещё ждать."""
+        now = time.monotonic()
+        global_wait = max(self._blocked_until.get(None, 0) - now, self._global.delay(now))
+        chat_wait = max(
+            self._blocked_until.get(chat_id, 0) - now,
+            self._chat_bucket(chat_id).delay(now),
+        ) if chat_id is not None else 0
+        wait = max(global_wait, chat_wait)
+        if waiter is not None:
+            # Конкурирует с LOW за общий токен, только если свой чат уже свободен
+            competing = global_wait > 0 and chat_wait <= 0
+            if competing != waiter["global"]:
+                self._high_global += 1 if competing else -1
+                waiter["global"] = competing
+        if priority == LOW and (self._high_global or self._high_chats.get(chat_id)):
+            wait = max(wait, 0.05)
+        if wait <= 0:
+            self._global.take()
+            if chat_id is not None:
+                self._chat_bucket(chat_id).take()
+        return wait
+
+    def acquire(self, chat_id=None, priority=HIGH):
+        with self._cond:
+            waiter = self._enter(chat_id, priority)
+            try:
+                throttled = False
+                while True:
+                    wait = self._try_acquire(chat_id, priority, waiter)
+                    if wait <= 0:
+                        break
+                    throttled = True
+                    self._cond.wait(wait)
+                if throttled:
+                    self.throttled += 1
+            finally:
+                self._leave(waiter)
+
+    async def acquire_async(self, chat_id=None, priority=HIGH):
+        with self._cond:
+            waiter = self._enter(chat_id, priority)
+        try:
+            throttled = False
+            while True:
+                with self._cond:
+                    wait = self._try_acquire(chat_id, priority, waiter)
+                if wait <= 0:
+                    break
+                throttled = True
+                await asyncio.sleep(wait)
+            if throttled:
+                self.throttled += 1
+        finally:
+            with self._cond:
+                self._leave(waiter)
+
+    def backoff(self, error, chat_id=None):
+        """Учитывает 429: блокирует чат (или весь бот) на retry_after секунд."""
+        retry_after = (error.result_json.get('parameters') or {}).get('retry_after', 1)
+        with self._cond:
+            self._blocked_until[chat_id] = time.monotonic() + retry_after
+            self.retries += 1
+            if chat_id is None and isinstance(self._global, SharedTokenBucket):
+                self._global.block(retry_after)
+        logging.warning(f"Telegram 429 для чата {chat_id}, повтор через {retry_after} с")
+
+    def call(self, chat_id, priority, func, *args, **kwargs):
+        for attempt in range(TELEGRAM_429_RETRIES + 1):
+            self.acquire(chat_id, priority)
+            try:
+                return func(*args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt == TELEGRAM_429_RETRIES:
+                    raise
+                self.backoff(e, chat_id)
+                _rewind_files(list(args) + list(kwargs.values()))
+
+    async def call_async(self, chat_id, priority, func, *args, **kwargs):
+        for attempt in range(TELEGRAM_429_RETRIES + 1):
+            await self.acquire_async(chat_id, priority)
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, 'error_code', None) != 429 or attempt == TELEGRAM_429_RETRIES:
+                    raise
+                self.backoff(e, chat_id)
+                _rewind_files(list(args) + list(kwargs.values()))
+
+    def stats(self):
+        return {"throttled": self.throttled, "retries": self.retries, "chats": len(self._chats)}
+
+
+class RateLimitedTeleBot(telebot.TeleBot):
+    """TeleBot, у которого исходящие сообщения проходят через TelegramRateLimiter."""
+
+    def __init__(self, token, *args, limiter=None, **kwargs):
+        super().__init__(token, *args, **kwargs)
+        self.limiter = limiter or TelegramRateLimiter()
+
+    def send_message(self, chat_id, text, *args, priority=HIGH, **kwargs):
+        return self.limiter.call(chat_id, priority, super().send_message, chat_id, text, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, *args, priority=HIGH, **kwargs):
+        return self.limiter.call(chat_id, priority, super().edit_message_text, text, chat_id, *args, **kwargs)
+
+    def send_video(self, chat_id, video, *args, priority=HIGH, **kwargs):
+        return self.limiter.call(chat_id, priority, super().send_video, chat_id, video, *args, **kwargs)
+
+    def send_photo(self, chat_id, photo, *args, priority=HIGH, **kwargs):
+        return self.limiter.call(chat_id, priority, super().send_photo, chat_id, photo, *args, **kwargs)
+
+    def send_media_group(self, chat_id, media, *args, priority=HIGH, **kwargs):
+        return self.limiter.call(chat_id, priority, super().send_media_group, chat_id, media, *args, **kwargs)
+
+    def send_chat_action(self, chat_id, action, *args, priority=LOW, **kwargs):
+        return self.limiter.call(chat_id, priority, super().send_chat_action, chat_id, action, *args, **kwargs)
+
+    def get_chat_member(self, chat_id, user_id, *args, priority=HIGH, **kwargs):
+        # Не сообщение в чат, поэтому учитывается только общий лимит
+        return self.limiter.call(None, priority, super().get_chat_member, chat_id, user_id, *args, **kwargs)
+
+    def answer_callback_query(self, callback_query_id, *args, priority=HIGH, **kwargs):
+        return self.limiter.call(None, priority, super().answer_callback_query, callback_query_id, *args, **kwargs)
@@ -0,0 +1,255 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import openai
+
+from cache import CACHE_DB
+from ratelimit import TokenBucket, SharedTokenBucket
+from singleflight import SingleFlight
+
+REWRITE_MODEL = os.getenv("REWRITE_MODEL", "gpt-3.5-turbo")
+# Одновременных запросов к OpenAI; остальные ждут в очереди пула
+REWRITE_WORKERS = int(os.getenv("REWRITE_WORKERS", "4"))
+REWRITE_TIMEOUT = float(os.getenv("REWRITE_TIMEOUT", "30"))
+# Рерайт одного и того же текста одним промптом не меняется, храним долго
+REWRITE_CACHE_TTL = int(os.getenv("REWRITE_CACHE_TTL", str(7 * 24 * 3600)))
+REWRITE_CACHE_MAX_ENTRIES = int(os.getenv("REWRITE_CACHE_MAX_ENTRIES", "10000"))
+# Не больше REWRITE_USER_LIMIT рерайтов за REWRITE_USER_WINDOW секунд на пользователя
+REWRITE_USER_LIMIT = int(os.getenv("REWRITE_USER_LIMIT", "5"))
+REWRITE_USER_WINDOW = int(os.getenv("REWRITE_USER_WINDOW", "600"))
+# Делать рерайт заранее, сразу после доставки видео, чтобы /rewrite отвечал мгновенно.
+# Каждый такой рерайт — платный запрос к OpenAI, поэтому по умолчанию выключено
+REWRITE_SPECULATIVE = os.getenv("REWRITE_SPECULATIVE", "0") == "1"
+# Заранее переписываются посты только в чатах, где /rewrite вызывали за последние N секунд
+REWRITE_PREFETCH_RECENT = int(os.getenv("REWRITE_PREFETCH_RECENT", str(24 * 3600)))
+# Общий бюджет: не больше REWRITE_PREFETCH_LIMIT рерайтов заранее за REWRITE_PREFETCH_WINDOW секунд
+REWRITE_PREFETCH_LIMIT = int(os.getenv("REWRITE_PREFETCH_LIMIT", "100"))
+REWRITE_PREFETCH_WINDOW = int(os.getenv("REWRITE_PREFETCH_WINDOW", "3600"))
+
+
+class RewriteCache:
+    """Готовые рерайты по хэшу модели, промпта и текста поста."""
+
+    def __init__(self, path=CACHE_DB, ttl=REWRITE_CACHE_TTL, max_entries=REWRITE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rewrites ("
+                "key TEXT PRIMARY KEY, "
+                "rewritten TEXT NOT NULL, "
+                "created_at REAL NOT NULL)"
+            )
+            # Когда в чате последний раз вызывали /rewrite
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rewrite_chats ("
+                "chat_id INTEGER PRIMARY KEY, "
+                "used_at REAL NOT NULL)"
+            )
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT rewritten FROM rewrites WHERE key = ? AND created_at >= ?", (key, time.time() - self.ttl)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, rewritten):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rewrites (key, rewritten, created_at) VALUES (?, ?, ?)",
+                (key, rewritten, time.time())
+            )
+            self._conn.execute(
+                "DELETE FROM rewrites WHERE key IN ("
+                "SELECT key FROM rewrites ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def mark_used(self, chat_id):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rewrite_chats (chat_id, used_at) VALUES (?, ?)", (chat_id, time.time())
+            )
+
+    def used_since(self, chat_id, since):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM rewrite_chats WHERE chat_id = ? AND used_at >= ?", (chat_id, since)
+            ).fetchone()
+        return row is not None
+
+
+class Rewriter:
+    """
+    Рерайт постов через OpenAI в ограниченном пуле потоков, чтобы долгий
+    запрос не блокировал обработку обновлений. Одинаковые тексты (вирусный
+    пост у многих пользователей) переписываются один раз: результат берётся
+    из кэша, а одновременные запросы объединяются.
+    """
+
+    def __init__(self, prompt, model=REWRITE_MODEL, workers=REWRITE_WORKERS, cache=None,
+                 user_limit=REWRITE_USER_LIMIT, user_window=REWRITE_USER_WINDOW, speculative=REWRITE_SPECULATIVE,
+                 prefetch_limit=REWRITE_PREFETCH_LIMIT, prefetch_window=REWRITE_PREFETCH_WINDOW):
+        self.prompt = prompt
+        self.model = model
+        self.workers = workers
+        self.cache = cache or RewriteCache()
+        self.user_limit = user_limit
+        self.user_window = user_window
+        self.speculative = speculative
+        self._prefetch_budget = TokenBucket(prefetch_limit / prefetch_window, prefetch_limit)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rewrite")
+        self._flights = SingleFlight()
+        self._users = {}
+        self._lock = threading.Lock()
+        self._pending = 0  # рерайтов, ждущих результата
+        self._leaders = 0  # из них запросов к OpenAI в пуле
+        self.api_calls = 0
+        self.cache_hits = 0
+        self.prefetched = 0
+        self.limited = 0
+
+    def use_shared_budget(self, store):
+        """Бюджет рерайтов заранее берётся из store, общего для процессов бота."""
+        budget = self._prefetch_budget
+        with self._lock:
+            self._prefetch_budget = SharedTokenBucket(store, "rewrite_prefetch", budget.rate, budget.capacity, batch=1)
+
+    def mark_used(self, chat_id):
+        """Отмечает вызов /rewrite в чате: следующие посты этого чата можно переписывать заранее."""
+        self.cache.mark_used(chat_id)
+
+    def cache_key(self, text):
+        return hashlib.sha256(f"{self.model}\n{self.prompt}\n{text.strip()}".encode()).hexdigest()
+
+    def cached(self, text):
+        rewritten = self.cache.get(self.cache_key(text))
+        if rewritten is not None:
+            with self._lock:
+                self.cache_hits += 1
+        return rewritten
+
+    def allow(self, user_id):
+        """0, если пользователь может сделать рерайт (попытка засчитывается), иначе секунды ожидания."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(self.user_limit / self.user_window, self.user_limit)
+                if len(self._users) > 10000:
+                    self._users.pop(next(iter(self._users)))
+            wait = bucket.delay(now)
+            if wait:
+                self.limited += 1
+                return wait
+            bucket.take()
+            return 0.0
+
+    def rewrite(self, text):
+        """Блокирующий рерайт: из кэша или одним запросом к OpenAI на одинаковый текст."""
+        key = self.cache_key(text)
+        rewritten = self.cache.get(key)
+        if rewritten is not None:
+            return rewritten
+        return self._flights.do(key, lambda: self._request(key, text))
+
+    def _request(self, key, text):
+        response = openai.ChatCompletion.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": self.prompt},
+                {"role": "user", "content": text}
+            ],
+            max_tokens=256,
+            temperature=1.0,
+            request_timeout=REWRITE_TIMEOUT,
+        )
+        with self._lock:
+            self.api_calls += 1
+        rewritten = response.choices[0].message.content.strip()
+        self.cache.put(key, rewritten)
+        return rewritten
+
+    def submit(self, text, callback=None):
+        """
+        Ставит рерайт в пул и возвращает Future с результатом.
+        callback(rewritten, error), если задан, вызывается из потока пула.
+        Ожидающие того же текста поток пула не занимают.
+        """
+        future = Future()
+        key = self.cache_key(text)
+
+        def done(result, error):
+            with self._lock:
+                self._pending -= 1
+            if callback:
+                callback(result, error)
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        with self._lock:
+            self._pending += 1
+        if self._flights.join(key, done):
+            with self._lock:
+                self._leaders += 1
+            self.pool.submit(self._lead, key, text, done)
+        return future
+
+    def _lead(self, key, text, done):
+        try:
+            result = self.cache.get(key)
+            if result is None:
+                result = self._request(key, text)
+        except Exception as e:
+            self._flights.finish(key, error=e)
+            done(None, e)
+            return
+        finally:
+            with self._lock:
+                self._leaders -= 1
+        self._flights.finish(key, result)
+        done(result, None)
+
+    def prefetch(self, text, chat_id):
+        """
+        Заранее переписывает текст для чата, где недавно вызывали /rewrite,
+        если пул не занят запросами пользователей и не исчерпан общий бюджет.
+        """
+        if not self.speculative or not text or not text.strip():
+            return
+        if not self.cache.used_since(chat_id, time.time() - REWRITE_PREFETCH_RECENT):
+            return
+        if self.cache.get(self.cache_key(text)) is not None:
+            return
+        with self._lock:
+            if self._leaders >= self.workers or self._prefetch_budget.delay(time.monotonic()) > 0:
+                return
+            self._prefetch_budget.take()
+            self.prefetched += 1
+
+        def log_error(result, error):
+            if error:
+                logging.warning(f"Предварительный рерайт не удался: {error}")
+
+        self.submit(text, log_error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "api_calls": self.api_calls,
+                "cache_hits": self.cache_hits,
+                "prefetched": self.prefetched,
+                "limited": self.limited,
+                "pending": self._pending,
+            }
@@ -0,0 +1,66 @@
+import threading
+import logging
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные задачи с одинаковым ключом: работу выполняет
+    только первый (ведущий), остальные получают его результат или ошибку.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+        # Сколько вызовов получили чужой результат вместо собственной работы
+        self.coalesced = 0
+
+    def join(self, key, callback):
+        """
+        Возвращает True, если вызывающий стал ведущим и должен выполнить работу
+        и затем вызвать finish(). Иначе callback(result, error) будет вызван
+        при завершении работы ведущего.
+        """
+        with self._lock:
+            if key in self._waiters:
+                self._waiters[key].append(callback)
+                self.coalesced += 1
+                return False
+            self._waiters[key] = []
+            return True
+
+    def finish(self, key, result=None, error=None):
+        with self._lock:
+            waiters = self._waiters.pop(key, [])
+        if waiters:
+            logging.info(f"Результат {key} разослан ожидающим: {len(waiters)}")
+        for callback in waiters:
+            try:
+                callback(result, error)
+            except Exception as e:
+                logging.error(f"Ошибка при отправке общего результата {key}: {e}")
+
+    def do(self, key, func):
+        """Блокирующий вариант: выполняет func() один раз на ключ и возвращает общий результат."""
+        done = threading.Event()
+        outcome = {}
+
+        def callback(result, error):
+            outcome['result'], outcome['error'] = result, error
+            done.set()
+
+        if not self.join(key, callback):
+            done.wait()
+            if outcome['error']:
+                raise outcome['error']
+            return outcome['result']
+        try:
+            result = func()
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._waiters)
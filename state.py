@@ -0,0 +1,286 @@
+import os
+import sqlite3
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")  # sqlite или memory
+STATE_DB = os.getenv("STATE_DB", "state.sqlite3")
+# Несколько файлов/блокировок, чтобы потоки разных чатов не ждали друг друга
+STATE_SHARDS = int(os.getenv("STATE_SHARDS", "4"))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "100000"))
+# Текст поста нужен только для /rewrite и подписи, долго его не храним
+POST_TTL = int(os.getenv("POST_TTL", "86400"))
+# Если загрузка не закончилась за это время (процесс упал), пользователь
+# снова может прислать ссылку
+DOWNLOAD_STATE_TTL = int(os.getenv("DOWNLOAD_STATE_TTL", "1800"))
+# Каждые N переходов состояния SQLite-хранилище стирает устаревшие посты и зависшие загрузки
+STATE_PURGE_EVERY = int(os.getenv("STATE_PURGE_EVERY", "1000"))
+
+WAITING_FOR_LINK = 'WAITING_FOR_LINK'
+WAITING_FOR_DOWNLOAD = 'WAITING_FOR_DOWNLOAD'
+
+
+def _effective_state(state, state_at, now, download_ttl):
+    if state == WAITING_FOR_DOWNLOAD and state_at is not None and now - state_at > download_ttl:
+        return WAITING_FOR_LINK
+    return state
+
+
+class MemoryStateStore:
+    """
+    Состояние чатов в памяти процесса: LRU по чатам, разбитый на шарды
+    со своими блокировками. Подходит для одного процесса.
+    """
+
+    def __init__(self, max_entries=STATE_MAX_ENTRIES, post_ttl=POST_TTL,
+                 download_ttl=DOWNLOAD_STATE_TTL, shards=STATE_SHARDS):
+        self.post_ttl = post_ttl
+        self.download_ttl = download_ttl
+        self._max_per_shard = max(1, max_entries // shards)
+        self._shards = [(OrderedDict(), threading.Lock()) for _ in range(shards)]
+
+    def _shard(self, chat_id):
+        return self._shards[chat_id % len(self._shards)]
+
+    def _record(self, entries, chat_id, now, create=False):
+        record = entries.get(chat_id)
+        if record is None:
+            if not create:
+                return None
+            record = {'state': None, 'state_at': None, 'link': None, 'post': '', 'post_at': None, 'messages': 0}
+            entries[chat_id] = record
+            while len(entries) > self._max_per_shard:
+                entries.popitem(last=False)
+        entries.move_to_end(chat_id)
+        if record['post'] and now - record['post_at'] > self.post_ttl:
+            record['post'] = ''
+        state = _effective_state(record['state'], record['state_at'], now, self.download_ttl)
+        if state != record['state']:
+            record['state'], record['link'] = state, None
+        return record
+
+    def _set(self, record, now, fields):
+        if 'state' in fields:
+            record['state_at'] = now
+        if 'post' in fields:
+            record['post_at'] = now
+            fields['post'] = fields['post'] or ''
+        record.update(fields)
+
+    def get_state(self, chat_id):
+        entries, lock = self._shard(chat_id)
+        with lock:
+            record = self._record(entries, chat_id, time.time())
+            return record['state'] if record else None
+
+    def set_state(self, chat_id, state):
+        self.transition(chat_id, state)
+
+    def transition(self, chat_id, state, unless=(), **fields):
+        """
+        Атомарно переводит чат в state, если текущее состояние не входит в unless.
+        Вместе с состоянием можно записать link и post. Возвращает True, если перевод выполнен.
+        """
+        entries, lock = self._shard(chat_id)
+        now = time.time()
+        with lock:
+            record = self._record(entries, chat_id, now, create=True)
+            if record['state'] in unless:
+                return False
+            self._set(record, now, dict(fields, state=state))
+            return True
+
+    def reset(self, chat_id):
+        """Чат снова ждёт ссылку, прошлые ссылка и пост забыты."""
+        self.transition(chat_id, WAITING_FOR_LINK, link=None, post='')
+
+    def get_post(self, chat_id):
+        entries, lock = self._shard(chat_id)
+        with lock:
+            record = self._record(entries, chat_id, time.time())
+            return record['post'] if record else ''
+
+    def set_post(self, chat_id, post):
+        entries, lock = self._shard(chat_id)
+        now = time.time()
+        with lock:
+            self._set(self._record(entries, chat_id, now, create=True), now, {'post': post})
+
+    def increment_messages(self, chat_id):
+        entries, lock = self._shard(chat_id)
+        with lock:
+            self._record(entries, chat_id, time.time(), create=True)['messages'] += 1
+
+    def stats(self):
+        now = time.time()
+        result = {"users": 0, "links": 0, "posts": 0, "messages": 0}
+        for entries, lock in self._shards:
+            with lock:
+                for chat_id in list(entries):
+                    record = self._record(entries, chat_id, now)
+                    result["users"] += 1
+                    result["links"] += record['state'] == WAITING_FOR_DOWNLOAD
+                    result["posts"] += bool(record['post'])
+                    result["messages"] += record['messages']
+        return result
+
+
+class SQLiteStateStore:
+    """
+    Состояние чатов в SQLite: переживает перезапуск и общее для нескольких
+    процессов бота. Чаты распределены по STATE_SHARDS файлам. Устаревшие
+    записи стираются при запуске и затем каждые purge_every переходов.
+    """
+
+    def __init__(self, path=STATE_DB, post_ttl=POST_TTL, download_ttl=DOWNLOAD_STATE_TTL, shards=STATE_SHARDS,
+                 purge_every=STATE_PURGE_EVERY):
+        self.post_ttl = post_ttl
+        self.download_ttl = download_ttl
+        self.purge_every = purge_every
+        root, ext = os.path.splitext(path)
+        paths = [path] if shards <= 1 else [f"{root}-{i}{ext}" for i in range(shards)]
+        self._shards = [(self._connect(p), threading.Lock()) for p in paths]
+        self._transitions = 0
+        self._transitions_lock = threading.Lock()
+        self.purge()
+
+    def _connect(self, path):
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chats ("
+            "chat_id INTEGER PRIMARY KEY, "
+            "state TEXT, "
+            "state_at REAL, "
+            "link TEXT, "
+            "post TEXT NOT NULL DEFAULT '', "
+            "post_at REAL, "
+            "messages INTEGER NOT NULL DEFAULT 0)"
+        )
+        return conn
+
+    def _shard(self, chat_id):
+        return self._shards[chat_id % len(self._shards)]
+
+    def purge(self):
+        """Стирает устаревшие тексты постов и зависшие загрузки."""
+        now = time.time()
+        cleared = 0
+        for conn, lock in self._shards:
+            with lock:
+                conn.execute(
+                    "UPDATE chats SET post = '' WHERE post != '' AND post_at < ?", (now - self.post_ttl,)
+                )
+                cur = conn.execute(
+                    "UPDATE chats SET state = ?, state_at = ?, link = NULL WHERE state = ? AND state_at < ?",
+                    (WAITING_FOR_LINK, now, WAITING_FOR_DOWNLOAD, now - self.download_ttl)
+                )
+                cleared += cur.rowcount
+        if cleared:
+            logging.info(f"Сброшено зависших загрузок: {cleared}")
+
+    def _upsert(self, conn, chat_id, now, fields):
+        if 'state' in fields:
+            fields['state_at'] = now
+        if 'post' in fields:
+            fields['post'] = fields['post'] or ''
+            fields['post_at'] = now
+        columns = list(fields)
+        conn.execute(
+            f"INSERT INTO chats (chat_id, {', '.join(columns)}) VALUES (?{', ?' * len(columns)}) "
+            f"ON CONFLICT (chat_id) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in columns)}",
+            [chat_id] + [fields[c] for c in columns]
+        )
+
+    def get_state(self, chat_id):
+        conn, lock = self._shard(chat_id)
+        with lock:
+            row = conn.execute("SELECT state, state_at FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        return _effective_state(row[0], row[1], time.time(), self.download_ttl)
+
+    def set_state(self, chat_id, state):
+        self.transition(chat_id, state)
+
+    def transition(self, chat_id, state, unless=(), **fields):
+        """
+        Атомарно (и между процессами) переводит чат в state, если текущее
+        состояние не входит в unless. Возвращает True, если перевод выполнен.
+        """
+        conn, lock = self._shard(chat_id)
+        now = time.time()
+        with lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT state, state_at FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+                current = _effective_state(row[0], row[1], now, self.download_ttl) if row else None
+                applied = current not in unless
+                if applied:
+                    self._upsert(conn, chat_id, now, dict(fields, state=state))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        self._count_transition()
+        return applied
+
+    def _count_transition(self):
+        with self._transitions_lock:
+            self._transitions += 1
+            due = self.purge_every and self._transitions % self.purge_every == 0
+        if due:
+            try:
+                self.purge()
+            except sqlite3.Error as e:
+                logging.warning(f"Не удалось очистить состояние чатов: {e}")
+
+    def reset(self, chat_id):
+        """Чат снова ждёт ссылку, прошлые ссылка и пост забыты."""
+        self.transition(chat_id, WAITING_FOR_LINK, link=None, post='')
+
+    def get_post(self, chat_id):
+        conn, lock = self._shard(chat_id)
+        with lock:
+            row = conn.execute(
+                "SELECT post FROM chats WHERE chat_id = ? AND post_at >= ?", (chat_id, time.time() - self.post_ttl)
+            ).fetchone()
+        return row[0] if row else ''
+
+    def set_post(self, chat_id, post):
+        conn, lock = self._shard(chat_id)
+        with lock:
+            self._upsert(conn, chat_id, time.time(), {'post': post})
+
+    def increment_messages(self, chat_id):
+        conn, lock = self._shard(chat_id)
+        with lock:
+            conn.execute(
+                "INSERT INTO chats (chat_id, messages) VALUES (?, 1) "
+                "ON CONFLICT (chat_id) DO UPDATE SET messages = messages + 1",
+                (chat_id,)
+            )
+
+    def stats(self):
+        now = time.time()
+        result = {"users": 0, "links": 0, "posts": 0, "messages": 0}
+        for conn, lock in self._shards:
+            with lock:
+                row = conn.execute(
+                    "SELECT COUNT(*), "
+                    "COALESCE(SUM(state = ? AND state_at >= ?), 0), "
+                    "COALESCE(SUM(post != '' AND post_at >= ?), 0), "
+                    "COALESCE(SUM(messages), 0) FROM chats",
+                    (WAITING_FOR_DOWNLOAD, now - self.download_ttl, now - self.post_ttl)
+                ).fetchone()
+            for key, value in zip(("users", "links", "posts", "messages"), row):
+                result[key] += value
+        return result
+
+
+def open_state_store():
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore()
+    return SQLiteStateStore()
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+import encode
+from encode import EncodeController
+
+
+@pytest.fixture(autouse=True)
+def idle_machine(monkeypatch):
+    # Пресет зависит и от загрузки машины; в тестах она не должна влиять
+    monkeypatch.setattr(encode, "_load_per_core", lambda: 0.0)
+
+
+def make_controller(budget=8, slots=4, backlog=0, peers=1):
+    controller = EncodeController(budget=budget, presets=["fast", "faster", "veryfast"], backlog_step=4, slots=slots)
+    controller.backlog = lambda: backlog
+    controller.peers = lambda: peers
+    return controller
+
+
+def test_lone_encode_takes_whole_budget():
+    controller = make_controller()
+    profile = controller.acquire()
+    assert profile["threads"] == 8
+    assert profile["preset"] == "fast"
+    controller.release(profile)
+    assert controller.threads_in_use == 0 and controller.active == 0
+
+
+def test_contended_encode_is_capped_per_slot():
+    controller = make_controller()
+    first = controller.acquire()
+    controller.release(first)
+    controller.waiting = 1  # ещё одно кодирование ждёт потоков
+    profile = controller.acquire()
+    assert profile["threads"] == 8 // 4
+
+
+def test_budget_is_split_between_peers():
+    controller = make_controller(peers=2)
+    assert controller.local_budget() == 4
+    assert controller.acquire()["threads"] == 4
+
+
+def test_backlog_selects_faster_preset():
+    assert make_controller(backlog=4).acquire()["preset"] == "faster"
+    assert make_controller(backlog=100).acquire()["preset"] == "veryfast"
+
+
+def test_acquire_waits_for_free_threads():
+    controller = make_controller(budget=2)
+    held = controller.acquire()
+    assert held["threads"] == 2
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(controller.acquire()))
+    waiter.start()
+    waiter.join(0.2)
+    assert waiter.is_alive() and controller.waiting == 1
+    controller.release(held)
+    waiter.join(1)
+    assert acquired and acquired[0]["threads"] >= 1
+    assert controller.waiting == 0
+
+
+def test_reserve_skips_non_encode_modes():
+    controller = make_controller()
+    with controller.reserve("remux") as profile:
+        assert profile is None
+        assert controller.threads_in_use == 0
+    with controller.reserve("encode") as profile:
+        assert controller.threads_in_use == profile["threads"]
+    assert controller.threads_in_use == 0
@@ -0,0 +1,145 @@
+import jobs
+from jobs import JobQueue
+
+
+def make_queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"))
+
+
+def job_status(queue, job_id):
+    return queue._conn.execute("SELECT status, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def test_claim_empty_queue(tmp_path):
+    assert make_queue(tmp_path).claim() is None
+
+
+def test_claim_marks_job_running(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.enqueue(1, 10, "https://example.com/1")
+    job = queue.claim()
+    assert job["id"] == job_id
+    assert job["status"] == "pending"  # строка до захвата
+    assert job_status(queue, job_id)["status"] == "running"
+    assert queue.claim() is None
+
+
+def test_claim_alternates_users(tmp_path):
+    # Пользователь с задачей в работе пропускает вперёд остальных
+    queue = make_queue(tmp_path)
+    a1 = queue.enqueue(1, 10, "https://example.com/a1")
+    a2 = queue.enqueue(1, 10, "https://example.com/a2")
+    b1 = queue.enqueue(2, 20, "https://example.com/b1")
+    assert [queue.claim()["id"] for _ in range(3)] == [a1, b1, a2]
+
+
+def test_finish_ignores_stale_run(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.enqueue(1, 10, "https://example.com/1")
+    job = queue.claim()
+    queue.finish(job_id, None, job["started_at"] - 1)
+    assert job_status(queue, job_id)["status"] == "running"
+    queue.finish(job_id, None, job["started_at"])
+    assert job_status(queue, job_id)["status"] == "done"
+
+
+def test_lead_makes_second_job_wait(tmp_path):
+    queue = make_queue(tmp_path)
+    leader = queue.enqueue(1, 10, "https://example.com/p")
+    waiter = queue.enqueue(2, 20, "https://example.com/p")
+    queue.claim(), queue.claim()
+    assert queue.lead(leader, "site:p") == {}
+    assert queue.lead(waiter, "site:p") == {"leader": leader}
+    assert job_status(queue, waiter)["status"] == "waiting"
+    assert [w["id"] for w in queue.waiters(leader)] == [waiter]
+
+
+def test_lead_returns_cached_result(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.enqueue(1, 10, "https://example.com/p")
+    queue.claim()
+    result = {"media": [["video", "file-id"]]}
+    assert queue.lead(job_id, "site:p", lambda key: result if key == "site:p" else None) == {"cached": result}
+
+
+def test_wake_waiters_requeues_them(tmp_path):
+    queue = make_queue(tmp_path)
+    leader = queue.enqueue(1, 10, "https://example.com/p")
+    waiter = queue.enqueue(2, 20, "https://example.com/p")
+    queue.claim(), queue.claim()
+    queue.lead(leader, "site:p")
+    queue.lead(waiter, "site:p")
+    assert queue.wake_waiters(leader) == 1
+    assert job_status(queue, waiter)["status"] == "pending"
+    # Ведущая больше не держит ключ: следующая задача скачивает пост сама
+    assert queue.claim()["id"] == waiter
+    assert queue.lead(waiter, "site:p") == {}
+
+
+def test_fail_waiters_fans_out_error_once(tmp_path):
+    queue = make_queue(tmp_path)
+    leader = queue.enqueue(1, 10, "https://example.com/p")
+    waiters = [queue.enqueue(chat, chat, "https://example.com/p") for chat in (2, 3, 4)]
+    for _ in range(4):
+        queue.claim()
+    queue.lead(leader, "site:p")
+    for waiter in waiters:
+        assert queue.lead(waiter, "site:p") == {"leader": leader}
+
+    failed = queue.fail_waiters(leader, "site:p", "⚠️ Не удалось скачать видео")
+    assert sorted(row["id"] for row in failed) == waiters
+    assert {row["chat_id"] for row in failed} == {2, 3, 4}
+    for waiter in waiters:
+        assert tuple(job_status(queue, waiter)) == ("failed", "⚠️ Не удалось скачать видео")
+    assert queue.wake_waiters(leader) == 0
+
+    # Новая ссылка на тот же пост в течение SHARED_FAILURE_TTL не скачивается заново
+    late = queue.enqueue(5, 50, "https://example.com/p")
+    queue.claim()
+    assert queue.lead(late, "site:p") == {"error": "⚠️ Не удалось скачать видео"}
+
+
+def test_failure_expires(tmp_path, monkeypatch):
+    queue = make_queue(tmp_path)
+    leader = queue.enqueue(1, 10, "https://example.com/p")
+    queue.claim()
+    queue.lead(leader, "site:p")
+    queue.fail_waiters(leader, "site:p", "ошибка")
+    monkeypatch.setattr(jobs, "SHARED_FAILURE_TTL", -1)
+    retry = queue.enqueue(1, 10, "https://example.com/p")
+    queue.claim()
+    assert queue.lead(retry, "site:p") == {}
+
+
+def test_cancel_waiting(tmp_path):
+    queue = make_queue(tmp_path)
+    leader = queue.enqueue(1, 10, "https://example.com/p")
+    waiter = queue.enqueue(2, 20, "https://example.com/p")
+    queue.claim(), queue.claim()
+    queue.lead(leader, "site:p")
+    queue.lead(waiter, "site:p")
+    assert queue.cancel_waiting(waiter, 3) is None  # чужой чат
+    assert queue.cancel_waiting(waiter, 2) == "https://example.com/p"
+    assert tuple(job_status(queue, waiter)) == ("failed", "cancelled")
+    assert queue.cancel_waiting(waiter, 2) is None
+
+
+def test_recover_requeues_expired_leases_and_orphans(tmp_path, monkeypatch):
+    queue = make_queue(tmp_path)
+    leader = queue.enqueue(1, 10, "https://example.com/p")
+    waiter = queue.enqueue(2, 20, "https://example.com/p")
+    queue.claim(), queue.claim()
+    queue.lead(leader, "site:p")
+    queue.lead(waiter, "site:p")
+
+    queue.recover()
+    assert job_status(queue, leader)["status"] == "running"
+    assert job_status(queue, waiter)["status"] == "waiting"
+
+    # Аренда ведущей истекла: она и её ожидающая возвращаются в очередь
+    monkeypatch.setattr(jobs, "JOB_LEASE_SECONDS", -1)
+    queue.recover()
+    assert job_status(queue, leader)["status"] == "pending"
+    assert job_status(queue, waiter)["status"] == "pending"
+    assert queue.claim()["id"] == leader
+    assert queue.lead(leader, "site:p") == {}
@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+from jobs import JobQueue
+from ratelimit import TokenBucket, TelegramRateLimiter, HIGH, LOW
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(rate=2, capacity=2)
+    now = bucket.updated
+    for _ in range(2):
+        assert bucket.delay(now) == 0
+        bucket.take()
+    assert bucket.delay(now) == pytest.approx(0.5)
+    assert bucket.delay(now + 0.5) == 0
+
+
+def test_token_bucket_does_not_exceed_capacity():
+    bucket = TokenBucket(rate=10, capacity=3)
+    now = bucket.updated + 100
+    bucket.delay(now)
+    assert bucket.tokens == 3
+
+
+def timed(func, *args):
+    started = time.monotonic()
+    func(*args)
+    return time.monotonic() - started
+
+
+def test_chat_burst_then_rate():
+    limiter = TelegramRateLimiter(global_rate=1000, chat_rate=10, chat_burst=2)
+    assert timed(limiter.acquire, 1) < 0.05
+    assert timed(limiter.acquire, 1) < 0.05
+    assert timed(limiter.acquire, 1) == pytest.approx(0.1, abs=0.05)
+    # Лимит другого чата не тронут
+    assert timed(limiter.acquire, 2) < 0.05
+
+
+def test_group_chat_has_its_own_rate():
+    limiter = TelegramRateLimiter(global_rate=1000, group_rate=10)
+    limiter.acquire(-100)
+    assert timed(limiter.acquire, -100) == pytest.approx(0.1, abs=0.05)
+
+
+def test_low_priority_yields_to_waiting_high():
+    limiter = TelegramRateLimiter(global_rate=1000, chat_rate=5, chat_burst=1)
+    limiter.acquire(1)
+    order = []
+    high = threading.Thread(target=lambda: (limiter.acquire(1, HIGH), order.append("high")))
+    high.start()
+    time.sleep(0.05)
+    limiter.acquire(1, LOW)
+    order.append("low")
+    high.join()
+    assert order == ["high", "low"]
+
+
+def too_many_requests(retry_after):
+    return ApiTelegramException("sendMessage", None, {
+        "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": retry_after},
+    })
+
+
+def test_call_retries_after_429():
+    limiter = TelegramRateLimiter(global_rate=1000, chat_rate=1000, chat_burst=10)
+    calls = []
+
+    def send():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise too_many_requests(0.2)
+        return "ok"
+
+    assert limiter.call(1, HIGH, send) == "ok"
+    assert calls[1] - calls[0] == pytest.approx(0.2, abs=0.05)
+    assert limiter.stats()["retries"] == 1
+
+
+def test_call_raises_other_errors():
+    limiter = TelegramRateLimiter()
+
+    def send():
+        raise ApiTelegramException("sendMessage", None, {"error_code": 400, "description": "Bad Request"})
+
+    with pytest.raises(ApiTelegramException):
+        limiter.call(1, HIGH, send)
+
+
+def test_shared_budget_spans_processes(tmp_path):
+    # Два лимитера (как два процесса) делят один общий лимит через очередь
+    path = str(tmp_path / "jobs.sqlite3")
+    limiters = [TelegramRateLimiter(global_rate=10, chat_rate=1000, chat_burst=1000) for _ in range(2)]
+    for limiter in limiters:
+        limiter.use_shared_budget(JobQueue(path))
+    started = time.monotonic()
+    threads = [threading.Thread(target=lambda l=limiter: [l.acquire(None) for _ in range(10)]) for limiter in limiters]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 10 токенов запаса, остальные 10 — по 10 в секунду
+    assert time.monotonic() - started == pytest.approx(1.0, abs=0.25)
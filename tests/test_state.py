@@ -0,0 +1,63 @@
+import threading
+import time
+
+from state import SQLiteStateStore, WAITING_FOR_LINK, WAITING_FOR_DOWNLOAD
+
+
+def make_store(tmp_path, **kwargs):
+    return SQLiteStateStore(str(tmp_path / "state.sqlite3"), **kwargs)
+
+
+def test_transition_sets_state_and_fields(tmp_path):
+    store = make_store(tmp_path)
+    assert store.get_state(1) is None
+    assert store.transition(1, WAITING_FOR_DOWNLOAD, link="https://example.com/1", post="текст")
+    assert store.get_state(1) == WAITING_FOR_DOWNLOAD
+    assert store.get_post(1) == "текст"
+
+
+def test_transition_refuses_state_in_unless(tmp_path):
+    store = make_store(tmp_path)
+    assert store.transition(1, WAITING_FOR_DOWNLOAD, unless=(WAITING_FOR_DOWNLOAD,))
+    assert not store.transition(1, WAITING_FOR_DOWNLOAD, unless=(WAITING_FOR_DOWNLOAD,))
+    store.reset(1)
+    assert store.get_state(1) == WAITING_FOR_LINK
+    assert store.transition(1, WAITING_FOR_DOWNLOAD, unless=(WAITING_FOR_DOWNLOAD,))
+
+
+def test_stuck_download_expires(tmp_path):
+    store = make_store(tmp_path, download_ttl=0.1)
+    store.transition(1, WAITING_FOR_DOWNLOAD)
+    time.sleep(0.2)
+    assert store.get_state(1) == WAITING_FOR_LINK
+    assert store.transition(1, WAITING_FOR_DOWNLOAD, unless=(WAITING_FOR_DOWNLOAD,))
+
+
+def test_transition_is_atomic_across_stores(tmp_path):
+    # Отдельные соединения, как у разных процессов: захватить чат удаётся одному
+    stores = [make_store(tmp_path) for _ in range(8)]
+    results = []
+    barrier = threading.Barrier(len(stores))
+
+    def grab(store):
+        barrier.wait()
+        results.append(store.transition(1, WAITING_FOR_DOWNLOAD, unless=(WAITING_FOR_DOWNLOAD,)))
+
+    threads = [threading.Thread(target=grab, args=(store,)) for store in stores]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(results) == [False] * 7 + [True]
+
+
+def test_transitions_purge_expired_posts(tmp_path):
+    store = make_store(tmp_path, post_ttl=0.1, purge_every=3, shards=1)
+    store.set_post(1, "старый текст")
+    time.sleep(0.2)
+    conn = store._shard(1)[0]
+    store.transition(2, WAITING_FOR_DOWNLOAD)
+    store.transition(3, WAITING_FOR_DOWNLOAD)
+    assert conn.execute("SELECT post FROM chats WHERE chat_id = 1").fetchone()[0] == "старый текст"
+    store.transition(4, WAITING_FOR_DOWNLOAD)
+    assert conn.execute("SELECT post FROM chats WHERE chat_id = 1").fetchone()[0] == ""
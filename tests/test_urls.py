@@ -0,0 +1,56 @@
+import pytest
+
+from cache import resolve_post_key
+from urls import parse_link, link_key, extract_links
+
+
+@pytest.mark.parametrize("url, platform, key, clean", [
+    ("https://www.instagram.com/reel/Cx1Ab/?igsh=xyz&utm_source=ig",
+     "instagram", "instagram:Cx1Ab", "https://www.instagram.com/reel/Cx1Ab/"),
+    ("instagram.com/p/Cx2Cd/", "instagram", "instagram:Cx2Cd", "https://www.instagram.com/p/Cx2Cd/"),
+    ("https://m.tiktok.com/@user/video/7234567890123456789?is_from_webapp=1",
+     "tiktok", "tiktok:7234567890123456789", "https://www.tiktok.com/@user/video/7234567890123456789"),
+    ("https://pinterest.ru/pin/some-title--123456/",
+     "pinterest", "pinterest:123456", "https://www.pinterest.com/pin/some-title--123456/"),
+])
+def test_parse_link_extracts_post_id(url, platform, key, clean):
+    link = parse_link(url)
+    assert (link.platform, link.key, link.url, link.short) == (platform, key, clean, False)
+
+
+@pytest.mark.parametrize("url", [
+    "https://vm.tiktok.com/ZMabc/?x=1",
+    "https://www.tiktok.com/t/ZTabc/",
+    "https://pin.it/4abc",
+    "https://www.instagram.com/share/reel/abc/",
+])
+def test_parse_link_marks_short_links(url):
+    link = parse_link(url)
+    assert link.short and link.key is None
+    assert "?" not in link.url
+
+
+@pytest.mark.parametrize("url", ["https://example.com/x", "https://ig.me/abc", "https://notinstagram.com/p/abc/"])
+def test_parse_link_unknown_host(url):
+    assert parse_link(url).platform is None
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.instagram.com/reel/Cx1Ab/",
+    "https://www.tiktok.com/@user/video/7234567890123456789",
+])
+def test_link_key_matches_yt_dlp(url):
+    # Ключ из ссылки совпадает с ключом экстрактора, иначе кэш не найдёт пост
+    assert link_key(parse_link(url)) == resolve_post_key(url)
+
+
+def test_link_key_falls_back_to_extractor():
+    link = parse_link("https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+    assert link.key is None
+    assert link_key(link) == "youtube:dQw4w9WgXcQ"
+
+
+def test_extract_links_dedupes_posts():
+    text = ("смотри https://www.instagram.com/reel/Cx1Ab/?igsh=1 и "
+            "https://instagram.com/reel/Cx1Ab/ и https://www.tiktok.com/@u/video/1")
+    assert [link.key for link in extract_links(text)] == ["instagram:Cx1Ab", "tiktok:1"]
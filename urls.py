@@ -0,0 +1,251 @@
+import os
+import re
+import time
+import logging
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit
+
+from cache import resolve_post_key
+from singleflight import SingleFlight
+
+# Сколько ссылок из одного сообщения ставить в очередь
+MAX_LINKS_PER_MESSAGE = int(os.getenv("MAX_LINKS_PER_MESSAGE", "5"))
+# Короткая ссылка всегда ведёт на один и тот же пост, поэтому храним долго
+SHORT_LINK_TTL = int(os.getenv("SHORT_LINK_TTL", str(24 * 3600)))
+SHORT_LINK_CACHE_SIZE = int(os.getenv("SHORT_LINK_CACHE_SIZE", "10000"))
+SHORT_LINK_TIMEOUT = float(os.getenv("SHORT_LINK_TIMEOUT", "5"))
+
+# Ссылка в тексте: со схемой или без неё, но тогда с путём (instagram.com/reel/...)
+_URL_RE = re.compile(
+    r"(?:https?://(?:[\w-]+\.)*[\w-]+|(?:[\w-]+\.)+[a-z]{2,}(?=/))(?::\d+)?(?:/[^\s<>\"'«»]*)?",
+    re.IGNORECASE
+)
+_TRAILING = ".,;:!?)]}…"
+
+# Платформа по хосту одним регулярным выражением; имя группы — имя платформы в pipeline
+_HOST_RE = re.compile(
+    r"(?:^|\.)(?:"
+    r"(?P<instagram>instagram\.com|instagr\.am)"
+    r"|(?P<tiktok>tiktok\.com)"
+    r"|(?P<pinterest>pinterest\.(?:com?\.)?[a-z]{2,3}|pin\.it)"
+    r")$"
+)
+# Платформы, которые определяются только по хосту: шаблоны pipeline для них не нужны
+HOST_PLATFORMS = frozenset(_HOST_RE.groupindex)
+
+# Хосты, у которых любая ссылка — редирект на пост
+_SHORT_HOSTS = {"vm.tiktok.com", "vt.tiktok.com", "pin.it"}
+# Короткие ссылки на основном домене: tiktok.com/t/..., instagram.com/share/...
+_SHORT_PATHS = {
+    "tiktok": re.compile(r"^/t/[\w-]+"),
+    "instagram": re.compile(r"^/share/"),
+}
+_NEVER = re.compile(r"(?!)")
+
+# ID поста в пути ссылки в том виде, в каком его возвращает экстрактор yt-dlp
+_POST_ID_RE = {
+    "instagram": re.compile(r"^/(?:[\w.]+/)?(?:p|reels?|tv)/([\w-]+)"),
+    "tiktok": re.compile(r"^/(?:@[^/]+/(?:video|photo)|v|embed(?:/v2)?)/(\d+)"),
+    "pinterest": re.compile(r"^/pin/(?:[\w-]*--)?(\d+)"),
+}
+
+# Канонический хост: мобильные (m.) и региональные (pinterest.ru) домены ведут на тот же пост
+_CANONICAL_HOSTS = {
+    "instagram": "www.instagram.com",
+    "tiktok": "www.tiktok.com",
+    "pinterest": "www.pinterest.com",
+}
+
+
+class Link:
+    """
+    Разобранная ссылка. url — без параметров отслеживания (utm, igsh, is_from_webapp),
+    key — ключ поста для кэша и объединения загрузок (None, если ID не виден в ссылке).
+    """
+
+    __slots__ = ("url", "platform", "post_id", "key", "short")
+
+    def __init__(self, url, platform=None, post_id=None, short=False):
+        self.url = url
+        self.platform = platform
+        self.post_id = post_id
+        self.key = f"{platform}:{post_id}" if platform and post_id else None
+        self.short = short
+
+    def __repr__(self):
+        return f"Link({self.url!r}, platform={self.platform!r}, key={self.key!r}, short={self.short})"
+
+
+def _host_platform(host):
+    match = _HOST_RE.search(host)
+    return match.lastgroup if match else None
+
+
+@lru_cache(maxsize=4096)
+def parse_link(url):
+    """
+    Классифицирует ссылку, достаёт ID поста и убирает параметры запроса.
+    Сети не требует; короткие ссылки раскрывает resolve_link.
+    Ссылки неизвестных платформ возвращаются без изменений, с platform=None.
+    """
+    url = url.strip()
+    parts = urlsplit(url if "://" in url else f"https://{url}")
+    host = (parts.hostname or "").lower()
+    platform = _host_platform(host)
+    if platform is None:
+        return Link(url)
+    path = parts.path or "/"
+    short = host in _SHORT_HOSTS or bool(_SHORT_PATHS.get(platform, _NEVER).match(path))
+    if short:
+        # Путь короткой ссылки и есть её ключ, параметры на редирект не влияют
+        return Link(urlunsplit(("https", host, path, "", "")), platform, short=True)
+    match = _POST_ID_RE[platform].match(path)
+    if match is None:
+        # Без ID поста хост не меняем: api.pinterest.com/url_shortener/... на www не работает
+        return Link(url if "://" in url else f"https://{url}", platform)
+    return Link(urlunsplit(("https", _CANONICAL_HOSTS[platform], path, "", "")), platform, match.group(1))
+
+
+def extract_links(text, limit=MAX_LINKS_PER_MESSAGE, accept=None):
+    """
+    Ссылки из текста сообщения по порядку, без повторов одного поста.
+    accept(link) отсеивает неподдерживаемые ссылки до того, как считается limit.
+    """
+    links = []
+    seen = set()
+    for match in _URL_RE.finditer(text or ""):
+        link = parse_link(match.group(0).rstrip(_TRAILING))
+        key = link.key or link.url
+        if key in seen or (accept and not accept(link)):
+            continue
+        seen.add(key)
+        links.append(link)
+        if len(links) >= limit:
+            break
+    return links
+
+
+class _Resolved(Exception):
+    def __init__(self, url):
+        super().__init__(url)
+        self.url = url
+
+
+class _StopAtPost(urllib.request.HTTPRedirectHandler):
+    # Страницу самого поста не запрашиваем: достаточно адреса из Location.
+    # Промежуточные редиректы без ID поста (pin.it -> api.pinterest.com/url_shortener/...) проходим
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if parse_link(newurl).key:
+            raise _Resolved(newurl)
+        request = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if request is not None:
+            # urllib превращает повторный запрос в GET; HEAD не скачивает промежуточные страницы
+            request.method = req.get_method()
+        return request
+
+
+class ShortLinkResolver:
+    """
+    Раскрывает короткие ссылки (vm.tiktok.com, pin.it) по редиректам.
+    Результат хранится в памяти процесса ttl секунд, одновременные запросы
+    одной ссылки объединяются. При ошибке возвращается исходная ссылка —
+    yt-dlp пройдёт редирект сам.
+    """
+
+    def __init__(self, ttl=SHORT_LINK_TTL, max_entries=SHORT_LINK_CACHE_SIZE, timeout=SHORT_LINK_TIMEOUT):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.resolved = 0  # раскрыто по сети (промахи кэша без ошибок)
+        self.failures = 0
+        self._entries = OrderedDict()
+        self._flights = SingleFlight()
+        self._opener = urllib.request.build_opener(_StopAtPost())
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(url, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, url, target):
+        with self._lock:
+            self._entries[url] = (target, time.monotonic() + self.ttl)
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def resolve(self, url):
+        target = self.get(url)
+        if target is not None:
+            return target
+        return self._flights.do(url, lambda: self._resolve(url))
+
+    def _resolve(self, url):
+        try:
+            target = self._follow(url)
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            logging.warning(f"Не удалось раскрыть короткую ссылку {url}: {e}")
+            return url
+        logging.info(f"Короткая ссылка {url} -> {target}")
+        with self._lock:
+            self.resolved += 1
+        self.put(url, target)
+        return target
+
+    def _follow(self, url):
+        # HEAD не скачивает страницу; часть сайтов отвечает на него 405, тогда GET без чтения тела
+        for method in ("HEAD", "GET"):
+            request = urllib.request.Request(url, method=method, headers={"User-Agent": "Mozilla/5.0"})
+            try:
+                with self._opener.open(request, timeout=self.timeout) as response:
+                    return response.geturl()
+            except _Resolved as e:
+                return e.url
+            except urllib.error.HTTPError as e:
+                if method == "GET" or e.code not in (403, 405):
+                    raise
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "resolved": self.resolved,
+            "failures": self.failures,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+resolver = ShortLinkResolver()
+
+
+def resolve_link(url):
+    """parse_link с раскрытием короткой ссылки; может обращаться к сети."""
+    link = parse_link(url)
+    if link.short:
+        expanded = parse_link(resolver.resolve(link.url))
+        # Редирект на неизвестный хост (страница входа и т.п.) ничего не даёт
+        if expanded.platform == link.platform:
+            return expanded
+    return link
+
+
+def link_key(link):
+    """Ключ поста для кэша: по ID из ссылки, иначе по экстрактору yt-dlp."""
+    return link.key or resolve_post_key(link.url)
@@ -0,0 +1,86 @@
+"""
+Приём обновлений Telegram через webhook (Flask/gunicorn) вместо long polling.
+
+Обновление проверяется по секретному токену, сохраняется в очередь jobs.sqlite3
+и сразу подтверждается; разбирают очередь потоки UPDATE_WORKERS в каждом
+процессе, поэтому gunicorn можно запускать с несколькими воркерами:
+
+    python webhook.py set                       # зарегистрировать webhook в Telegram
+    gunicorn -w 4 -b 0.0.0.0:8080 webhook:app   # принимать обновления
+"""
+import os
+import sys
+import hmac
+import json
+import logging
+
+import telebot
+from flask import Flask, request, abort
+
+import bot as core
+import metrics
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес, например https://example.com/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# 0 — только принимать обновления (например, для замеров webhook_replay)
+WEBHOOK_START_WORKERS = os.getenv("WEBHOOK_START_WORKERS", "1") == "1"
+
+# Без секрета любой, кто знает адрес, может слать боту поддельные обновления
+if not WEBHOOK_SECRET:
+    raise SystemExit("Укажите WEBHOOK_SECRET: без секретного токена webhook не запускается")
+
+app = Flask(__name__)
+
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        abort(403)
+    payload = request.get_data(as_text=True)
+    try:
+        json.loads(payload)
+    except ValueError:
+        abort(400)
+    core.job_queue.enqueue_update(payload)
+    return ''
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return 'ok'
+
+
+def process_update(payload):
+    update = telebot.types.Update.de_json(payload)
+    core.bot.process_new_updates([update])
+
+
+def start_workers():
+    # Обработчики выполняются прямо в потоках UPDATE_WORKERS, без пула TeleBot
+    core.bot.threaded = False
+    # С BOT_ROLE=dispatcher задачи выполняют отдельные процессы worker.py
+    if core.BOT_ROLE != "dispatcher":
+        core.job_queue.start(core.process_download)
+    core.job_queue.start_updates(process_update)
+    metrics.start_metrics_server()
+    logging.info("Webhook: обработчики очереди запущены")
+
+
+def set_webhook():
+    if not WEBHOOK_URL:
+        raise SystemExit("Укажите WEBHOOK_URL")
+    core.bot.remove_webhook()
+    core.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    print(f"Webhook установлен: {WEBHOOK_URL}")
+
+
+if WEBHOOK_START_WORKERS and not (__name__ == '__main__' and sys.argv[1:] == ['set']):
+    start_workers()
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['set']:
+        set_webhook()
+    else:
+        app.run(host='0.0.0.0', port=int(os.getenv("PORT", "8080")))
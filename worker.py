@@ -0,0 +1,57 @@
+"""
+Отдельный процесс-воркер: берёт из очереди jobs.sqlite3 задачи на скачивание,
+перекодирование и отправку, а обновления Telegram не принимает. Так приём
+сообщений (диспетчер) и тяжёлая обработка масштабируются отдельно:
+
+    BOT_ROLE=dispatcher python bot.py       # или webhook.py — только ставит задачи
+    python worker.py                        # сколько угодно таких процессов
+    python worker.py --workers 2            # задач одновременно в этом процессе
+
+Прогресс воркер сообщает сам: правит сообщение о статусе в чате через Bot API
+и пишет этап задачи в очередь, откуда его видит статистика диспетчера.
+Отмена из чата доходит до воркера через флаг в очереди. По SIGTERM воркер
+перестаёт брать задачи и дорабатывает текущие.
+"""
+import os
+import sys
+import signal
+import logging
+import argparse
+import threading
+
+import bot as core
+import metrics
+from jobs import DOWNLOAD_WORKERS, WORKER_ID
+
+# Сколько ждать завершения текущих задач при остановке, секунд
+WORKER_DRAIN_SECONDS = int(os.getenv("WORKER_DRAIN_SECONDS", "300"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=DOWNLOAD_WORKERS, help='задач одновременно')
+    args = parser.parse_args()
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        logging.info(f"Воркер {WORKER_ID}: получен сигнал {signum}, дорабатываю текущие задачи")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    metrics.start_metrics_server()
+    core.job_queue.start(core.process_download, workers=args.workers, role="worker")
+    print(f"Воркер {WORKER_ID} запущен, задач одновременно: {args.workers}")
+    while not stopping.wait(1.0):
+        pass
+    if not core.job_queue.stop(timeout=WORKER_DRAIN_SECONDS):
+        # Недоделанные задачи вернутся в очередь, когда истечёт их аренда
+        logging.warning(f"Воркер {WORKER_ID}: не все задачи завершились за {WORKER_DRAIN_SECONDS} с")
+        sys.exit(1)
+    logging.info(f"Воркер {WORKER_ID} остановлен")
+
+
+if __name__ == '__main__':
+    main()